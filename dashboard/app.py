@@ -2,6 +2,7 @@
 Edmonton Transit Equity Dashboard
 River Valley Light Theme — Built with Dash (Plotly)
 
+Build: python bundle.py
 Run:  python app.py
 Open:  http://localhost:8050
 """
@@ -12,151 +13,20 @@ import plotly.express as px
 import plotly.graph_objects as go
 import pandas as pd
 import numpy as np
+import functools
+import operator
 import os
-import json
-import geopandas as gpd
-import geopandas as gpd
+
+from bundle import load_bundle
 
 # ============================================================
 # DATA LOADING
 # ============================================================
 
-DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'data', 'EDM')
-
-def load_demographics():
-    """Load real demographics or generate sample data."""
-    demo_path = os.path.join(DATA_DIR, 'raw', 'demographics.csv')
-    if os.path.exists(demo_path):
-        df = pd.read_csv(demo_path, dtype={'DAUID': str})
-        return df
-    else:
-        # Generate sample for development
-        np.random.seed(42)
-        n = 200
-        return pd.DataFrame({
-            'DAUID': [f'4811{str(i).zfill(4)}' for i in range(n)],
-            'total_pop': np.random.randint(100, 2000, n),
-            'low_income': np.random.randint(10, 500, n),
-            'minority': np.random.randint(20, 600, n),
-            'seniors': np.random.randint(10, 400, n),
-        })
-
-def load_travel_times():
-    """Load travel time matrix or generate sample."""
-    tt_path = os.path.join(DATA_DIR, 'processed', 'travel_times.csv')
-    if os.path.exists(tt_path):
-        return pd.read_csv(tt_path, dtype={'from_id': str, 'to_id': str})
-    return None
-
-def compute_accessibility(demo_df, tt_df=None, threshold=45):
-    """Compute accessibility scores for each DA."""
-    n = len(demo_df)
-    
-    if tt_df is not None and len(tt_df) > 0:
-        # Real computation from travel time matrix
-        reachable = tt_df[tt_df['travel_time'] <= threshold].groupby('from_id').size()
-        scores = (reachable / n * 100).clip(0, 100)
-        demo_df = demo_df.copy()
-        demo_df['accessibility'] = demo_df['DAUID'].map(scores).fillna(0).round(1)
-        
-        avg_times = tt_df.groupby('from_id')['travel_time'].mean()
-        demo_df['avg_travel_time'] = demo_df['DAUID'].map(avg_times).fillna(60).round(1)
-    else:
-        # Sample data for development
-        np.random.seed(42)
-        demo_df = demo_df.copy()
-        demo_df['accessibility'] = np.random.uniform(5, 85, n).round(1)
-        demo_df['avg_travel_time'] = np.random.uniform(15, 55, n).round(1)
-    
-    # Derived metrics
-    demo_df['low_income_pct'] = (demo_df['low_income'] / demo_df['total_pop'].replace(0, 1) * 100).round(1)
-    demo_df['minority_pct'] = (demo_df['minority'] / demo_df['total_pop'].replace(0, 1) * 100).round(1)
-    demo_df['senior_pct'] = (demo_df['seniors'] / demo_df['total_pop'].replace(0, 1) * 100).round(1)
-    
-    # Vulnerability weight (normalized)
-    vuln = demo_df[['low_income_pct', 'minority_pct', 'senior_pct']].mean(axis=1)
-    demo_df['vulnerability'] = (vuln / vuln.max() * 100).round(1) if vuln.max() > 0 else 0
-    
-    # Transit Desert Score = low access + high vulnerability
-    demo_df['desert_score'] = ((100 - demo_df['accessibility']) * demo_df['vulnerability'] / 100).round(1)
-    
-    # Equity Index = access × vulnerability (high = vulnerable BUT well-served)
-    demo_df['equity_index'] = (demo_df['accessibility'] * demo_df['vulnerability'] / 100).round(1)
-    
-    # Rank
-    demo_df['access_rank'] = demo_df['accessibility'].rank(ascending=False).astype(int)
-    
-    # Rating
-    def rate(score):
-        if score >= 60: return 'Excellent'
-        if score >= 40: return 'Good'
-        if score >= 20: return 'Moderate'
-        return 'Poor'
-    demo_df['rating'] = demo_df['accessibility'].apply(rate)
-    
-    return demo_df
-
-
-# Load data
-demo = load_demographics()
-tt = load_travel_times()
-df = compute_accessibility(demo, tt)
-
-# Load centroids for map coordinates
-centroids_path = os.path.join(DATA_DIR, 'region', 'centroids.gpkg')
-try:
-    if os.path.exists(centroids_path):
-        centroids_gdf = gpd.read_file(centroids_path)
-        centroids_gdf = centroids_gdf.copy()
-        centroids_gdf['DAUID'] = centroids_gdf['DAUID'].astype(str)
-        centroids_gdf['lat'] = centroids_gdf.geometry.y
-        centroids_gdf['lon'] = centroids_gdf.geometry.x
-        coords = centroids_gdf[['DAUID', 'lat', 'lon']].copy()
-        
-        # Ensure DAUID is string in df as well
-        df['DAUID'] = df['DAUID'].astype(str)
-        
-        # Merge
-        df = df.merge(coords, on='DAUID', how='left')
-        
-        # Check if merge worked
-        if 'lat' in df.columns and df['lat'].notna().sum() > 0:
-            print(f"✅ Loaded {df['lat'].notna().sum()} centroid coordinates for map")
-        else:
-            raise ValueError("Centroid merge failed - no valid coordinates")
-    else:
-        raise FileNotFoundError(f"Centroids file not found: {centroids_path}")
-except Exception as e:
-    print(f"⚠️  Centroid loading failed: {e}")
-    print("   Using sample coordinates instead")
-    df['lat'] = np.random.uniform(53.4, 53.7, len(df))
-    df['lon'] = np.random.uniform(-113.7, -113.3, len(df))
-
-# Load neighbourhood names
-neighbourhood_path = os.path.join(DATA_DIR, 'processed', 'da_neighbourhood_map.csv')
-try:
-    if os.path.exists(neighbourhood_path):
-        hoods = pd.read_csv(neighbourhood_path, dtype={'DAUID': str})
-        df = df.merge(hoods, on='DAUID', how='left')
-        print(f"✅ Loaded neighbourhood names for {df['neighbourhood'].notna().sum()} DAs")
-    else:
-        df['neighbourhood'] = 'Unknown'
-except Exception as e:
-    print(f"⚠️  Neighbourhood loading failed: {e}")
-    df['neighbourhood'] = df['DAUID']
-
-# Load transit routes for overlay
-routes_path = os.path.join(DATA_DIR, 'processed', 'transit_routes.json')
-try:
-    if os.path.exists(routes_path):
-        with open(routes_path) as f:
-            transit_routes = json.load(f)
-        print(f"✅ Loaded {sum(len(v) for v in transit_routes.values())} transit routes")
-    else:
-        transit_routes = {'lrt': [], 'bus_high_freq': [], 'bus_regular': []}
-except Exception as e:
-    print(f"⚠️  Transit routes loading failed: {e}")
-    transit_routes = {'lrt': [], 'bus_high_freq': [], 'bus_regular': []}
+# Precomputed by `python bundle.py`, memory-mapped instead of parsed
+bundle = load_bundle()
+df = bundle.das
+print(f"✅ Loaded dashboard bundle {bundle.version} ({len(df):,} DAs)")
 
 # ============================================================
 # THEME COLORS (River Valley)
@@ -283,6 +153,18 @@ def build_header(title, subtitle=''):
             html.Div(subtitle, className='header-subtitle') if subtitle else None,
         ]),
         html.Div([
+            html.Div([
+                html.Label('Reachable within', className='header-threshold-label'),
+                dcc.Slider(
+                    id='threshold-slider',
+                    min=5,
+                    max=bundle.max_minutes,
+                    step=5,
+                    value=bundle.threshold,
+                    marks={m: f'{m} min' for m in range(30, bundle.max_minutes + 1, 30)},
+                    tooltip={'placement': 'bottom', 'template': '{value} min'},
+                ),
+            ], className='header-threshold'),
             html.Span(f'{len(df):,} Neighbourhoods', className='header-badge'),
             html.Span(f'{df["total_pop"].sum():,} Population', className='header-badge'),
         ], className='header-right'),
@@ -292,7 +174,7 @@ def build_header(title, subtitle=''):
 # TAB 1: EXECUTIVE OVERVIEW
 # ============================================================
 
-def build_overview_tab():
+def build_overview_tab(df):
     """Executive Overview - KPIs, charts, key insights."""
     
     # KPI calculations
@@ -482,7 +364,7 @@ def build_map_tab():
 # TAB 3: EQUITY ANALYSIS
 # ============================================================
 
-def build_equity_tab():
+def build_equity_tab(df):
     """Equity analysis with scatter plots and disparity metrics."""
     
     # Scatter: Low Income % vs Accessibility
@@ -559,15 +441,114 @@ def build_equity_tab():
 # TAB 4: NEIGHBOURHOOD EXPLORER
 # ============================================================
 
+TABLE_COLUMNS = ['DAUID', 'total_pop', 'low_income_pct', 'minority_pct', 'senior_pct',
+                 'accessibility', 'avg_travel_time', 'desert_score', 'rating', 'access_rank']
+
+# Dash filter operators, with the symbols typed into the filter row
+FILTER_OPERATORS = [['ge ', '>='], ['le ', '<='], ['lt ', '<'], ['gt ', '>'],
+                    ['ne ', '!='], ['eq ', '='], ['contains '], ['datestartswith ']]
+COMPARISONS = {'ge': operator.ge, 'le': operator.le, 'lt': operator.lt,
+               'gt': operator.gt, 'ne': operator.ne, 'eq': operator.eq}
+
+
+def split_filter_part(filter_part):
+    """Split one `{column} operator value` part of a Dash filter query."""
+    for operator_type in FILTER_OPERATORS:
+        for symbol in operator_type:
+            if symbol in filter_part:
+                name_part, value_part = filter_part.split(symbol, 1)
+                name = name_part[name_part.find('{') + 1:name_part.rfind('}')]
+                value_part = value_part.strip()
+                quote = value_part[:1]
+                if quote in ('"', "'", '`') and value_part[-1] == quote:
+                    value = value_part[1:-1].replace('\\' + quote, quote)
+                else:
+                    try:
+                        value = float(value_part)
+                    except ValueError:
+                        value = value_part
+                return name, operator_type[0].strip(), value
+    return None, None, None
+
+
+class NeighbourhoodTable:
+    """The explorer table as column arrays, with a sort order per column.
+
+    Sort orders are built once per column and reused by every page request, so
+    a request only filters and slices index arrays.
+    """
+
+    def __init__(self, data):
+        self.columns = {c: data[c].to_numpy() for c in TABLE_COLUMNS}
+        self.length = len(data)
+        self._orders = {}
+
+    def order(self, column, descending=False):
+        """Row positions sorted by a column, missing values last and ties in table order."""
+        key = (column, descending)
+        if key not in self._orders:
+            values = pd.Series(self.columns[column])
+            self._orders[key] = values.sort_values(
+                ascending=not descending, kind='stable', na_position='last').index.to_numpy()
+        return self._orders[key]
+
+    def filter_mask(self, filter_query):
+        """Boolean mask of the rows matching a Dash filter query, or None for all rows."""
+        mask = None
+        for part in (filter_query or '').split(' && '):
+            name, relation, value = split_filter_part(part)
+            if name not in self.columns:
+                continue
+            column = self.columns[name]
+            numeric = np.issubdtype(column.dtype, np.number)
+            if not numeric or relation in ('contains', 'datestartswith'):
+                if isinstance(value, float) and value.is_integer():
+                    value = int(value)
+                strings = pd.Series(column).astype(str)
+                value = str(value)
+            if relation == 'contains':
+                matches = strings.str.contains(value, case=False, regex=False).to_numpy()
+            elif relation == 'datestartswith':
+                matches = strings.str.startswith(value).to_numpy()
+            elif not numeric:
+                matches = COMPARISONS[relation](strings, value).to_numpy()
+            elif isinstance(value, str):
+                # Text typed into a numeric column matches nothing
+                matches = np.zeros(self.length, dtype=bool)
+            else:
+                matches = COMPARISONS[relation](column, value)
+            mask = matches if mask is None else mask & matches
+        return mask
+
+    def page(self, page_current, page_size, sort_by=None, filter_query=''):
+        """Records of one page of the sorted and filtered table, the number of pages,
+        and the page shown (the last page if page_current is past it)."""
+        if sort_by:
+            rows = self.order(sort_by[0]['column_id'], sort_by[0]['direction'] == 'desc')
+        else:
+            rows = np.arange(self.length)
+        mask = self.filter_mask(filter_query)
+        if mask is not None:
+            rows = rows[mask[rows]]
+        page_count = max(1, -(-len(rows) // page_size))
+        page_current = min(page_current, page_count - 1)
+        start = page_current * page_size
+        rows = rows[start:start + page_size]
+        page = pd.DataFrame({c: values[rows] for c, values in self.columns.items()})
+        return page.to_dict('records'), page_count, page_current
+
+
+@functools.lru_cache(maxsize=8)
+def neighbourhood_table(threshold, version):
+    """The explorer table at a threshold, cached by threshold and bundle version."""
+    return NeighbourhoodTable(bundle.at_threshold(threshold))
+
+
 def build_neighbourhoods_tab():
-    """Sortable data table with all neighbourhoods."""
-    
-    table_data = df[['DAUID', 'total_pop', 'low_income_pct', 'minority_pct', 'senior_pct',
-                      'accessibility', 'avg_travel_time', 'desert_score', 'rating', 'access_rank']].copy()
+    """Sortable data table with all neighbourhoods, paged by the server."""
     
     neighbourhood_table = dash_table.DataTable(
         id='neighbourhood-table',
-        data=table_data.to_dict('records'),
         columns=[
             {'name': 'DAUID', 'id': 'DAUID'},
             {'name': 'Population', 'id': 'total_pop', 'type': 'numeric'},
@@ -580,10 +561,14 @@ def build_neighbourhoods_tab():
             {'name': 'Rating', 'id': 'rating'},
             {'name': 'Rank', 'id': 'access_rank', 'type': 'numeric'},
         ],
-        sort_action='native',
-        filter_action='native',
+        sort_action='custom',
+        sort_mode='single',
+        sort_by=[],
+        filter_action='custom',
+        filter_query='',
         page_size=20,
-        page_action='native',
+        page_current=0,
+        page_action='custom',
         style_header={
             'backgroundColor': COLORS['green_100'],
             'color': COLORS['green_900'],
@@ -671,7 +656,7 @@ def build_methodology_tab():
             html.H3('🧮 Accessibility Score'),
             html.P('Measures what percentage of the city each neighbourhood can reach within a given time threshold using public transit.'),
             html.Div('accessibility_i = COUNT(DAs reachable within T minutes from DA_i) / TOTAL_DAs × 100', className='formula-block'),
-            html.P('Default threshold T = 45 minutes. Higher scores indicate better transit connectivity.'),
+            html.P(f'Default threshold T = {bundle.threshold} minutes, adjustable with the slider in the header. Higher scores indicate better transit connectivity.'),
         ], className='methodology-section'),
         
         html.Div([
@@ -726,74 +711,48 @@ app.layout = html.Div([
 
 
 # ============================================================
-# CALLBACKS
+# FIGURE CACHE
 # ============================================================
 
-# Tab navigation
-@callback(
-    Output('current-tab', 'data'),
-    [Input('nav-overview', 'n_clicks'),
-     Input('nav-map', 'n_clicks'),
-     Input('nav-equity', 'n_clicks'),
-     Input('nav-neighbourhoods', 'n_clicks'),
-     Input('nav-methodology', 'n_clicks')],
-    prevent_initial_call=False,
-)
-def switch_tab(c1, c2, c3, c4, c5):
-    ctx = dash.callback_context
-    if not ctx.triggered or ctx.triggered[0]['prop_id'] == '.':
-        return 'overview'
-    
-    trigger = ctx.triggered[0]['prop_id'].split('.')[0]
-    mapping = {
-        'nav-overview': 'overview',
-        'nav-map': 'map',
-        'nav-equity': 'equity',
-        'nav-neighbourhoods': 'neighbourhoods',
-        'nav-methodology': 'methodology',
-    }
-    return mapping.get(trigger, 'overview')
+# Tabs and map figures kept per (tab or metric, threshold, bundle version)
+FIGURE_CACHE_SIZE = int(os.environ.get('DASHBOARD_FIGURE_CACHE_SIZE', 64))
+
+# Map color metrics and their colorbar titles
+MAP_LABELS = {
+    'accessibility': 'Accessibility Score',
+    'avg_travel_time': 'Avg Travel Time (min)',
+    'low_income_pct': 'Low Income %',
+    'minority_pct': 'Minority %',
+    'senior_pct': 'Senior %',
+    'desert_score': 'Transit Desert Score',
+    'equity_index': 'Equity Index',
+    'total_pop': 'Population',
+}
 
+# Tabs whose content depends on the travel time threshold
+THRESHOLD_TABS = {'overview', 'equity'}
 
-# Render tab content
-@callback(
-    Output('tab-content', 'children'),
-    Input('current-tab', 'data'),
-)
-def render_tab(tab):
-    if tab == 'overview':
-        return build_overview_tab()
-    elif tab == 'map':
+
+@functools.lru_cache(maxsize=FIGURE_CACHE_SIZE)
+def build_tab(tab, threshold, version):
+    """Build a tab's content, cached by tab, threshold and bundle version."""
+    if tab == 'map':
         return build_map_tab()
-    elif tab == 'equity':
-        return build_equity_tab()
     elif tab == 'neighbourhoods':
         return build_neighbourhoods_tab()
     elif tab == 'methodology':
         return build_methodology_tab()
-    return build_overview_tab()
+    data = bundle.at_threshold(threshold)
+    if tab == 'equity':
+        return build_equity_tab(data)
+    return build_overview_tab(data)
 
 
-# Map callback
-@callback(
-    Output('main-map', 'figure'),
-    Input('map-metric', 'value'),
-)
-def update_map(metric):
-    """Update the map based on selected metric."""
-    labels = {
-        'accessibility': 'Accessibility Score',
-        'avg_travel_time': 'Avg Travel Time (min)',
-        'low_income_pct': 'Low Income %',
-        'minority_pct': 'Minority %',
-        'senior_pct': 'Senior %',
-        'desert_score': 'Transit Desert Score',
-        'equity_index': 'Equity Index',
-        'total_pop': 'Population',
-    }
-    
+@functools.lru_cache(maxsize=FIGURE_CACHE_SIZE)
+def build_map_figure(metric, threshold, version):
+    """Build the map figure as a plain dict, cached by metric, threshold and bundle version."""
     # Real scatter mapbox with centroid coordinates
-    map_df = df.dropna(subset=['lat', 'lon']).copy()
+    map_df = bundle.at_threshold(threshold).dropna(subset=['lat', 'lon']).copy()
     
     # Clamp size to avoid tiny/huge dots
     map_df['marker_size'] = np.clip(map_df['total_pop'], 50, 2000)
@@ -829,7 +788,7 @@ def update_map(metric):
         height=600,
         margin=dict(l=0, r=0, t=0, b=0),
         coloraxis_colorbar=dict(
-            title=labels.get(metric, metric),
+            title=MAP_LABELS.get(metric, metric),
             thickness=15,
             len=0.6,
         ),
@@ -839,7 +798,100 @@ def update_map(metric):
         ),
     )
     
-    return fig
+    return fig.to_dict()
+
+
+def warm_figure_cache():
+    """Build every tab and map figure at the default threshold ahead of the first request."""
+    for tab in ['overview', 'map', 'equity', 'neighbourhoods', 'methodology']:
+        build_tab(tab, bundle.threshold if tab in THRESHOLD_TABS else None, bundle.version)
+    for metric in MAP_LABELS:
+        build_map_figure(metric, bundle.threshold, bundle.version)
+    print(f"✅ Warmed {len(MAP_LABELS)} map figures and 5 tabs")
+
+
+# Opt in with DASHBOARD_WARMUP=1, e.g. for gunicorn workers
+if os.environ.get('DASHBOARD_WARMUP') == '1':
+    warm_figure_cache()
+
+
+# ============================================================
+# CALLBACKS
+# ============================================================
+
+# Tab navigation
+@callback(
+    Output('current-tab', 'data'),
+    [Input('nav-overview', 'n_clicks'),
+     Input('nav-map', 'n_clicks'),
+     Input('nav-equity', 'n_clicks'),
+     Input('nav-neighbourhoods', 'n_clicks'),
+     Input('nav-methodology', 'n_clicks')],
+    prevent_initial_call=False,
+)
+def switch_tab(c1, c2, c3, c4, c5):
+    ctx = dash.callback_context
+    if not ctx.triggered or ctx.triggered[0]['prop_id'] == '.':
+        return 'overview'
+    
+    trigger = ctx.triggered[0]['prop_id'].split('.')[0]
+    mapping = {
+        'nav-overview': 'overview',
+        'nav-map': 'map',
+        'nav-equity': 'equity',
+        'nav-neighbourhoods': 'neighbourhoods',
+        'nav-methodology': 'methodology',
+    }
+    return mapping.get(trigger, 'overview')
+
+
+# Render tab content
+@callback(
+    Output('tab-content', 'children'),
+    Input('current-tab', 'data'),
+    Input('threshold-slider', 'value'),
+)
+def render_tab(tab, threshold):
+    if tab not in THRESHOLD_TABS | {'map', 'neighbourhoods', 'methodology'}:
+        tab = 'overview'
+    # Tabs that ignore the threshold share one cache entry
+    return build_tab(tab, threshold if tab in THRESHOLD_TABS else None, bundle.version)
+
+
+# Map callback
+@callback(
+    Output('main-map', 'figure'),
+    Input('map-metric', 'value'),
+    Input('threshold-slider', 'value'),
+)
+def update_map(metric, threshold):
+    """Update the map based on selected metric."""
+    return build_map_figure(metric, threshold, bundle.version)
+
+
+# Inputs that send the neighbourhood table back to its first page
+PAGE_RESET_INPUTS = {'neighbourhood-table.sort_by', 'neighbourhood-table.filter_query',
+                     'threshold-slider.value'}
+
+
+# Neighbourhood table page
+@callback(
+    Output('neighbourhood-table', 'data'),
+    Output('neighbourhood-table', 'page_count'),
+    Output('neighbourhood-table', 'page_current'),
+    Input('neighbourhood-table', 'page_current'),
+    Input('neighbourhood-table', 'page_size'),
+    Input('neighbourhood-table', 'sort_by'),
+    Input('neighbourhood-table', 'filter_query'),
+    Input('threshold-slider', 'value'),
+)
+def update_neighbourhood_table(page_current, page_size, sort_by, filter_query, threshold):
+    """Send only the visible page of the neighbourhood table."""
+    table = neighbourhood_table(threshold, bundle.version)
+    # A new sort, filter or threshold starts again from the first page
+    if PAGE_RESET_INPUTS & set(dash.ctx.triggered_prop_ids):
+        page_current = 0
+    return table.page(page_current or 0, page_size, sort_by, filter_query)
 
 
 # ============================================================
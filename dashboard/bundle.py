@@ -0,0 +1,343 @@
+"""
+Dashboard Data Bundle
+Precomputes everything the dashboard shows into one versioned folder
+
+Build:  python bundle.py
+
+The bundle holds the per-DA table as an uncompressed Arrow file and the reach
+counts as a binary array, so the app can memory-map both at startup instead of
+parsing the travel time matrix and the raw inputs.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+
+# ============================================================
+# BUNDLE LAYOUT
+# ============================================================
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'data', 'EDM')
+BUNDLE_DIR = os.path.join(DATA_DIR, 'dashboard')
+
+# Bump when the files or columns of the bundle change
+BUNDLE_FORMAT = 4
+# Points at the folder of the current bundle version
+CURRENT_FILE = 'current.json'
+MANIFEST_FILE = 'manifest.json'
+DAS_FILE = 'das.arrow'
+REACH_FILE = 'reach.npy'
+
+DEFAULT_THRESHOLD = 45
+# The longest travel time threshold the dashboard offers, in minutes
+MAX_MINUTES = 180
+
+INPUTS = {
+    'demographics': os.path.join(DATA_DIR, 'raw', 'demographics.csv'),
+    'travel_times': os.path.join(DATA_DIR, 'processed', 'travel_times.csv'),
+    'centroids': os.path.join(DATA_DIR, 'region', 'centroids.gpkg'),
+    'neighbourhoods': os.path.join(DATA_DIR, 'processed', 'da_neighbourhood_map.csv'),
+}
+
+# ============================================================
+# RAW DATA LOADING
+# ============================================================
+
+def load_demographics():
+    """Load real demographics or generate sample data."""
+    demo_path = INPUTS['demographics']
+    if os.path.exists(demo_path):
+        df = pd.read_csv(demo_path, dtype={'DAUID': str})
+        return df
+    else:
+        # Generate sample for development
+        np.random.seed(42)
+        n = 200
+        return pd.DataFrame({
+            'DAUID': [f'4811{str(i).zfill(4)}' for i in range(n)],
+            'total_pop': np.random.randint(100, 2000, n),
+            'low_income': np.random.randint(10, 500, n),
+            'minority': np.random.randint(20, 600, n),
+            'seniors': np.random.randint(10, 400, n),
+        })
+
+def load_travel_times():
+    """Load travel time matrix or generate sample."""
+    tt_path = INPUTS['travel_times']
+    if os.path.exists(tt_path):
+        return pd.read_csv(tt_path, dtype={'from_id': str, 'to_id': str})
+    return None
+
+def sample_scores(n):
+    """Sample accessibility (%) and average travel times for development."""
+    np.random.seed(42)
+    return np.random.uniform(5, 85, n), np.random.uniform(15, 55, n)
+
+
+def reach_counts(demo_df, tt_df=None):
+    """Count the DAs each DA reaches within every whole minute up to MAX_MINUTES.
+
+    Row i, column t is the number of destinations the i-th DA of demo_df reaches
+    in t minutes or less, so the accessibility at any threshold is one column of
+    this array.
+    """
+    n = len(demo_df)
+    if tt_df is not None and len(tt_df) > 0:
+        origins = pd.Index(demo_df['DAUID']).get_indexer(tt_df['from_id'])
+        # A trip of t minutes is within every whole-minute threshold >= ceil(t)
+        minutes = np.ceil(tt_df['travel_time'].to_numpy(dtype=float))
+        within = (origins >= 0) & (minutes <= MAX_MINUTES)
+        minutes = np.clip(minutes[within], 0, None).astype(np.int64)
+        counts = np.bincount(origins[within] * (MAX_MINUTES + 1) + minutes,
+                             minlength=n * (MAX_MINUTES + 1))
+        return np.cumsum(counts.reshape(n, MAX_MINUTES + 1), axis=1).astype(np.int32)
+    # Sample data for development, reach growing steadily with time. Not rounded
+    # to whole DAs, so the default threshold gives exactly the sampled scores.
+    share = sample_scores(n)[0] / 100 / DEFAULT_THRESHOLD
+    return np.minimum(np.outer(share, np.arange(MAX_MINUTES + 1)), 1) * n
+
+
+def apply_threshold(df, reach, threshold):
+    """Compute the metrics that depend on the travel time threshold.
+
+    Looks up one column of the reach counts, so this is cheap enough to run on
+    every change of the threshold. Rows are matched to the reach counts by their
+    reach_row column, not by position, as merges may have repeated some DAs.
+    """
+    df = df.copy()
+    reachable = reach[df['reach_row'].to_numpy(), int(threshold)]
+    df['accessibility'] = np.clip(reachable / len(reach) * 100, 0, 100).round(1)
+
+    # Transit Desert Score = low access + high vulnerability
+    df['desert_score'] = ((100 - df['accessibility']) * df['vulnerability'] / 100).round(1)
+
+    # Equity Index = access × vulnerability (high = vulnerable BUT well-served)
+    df['equity_index'] = (df['accessibility'] * df['vulnerability'] / 100).round(1)
+
+    # Rank
+    df['access_rank'] = df['accessibility'].rank(ascending=False).astype(int)
+
+    # Rating
+    df['rating'] = np.select(
+        [df['accessibility'] >= 60, df['accessibility'] >= 40, df['accessibility'] >= 20],
+        ['Excellent', 'Good', 'Moderate'],
+        default='Poor',
+    )
+    return df
+
+
+def compute_accessibility(demo_df, reach, tt_df=None, threshold=DEFAULT_THRESHOLD):
+    """Compute accessibility scores for each DA."""
+    n = len(demo_df)
+    demo_df = demo_df.copy()
+    # The row of each DA in the reach counts, kept through later merges
+    demo_df['reach_row'] = np.arange(n)
+
+    if tt_df is not None and len(tt_df) > 0:
+        avg_times = tt_df.groupby('from_id')['travel_time'].mean()
+        demo_df['avg_travel_time'] = demo_df['DAUID'].map(avg_times).fillna(60).round(1)
+    else:
+        # Sample data for development
+        demo_df['avg_travel_time'] = sample_scores(n)[1].round(1)
+
+    # Derived metrics
+    demo_df['low_income_pct'] = (demo_df['low_income'] / demo_df['total_pop'].replace(0, 1) * 100).round(1)
+    demo_df['minority_pct'] = (demo_df['minority'] / demo_df['total_pop'].replace(0, 1) * 100).round(1)
+    demo_df['senior_pct'] = (demo_df['seniors'] / demo_df['total_pop'].replace(0, 1) * 100).round(1)
+
+    # Vulnerability weight (normalized)
+    vuln = demo_df[['low_income_pct', 'minority_pct', 'senior_pct']].mean(axis=1)
+    demo_df['vulnerability'] = (vuln / vuln.max() * 100).round(1) if vuln.max() > 0 else 0
+
+    return apply_threshold(demo_df, reach, threshold)
+
+
+def add_coordinates(df):
+    """Add centroid lat/lon for the map, or sample coordinates."""
+    centroids_path = INPUTS['centroids']
+    try:
+        if os.path.exists(centroids_path):
+            centroids_gdf = gpd.read_file(centroids_path)
+            centroids_gdf = centroids_gdf.copy()
+            centroids_gdf['DAUID'] = centroids_gdf['DAUID'].astype(str)
+            centroids_gdf['lat'] = centroids_gdf.geometry.y
+            centroids_gdf['lon'] = centroids_gdf.geometry.x
+            coords = centroids_gdf[['DAUID', 'lat', 'lon']].copy()
+
+            # Ensure DAUID is string in df as well
+            df['DAUID'] = df['DAUID'].astype(str)
+
+            # Merge
+            df = df.merge(coords, on='DAUID', how='left')
+
+            # Check if merge worked
+            if 'lat' in df.columns and df['lat'].notna().sum() > 0:
+                print(f"✅ Loaded {df['lat'].notna().sum()} centroid coordinates for map")
+            else:
+                raise ValueError("Centroid merge failed - no valid coordinates")
+        else:
+            raise FileNotFoundError(f"Centroids file not found: {centroids_path}")
+    except Exception as e:
+        print(f"⚠️  Centroid loading failed: {e}")
+        print("   Using sample coordinates instead")
+        df['lat'] = np.random.uniform(53.4, 53.7, len(df))
+        df['lon'] = np.random.uniform(-113.7, -113.3, len(df))
+    return df
+
+
+def add_neighbourhoods(df):
+    """Add neighbourhood names."""
+    neighbourhood_path = INPUTS['neighbourhoods']
+    try:
+        if os.path.exists(neighbourhood_path):
+            hoods = pd.read_csv(neighbourhood_path, dtype={'DAUID': str})
+            df = df.merge(hoods, on='DAUID', how='left')
+            print(f"✅ Loaded neighbourhood names for {df['neighbourhood'].notna().sum()} DAs")
+        else:
+            df['neighbourhood'] = 'Unknown'
+    except Exception as e:
+        print(f"⚠️  Neighbourhood loading failed: {e}")
+        df['neighbourhood'] = df['DAUID']
+    return df
+
+
+# ============================================================
+# BUILD
+# ============================================================
+
+def input_version():
+    """Hash the inputs (path, size, modification time) and bundle format."""
+    sha = hashlib.sha1(str(BUNDLE_FORMAT).encode())
+    for name, path in sorted(INPUTS.items()):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            sha.update(f'{name}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+        else:
+            sha.update(f'{name}:missing'.encode())
+    return sha.hexdigest()[:16]
+
+
+def build_bundle(bundle_dir=BUNDLE_DIR, threshold=DEFAULT_THRESHOLD):
+    """Compute every dashboard table and write them as a new bundle version."""
+    version = input_version()
+    print(f"📦 Building dashboard bundle {version}")
+
+    demo = load_demographics()
+    tt = load_travel_times()
+    reach = reach_counts(demo, tt)
+    df = compute_accessibility(demo, reach, tt, threshold=threshold)
+    df = add_coordinates(df)
+    df = add_neighbourhoods(df)
+
+    # Written to a temporary folder, then made current in one step
+    version_dir = os.path.join(bundle_dir, version)
+    partial_dir = f'{version_dir}.{os.getpid()}.partial'
+    shutil.rmtree(partial_dir, ignore_errors=True)
+    os.makedirs(partial_dir)
+    feather.write_feather(df, os.path.join(partial_dir, DAS_FILE), compression='uncompressed')
+    np.save(os.path.join(partial_dir, REACH_FILE), reach)
+    manifest = {
+        'version': version,
+        'format': BUNDLE_FORMAT,
+        'threshold': threshold,
+        'max_minutes': MAX_MINUTES,
+        'das': len(df),
+    }
+    with open(os.path.join(partial_dir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    shutil.rmtree(version_dir, ignore_errors=True)
+    os.replace(partial_dir, version_dir)
+
+    current_path = os.path.join(bundle_dir, CURRENT_FILE)
+    with open(current_path + '.partial', 'w') as f:
+        json.dump({'version': version}, f)
+    os.replace(current_path + '.partial', current_path)
+
+    remove_older_versions(bundle_dir, version_dir)
+
+    print(f"✅ Wrote {len(df):,} DAs to {version_dir}")
+    return version_dir
+
+
+def remove_older_versions(bundle_dir, version_dir):
+    """Delete the finished bundle versions built before the one in version_dir.
+
+    Folders still being written by another build (.partial) and versions
+    finished after this one are left alone.
+    """
+    built = os.path.getmtime(os.path.join(version_dir, MANIFEST_FILE))
+    for entry in os.listdir(bundle_dir):
+        entry_path = os.path.join(bundle_dir, entry)
+        manifest_path = os.path.join(entry_path, MANIFEST_FILE)
+        if (entry_path == version_dir or entry.endswith('.partial')
+                or not os.path.exists(manifest_path)):
+            continue
+        if os.path.getmtime(manifest_path) < built:
+            shutil.rmtree(entry_path, ignore_errors=True)
+
+# ============================================================
+# LOAD
+# ============================================================
+
+def read_mapped_table(path):
+    """Read an Arrow file as a DataFrame backed by the memory map where possible.
+
+    With one block per column, numeric columns without nulls point straight
+    into the mapped file instead of being copied into consolidated blocks.
+    """
+    table = feather.read_table(path, memory_map=True)
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+class Bundle:
+    """A built bundle, memory-mapped from disk."""
+
+    def __init__(self, version_dir):
+        with open(os.path.join(version_dir, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        self.version = self.manifest['version']
+        self.das = read_mapped_table(os.path.join(version_dir, DAS_FILE))
+        self.reach = np.load(os.path.join(version_dir, REACH_FILE), mmap_mode='r')
+        self.threshold = self.manifest['threshold']
+        self.max_minutes = self.manifest['max_minutes']
+
+    def at_threshold(self, threshold):
+        """The per-DA table with the metrics of another travel time threshold."""
+        if threshold == self.threshold:
+            return self.das
+        return apply_threshold(self.das, self.reach, threshold)
+
+
+def current_bundle_dir(bundle_dir=BUNDLE_DIR):
+    """The folder of the current bundle version, or None if none was built."""
+    current_path = os.path.join(bundle_dir, CURRENT_FILE)
+    if not os.path.exists(current_path):
+        return None
+    with open(current_path) as f:
+        version = json.load(f)['version']
+    version_dir = os.path.join(bundle_dir, version)
+    return version_dir if os.path.exists(version_dir) else None
+
+
+def load_bundle(bundle_dir=BUNDLE_DIR):
+    """Open the current bundle.
+
+    The app never builds the bundle itself, since every server worker would
+    build it at once.
+    """
+    version_dir = current_bundle_dir(bundle_dir)
+    if version_dir is None:
+        raise FileNotFoundError(
+            f"No dashboard bundle found in {bundle_dir}, build one with `python bundle.py`"
+        )
+    return Bundle(version_dir)
+
+
+if __name__ == '__main__':
+    build_bundle()
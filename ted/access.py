@@ -0,0 +1,236 @@
+"""Fast access to opportunity kernels
+
+These compute the same measures as ``traccess.AccessComputer`` but are built for
+computing many of them over the same (large) cost matrix. Instead of scanning
+the whole matrix once per cutoff, each origin's costs are sorted once and every
+cutoff is read off a single cumulative sum of the opportunities.
+
+Cost matrices can be given either as long frames or as a dense
+:class:`~ted.matrix.CostMatrix`. With the latter, supply is aligned to the
+matrix positions once rather than looked up by id for every pair."""
+
+import numpy
+import pandas
+
+from .matrix import CostMatrix
+
+
+def cumulative_cutoffs(
+    cost: pandas.DataFrame | CostMatrix,
+    supply: pandas.DataFrame,
+    cutoffs: dict,
+    cost_column: str = "travel_time",
+    from_id: str = "from_id",
+    to_id: str = "to_id",
+    suffix: str = "",
+) -> pandas.DataFrame:
+    """Compute cumulative opportunity measures for several cutoffs in one pass
+
+    Gives the same values as ``traccess.AccessComputer.cumulative_cutoff`` run
+    once per cutoff: every origin in the cost matrix is kept, and missing costs
+    or missing supply count as unreachable.
+
+    Parameters
+    ----------
+    cost : pandas.DataFrame | CostMatrix
+        A long-format cost matrix with origin, destination, and cost columns,
+        or a dense matrix
+    supply : pandas.DataFrame
+        The opportunities, indexed by destination id
+    cutoffs : dict
+        The supply columns to measure for each cutoff, e.g.
+        ``{15: ["acres"], 30: ["C000", "acres"]}``
+    cost_column : str, optional
+        The cost column to apply the cutoffs to, by default "travel_time"
+        (long format only)
+    from_id : str, optional
+        The origin column, by default "from_id", also the output index name
+    to_id : str, optional
+        The destination column, by default "to_id" (long format only)
+    suffix : str, optional
+        A suffix added to every output column, by default ""
+
+    Returns
+    -------
+    pandas.DataFrame
+        The measures indexed by origin, with columns named
+        ``{supply_column}_c{cutoff}{suffix}`` in the order they were given
+    """
+    supply_columns = []
+    for columns in cutoffs.values():
+        supply_columns.extend(c for c in columns if c not in supply_columns)
+
+    if isinstance(cost, CostMatrix):
+        origins = cost.ids
+        positions = numpy.arange(len(cost))
+        codes = numpy.repeat(positions, len(cost))
+        costs = cost.as_float().ravel().astype(float)
+        opportunities = _aligned_supply(cost, supply, supply_columns)[
+            numpy.tile(positions, len(cost))
+        ]
+    else:
+        codes, origins = pandas.factorize(cost[from_id], sort=True)
+        costs = cost[cost_column].to_numpy(dtype=float)
+        opportunities = (
+            supply[supply_columns].reindex(cost[to_id]).fillna(0).to_numpy(dtype=float)
+        )
+
+    # Sort reachable pairs by origin, then by cost
+    reachable = ~numpy.isnan(costs)
+    codes = codes[reachable]
+    costs = costs[reachable]
+    order = numpy.lexsort((costs, codes))
+    codes = codes[order]
+    costs = costs[order]
+    totals = numpy.zeros((order.shape[0] + 1, len(supply_columns)))
+    numpy.cumsum(opportunities[reachable][order], axis=0, out=totals[1:])
+
+    # Find where each origin starts and, for each cutoff, where it stops
+    origin_codes = numpy.arange(origins.shape[0])
+    starts = numpy.searchsorted(codes, origin_codes, side="left")
+    ends = numpy.searchsorted(codes, origin_codes, side="right")
+    if costs.shape[0] > 0:
+        low, high = costs.min(), costs.max()
+    else:
+        low, high = 0.0, 0.0
+    # Search a combined (origin, cost) key so every origin is found at once
+    span = high - low + 1.0
+    keys = codes * span + (costs - low)
+
+    result = {}
+    for cutoff, columns in cutoffs.items():
+        if cutoff >= high:
+            stops = ends
+        elif cutoff < low:
+            stops = starts
+        else:
+            stops = numpy.searchsorted(
+                keys, origin_codes * span + (cutoff - low), side="right"
+            )
+        within = totals[stops] - totals[starts]
+        for column in columns:
+            index = supply_columns.index(column)
+            result[f"{column}_c{cutoff}{suffix}"] = within[:, index]
+
+    return pandas.DataFrame(result, index=pandas.Index(origins, name=from_id))
+
+
+def cost_to_closest(
+    cost: CostMatrix,
+    supply: pandas.DataFrame,
+    supply_columns: list,
+    n: int = 1,
+    from_id: str = "from_id",
+) -> pandas.DataFrame:
+    """Compute the cost to reach the n closest opportunities from each origin
+
+    Gives the same values as ``traccess.AccessComputer.cost_to_closest``: the
+    lowest cost at which the opportunities reached add up to at least ``n``,
+    or NaN where they never do.
+
+    Parameters
+    ----------
+    cost : CostMatrix
+        The dense cost matrix
+    supply : pandas.DataFrame
+        The opportunities, indexed by destination id
+    supply_columns : list
+        The supply columns to measure
+    n : int, optional
+        The number of opportunities to reach, by default 1
+    from_id : str, optional
+        The name of the output index, by default "from_id"
+
+    Returns
+    -------
+    pandas.DataFrame
+        The costs indexed by origin, with one column per supply column
+    """
+    costs = cost.as_float()
+    opportunities = _aligned_supply(cost, supply, supply_columns)
+    result = {}
+    for index, column in enumerate(supply_columns):
+        # Only destinations with some supply can be among the closest
+        destinations = opportunities[:, index] > 0
+        if not destinations.any():
+            result[column] = numpy.full(len(cost), numpy.nan)
+            continue
+        sub_costs = costs[:, destinations]
+        # Missing costs sort last, so they are never reached before a real one
+        order = numpy.argsort(sub_costs, axis=1, kind="stable")
+        sorted_costs = numpy.take_along_axis(sub_costs, order, axis=1)
+        reached = numpy.cumsum(opportunities[destinations, index][order], axis=1)
+        enough = reached >= n
+        first = enough.argmax(axis=1)
+        closest = sorted_costs[numpy.arange(len(cost)), first].astype(float)
+        closest[~enough.any(axis=1)] = numpy.nan
+        result[column] = closest
+    return pandas.DataFrame(result, index=pandas.Index(cost.ids, name=from_id))
+
+
+def _aligned_supply(
+    cost: CostMatrix, supply: pandas.DataFrame, supply_columns: list
+) -> numpy.ndarray:
+    # One row of opportunities per matrix position, zero for ids without supply
+    return supply[supply_columns].reindex(cost.ids).fillna(0).to_numpy(dtype=float)
+
+
+def fare_constrained_cutoffs(
+    networks: list,
+    supply: pandas.DataFrame,
+    cutoffs: dict,
+    fare_threshold: float,
+    from_id: str = "from_id",
+    suffix: str = "",
+) -> pandas.DataFrame:
+    """Compute cumulative measures within a fare, taking the best of several networks
+
+    For each network a pair only counts if its travel time is within the cutoff
+    and its fare is at most ``fare_threshold``. The result for an origin is the
+    highest of the networks' measures, like joining ``traccess`` results for
+    each network and taking the row-wise maximum.
+
+    Parameters
+    ----------
+    networks : list
+        ``(travel_time, fare)`` pairs of :class:`~ted.matrix.CostMatrix`, one
+        per network. Fares are aligned to the travel times by zone id, and
+        origins without any fares in a network are left out of it.
+    supply : pandas.DataFrame
+        The opportunities, indexed by destination id
+    cutoffs : dict
+        The supply columns to measure for each travel time cutoff, as for
+        :func:`cumulative_cutoffs`
+    fare_threshold : float
+        The highest fare that can be paid
+    from_id : str, optional
+        The name of the output index, by default "from_id"
+    suffix : str, optional
+        A suffix added to every output column, by default ""
+
+    Returns
+    -------
+    pandas.DataFrame
+        The measures indexed by the origins of the first network, with columns
+        named ``{supply_column}_c{cutoff}{suffix}``
+    """
+    best = None
+    for travel_time, fare in networks:
+        fares = fare.reindex(travel_time.ids).as_float()
+        # Unaffordable pairs are made unreachable
+        costs = numpy.where(fares <= fare_threshold, travel_time.as_float(), numpy.nan)
+        measures = cumulative_cutoffs(
+            CostMatrix(travel_time.ids, costs, name=travel_time.name),
+            supply,
+            cutoffs,
+            from_id=from_id,
+            suffix=suffix,
+        )
+        measures[numpy.isnan(fares).all(axis=1)] = numpy.nan
+        if best is None:
+            best = measures
+        else:
+            best[:] = numpy.fmax(
+                best.to_numpy(), measures.reindex(best.index).to_numpy()
+            )
+    return best
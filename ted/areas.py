@@ -0,0 +1,175 @@
+"""Assignment of transit stops to nearby areas
+
+A stop serves every area whose polygon, buffered by a walking distance,
+contains it. Rather than buffering and spatially joining the areas again for
+every feed and every measure, the assignment is built once with an STRtree and
+held as a sparse stop by area incidence matrix. Aggregating stop data by area
+is then a sparse matrix product instead of a loop over areas."""
+
+import os
+import shutil
+
+import geopandas
+import numpy
+import pandas
+import scipy.sparse
+import shapely
+
+#: The file names of a saved index
+STOPS_FILENAME = "stops.parquet"
+AREAS_FILENAME = "areas.parquet"
+INCIDENCE_FILENAME = "incidence.npz"
+
+
+class StopAreaIndex:
+    """Which stops are near which areas
+
+    Parameters
+    ----------
+    stops : geopandas.GeoDataFrame
+        The stops, one row per row of the incidence matrix, with ``agency`` and
+        ``stop_id`` columns
+    area_ids : pandas.Index
+        The area ids, one per column of the incidence matrix
+    incidence : scipy.sparse.csr_array
+        The stop by area matrix, 1 where a stop is near an area
+    """
+
+    def __init__(
+        self,
+        stops: geopandas.GeoDataFrame,
+        area_ids: pandas.Index,
+        incidence: scipy.sparse.csr_array,
+    ):
+        self.stops = stops.reset_index(drop=True)
+        self.area_ids = area_ids
+        self.incidence = incidence
+
+    @classmethod
+    def build(
+        cls,
+        areas: geopandas.GeoDataFrame,
+        area_column: str,
+        stops: geopandas.GeoDataFrame,
+        buffer: float,
+    ) -> "StopAreaIndex":
+        """Build the index by querying the buffered areas with every stop
+
+        Stops count as near an area if they intersect its buffered polygon,
+        like a ``geopandas.sjoin`` of the stops and the buffered areas.
+
+        Parameters
+        ----------
+        areas : geopandas.GeoDataFrame
+            The areas, in a projected CRS (the buffer is in its units). The
+            frame isn't modified.
+        area_column : str
+            The area id column
+        stops : geopandas.GeoDataFrame
+            The stops with ``agency`` and ``stop_id`` columns, as given by
+            :func:`~ted.gtfs.get_all_stops`
+        buffer : float
+            The distance around each area to include stops from
+
+        Returns
+        -------
+        StopAreaIndex
+            The index, with the stops in the CRS of the areas
+        """
+        polygons = numpy.asarray(areas.geometry.buffer(buffer).values)
+        tree = shapely.STRtree(polygons)
+        stops = stops.to_crs(areas.crs)
+        stop_positions, area_positions = tree.query(
+            numpy.asarray(stops.geometry.values), predicate="intersects"
+        )
+        incidence = scipy.sparse.csr_array(
+            (
+                numpy.ones(stop_positions.shape[0], dtype=numpy.int32),
+                (stop_positions, area_positions),
+            ),
+            shape=(stops.shape[0], areas.shape[0]),
+        )
+        return cls(stops, pandas.Index(areas[area_column], name=area_column), incidence)
+
+    @classmethod
+    def load(cls, folder: str) -> "StopAreaIndex":
+        """Load an index saved with :meth:`save`"""
+        stops = geopandas.read_parquet(os.path.join(folder, STOPS_FILENAME))
+        areas = pandas.read_parquet(os.path.join(folder, AREAS_FILENAME))
+        incidence = scipy.sparse.load_npz(os.path.join(folder, INCIDENCE_FILENAME))
+        return cls(
+            stops, pandas.Index(areas.iloc[:, 0]), scipy.sparse.csr_array(incidence)
+        )
+
+    def save(self, folder: str):
+        """Save the index into a folder"""
+        # Written next to the final folder and moved in place once complete, under
+        # a name of this process's own in case another saves the same index
+        partial_folder = f"{folder}.{os.getpid()}.partial"
+        shutil.rmtree(partial_folder, ignore_errors=True)
+        os.makedirs(partial_folder)
+        self.stops.to_parquet(os.path.join(partial_folder, STOPS_FILENAME))
+        self.area_ids.to_frame(index=False).to_parquet(
+            os.path.join(partial_folder, AREAS_FILENAME)
+        )
+        scipy.sparse.save_npz(
+            os.path.join(partial_folder, INCIDENCE_FILENAME), self.incidence
+        )
+        try:
+            os.replace(partial_folder, folder)
+        except OSError:
+            # Another process saved the same index first
+            shutil.rmtree(partial_folder, ignore_errors=True)
+
+    def agency(self, agency: str) -> "StopAreaIndex":
+        """Get the index of only the stops of one agency (feed)"""
+        rows = numpy.flatnonzero(self.stops.agency.to_numpy() == agency)
+        return StopAreaIndex(self.stops.iloc[rows], self.area_ids, self.incidence[rows])
+
+    def pairs(self) -> pandas.DataFrame:
+        """Get the stop and area of every stop near an area, like a spatial join"""
+        coo = self.incidence.tocoo()
+        return pandas.DataFrame(
+            {
+                "agency": self.stops.agency.to_numpy()[coo.row],
+                "stop_id": self.stops.stop_id.to_numpy()[coo.row],
+                self.area_ids.name: self.area_ids.to_numpy()[coo.col],
+            }
+        )
+
+    def stop_counts(self) -> pandas.Series:
+        """Count the stops near each area"""
+        return pandas.Series(
+            self.incidence.sum(axis=0), index=self.area_ids, name="stops"
+        )
+
+    def count_unique(self, stop_ids, groups) -> pandas.Series:
+        """Count the distinct groups (e.g. trips) seen at the stops near each area
+
+        Parameters
+        ----------
+        stop_ids : array-like
+            The stop of each observation. Stop ids are looked up in this index,
+            so it should hold a single agency.
+        groups : array-like
+            The group (e.g. trip id) of each observation
+
+        Returns
+        -------
+        pandas.Series
+            The number of distinct groups, indexed by area
+        """
+        positions = pandas.Index(self.stops.stop_id).get_indexer(stop_ids)
+        known = positions >= 0
+        codes, uniques = pandas.factorize(numpy.asarray(groups)[known])
+        visits = scipy.sparse.csr_array(
+            (
+                numpy.ones(codes.shape[0], dtype=numpy.int32),
+                (codes, positions[known]),
+            ),
+            shape=(uniques.shape[0], self.stops.shape[0]),
+        )
+        # Group by area visit counts, an area counts a group if any are non-zero
+        served = visits @ self.incidence
+        counts = numpy.diff(served.tocsc().indptr)
+        return pandas.Series(counts, index=self.area_ids)
@@ -0,0 +1,38 @@
+"""Content hashes for cache keys
+
+Cached networks, feed tables, and stop area indexes are keyed by the contents
+of their input files. This module only depends on the standard library, so any
+module can hash its inputs without importing R5 or the JVM."""
+
+import hashlib
+import os
+
+#: The size of the blocks read when hashing input files (bytes)
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Hashes keyed by (path, mtime, size) so unchanged files are only read once
+_file_hashes = {}
+
+
+def file_hash(path: str) -> str:
+    """Get the SHA-1 hash of a file, reusing it while the file is unchanged
+
+    Parameters
+    ----------
+    path : str
+        The path of the file to hash
+
+    Returns
+    -------
+    str
+        The hex digest of the file contents
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if key not in _file_hashes:
+        sha = hashlib.sha1()
+        with open(path, "rb") as infile:
+            for block in iter(lambda: infile.read(HASH_BLOCK_SIZE), b""):
+                sha.update(block)
+        _file_hashes[key] = sha.hexdigest()
+    return _file_hashes[key]
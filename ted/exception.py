@@ -12,3 +12,7 @@ class FareNotFoundError(ValueError, TEDError):
 
 class NoExistingFareError(ValueError, TEDError):
     """An existing fare was not found"""
+
+
+class FeedError(TEDError):
+    """One or more GTFS feeds could not be processed"""
@@ -1,16 +1,23 @@
+import asyncio
+import collections
 import datetime
+import gc
 import itertools
 import json
 import logging
 import multiprocessing
 import os
 import requests
+import shutil
 from pytz import timezone
 import time
 
+import aiohttp
 import geopandas
 import numpy
 import pandas
+import pyarrow
+import pyarrow.parquet
 from tqdm import tqdm
 import sqlite3
 import yaml
@@ -27,6 +34,32 @@ MAX_FARE_TRAVEL_TIME = 180
 WALK_MODE = "WALK"
 
 TRANSFER_DISCOUNT = "transfer-discount"
+#: The time zone OTP departure times are reported in
+OTP_TIMEZONE = "America/New_York"
+#: The columns of itinerary legs, as written to Parquet
+ITINERARY_COLUMNS = [
+    "from_id",
+    "to_id",
+    "segment",
+    "mode",
+    "departure_time",
+    "feed",
+    "agency_id",
+    "route_id",
+    "start_stop_id",
+    "end_stop_id",
+]
+#: The name of the completed-pairs ledger inside an itinerary dataset
+ITINERARY_LEDGER_FILENAME = "_completed.jsonl"
+#: The file name template for the part files of an itinerary dataset
+ITINERARY_PART_TEMPLATE = "part-{:05d}.parquet"
+#: The tables of a fares database that are read into FareRules
+FARE_TABLES = ["fare_type", "flat_fare", "route_fare", "zone", "zone_fare"]
+
+# Fare rules keyed by (path, mtime, size) so each database is only read once
+_fare_rules = {}
+# Data handed to forked fare workers, which share it copy-on-write
+_fare_worker_data = {}
 
 
 def compute_wmata_2020_fare(miles):
@@ -150,8 +183,26 @@ class ItinerariesGenerator:
 
 
 class ItineraryCollection:
-    def __init__(self, itineraries_df: pandas.DataFrame, region: str):
+    """The fastest itinerary of each origin-destination pair
+
+    The transit legs of all itineraries are kept in one :class:`LegTable`,
+    built from the itineraries in a single sorted pass, rather than in
+    per-itinerary frames.
+
+    Parameters
+    ----------
+    itineraries_df : pandas.DataFrame
+        The legs of every itinerary option, with ``option``, ``segment``,
+        ``transport_mode``, ``wait_time`` and ``travel_time`` columns
+    region : str
+        The region the itineraries are in
+    rules : FareRules | str, optional
+        The fare rules, or the path to a fares database, needed to compute fares
+    """
+
+    def __init__(self, itineraries_df: pandas.DataFrame, region: str, rules=None):
         self.region = region
+        self.rules = None if rules is None else FareRules.load(rules)
         print("Loaded itineraries, getting fastest options")
         itineraries_df = itineraries_df[itineraries_df.from_id != itineraries_df.to_id]
         fastest = itineraries_df[
@@ -169,20 +220,141 @@ class ItineraryCollection:
         fastest_only = pandas.merge(
             itineraries_df, fastest, on=["from_id", "to_id", "option"]
         )
-        fastest_only.sort_values(["from_id", "to_id", "segment"])
-        fastest_only["pair"] = fastest_only["from_id"] + "-" + fastest_only["to_id"]
-        self._df = fastest_only
-        self._itineraries = []
-        for pair in fastest_only["pair"].unique():
-            idf = self._df[self._df["pair"] == pair]
-            it = Itinerary(idf, region)
-            it.clean()
-            it.make_legs()
-            self._itineraries.append(it)
+        fastest_only = fastest_only.sort_values(
+            ["from_id", "to_id", "segment"], kind="stable"
+        )
+        codes = (
+            fastest_only.groupby(["from_id", "to_id"], sort=False).ngroup().to_numpy()
+        )
+        self.pairs = (
+            fastest_only[["from_id", "to_id"]].drop_duplicates().reset_index(drop=True)
+        )
+        self._legs = LegTable.from_frame(fastest_only, codes, len(self.pairs))
 
     @property
     def size(self) -> int:
-        return len(self._itineraries)
+        return len(self.pairs)
+
+    def itinerary(self, i: int) -> "Itinerary":
+        """Get the ``i``-th itinerary, in the order of :attr:`pairs`"""
+        return Itinerary.from_legs(self._legs.legs(i), self.region, self.rules)
+
+    def compute_fares(self) -> pandas.DataFrame:
+        """Compute the fare of every itinerary that uses transit
+
+        Returns
+        -------
+        pandas.DataFrame
+            The ``from_id``, ``to_id`` and ``fare_cost`` of each itinerary
+        """
+        if self.rules is None:
+            raise ValueError("Fare rules are needed to compute fares")
+        has_legs = self._legs.leg_counts() > 0
+        fares = [self.itinerary(i).compute_fare() for i in numpy.flatnonzero(has_legs)]
+        fare_df = self.pairs[has_legs].reset_index(drop=True)
+        fare_df["fare_cost"] = fares
+        return fare_df
+
+
+class LegTable:
+    """The transit legs of many itineraries, stored column-wise
+
+    The legs of itinerary ``i`` are rows ``offsets[i]`` up to ``offsets[i + 1]``
+    in travel order. Walking legs are left out, as they never affect fares.
+    Ids are interned: each id column is stored as integer codes into an array
+    of its distinct values, so a feed or route id is held once however many
+    legs use it. Departure times are stored as a datetime array.
+
+    Parameters
+    ----------
+    codes : dict
+        The integer codes of each of ``LegTable.ID_COLUMNS``
+    values : dict
+        The distinct values of each of ``LegTable.ID_COLUMNS``
+    departure_times : pandas.DatetimeIndex
+        The departure time of each leg
+    offsets : numpy.ndarray
+        The first row of each itinerary, followed by the total number of rows
+    """
+
+    ID_COLUMNS = [
+        "transport_mode",
+        "feed",
+        "agency_id",
+        "route_id",
+        "start_stop_id",
+        "end_stop_id",
+    ]
+
+    def __init__(
+        self,
+        codes: dict,
+        values: dict,
+        departure_times: pandas.DatetimeIndex,
+        offsets: numpy.ndarray,
+    ):
+        self.codes = codes
+        self.values = values
+        self.departure_times = departure_times
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    @classmethod
+    def from_frame(
+        cls, df: pandas.DataFrame, codes: numpy.ndarray, num_itineraries: int
+    ) -> "LegTable":
+        """Build a table from itinerary legs sorted by itinerary, then segment
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+            The legs, including walking legs
+        codes : numpy.ndarray
+            The (non-decreasing) number of the itinerary of each row
+        num_itineraries : int
+            The number of itineraries
+
+        Returns
+        -------
+        LegTable
+            The transit legs
+        """
+        transit = df["transport_mode"].to_numpy() != WALK_MODE
+        df = df[transit]
+        id_codes = {}
+        id_values = {}
+        for column in cls.ID_COLUMNS:
+            column_codes, values = pandas.factorize(df[column], use_na_sentinel=False)
+            id_codes[column] = column_codes.astype(numpy.int32)
+            id_values[column] = numpy.asarray(values, dtype=object)
+        departure_times = pandas.DatetimeIndex(pandas.to_datetime(df["departure_time"]))
+        offsets = numpy.searchsorted(codes[transit], numpy.arange(num_itineraries + 1))
+        return cls(id_codes, id_values, departure_times, offsets)
+
+    def leg_counts(self) -> numpy.ndarray:
+        """Get the number of transit legs of each itinerary"""
+        return numpy.diff(self.offsets)
+
+    def legs(self, i: int) -> list:
+        """Get the transit legs of the ``i``-th itinerary"""
+        rows = slice(self.offsets[i], self.offsets[i + 1])
+        columns = [self.values[c][self.codes[c][rows]] for c in self.ID_COLUMNS]
+        mode, feed, agency_id, route_id, start_stop_id, end_stop_id = columns
+        times = self.departure_times[rows].to_pydatetime()
+        return [
+            TransitLeg(
+                mode[j],
+                times[j],
+                feed[j],
+                agency_id[j],
+                route_id[j],
+                start_stop_id[j],
+                end_stop_id[j],
+            )
+            for j in range(len(times))
+        ]
 
 
 def add_gtfs_tag_to_zipfiles(folder):
@@ -238,7 +410,11 @@ def run_r5_on_clusters(
 
 class Itinerary:
     def __init__(
-        self, itinerary_df: pandas.DataFrame, region: str, db, verbose: bool = False
+        self,
+        itinerary_df: pandas.DataFrame,
+        region: str,
+        rules,
+        verbose: bool = False,
     ):
         self._df = itinerary_df.sort_values("segment")
         self.region = region
@@ -246,7 +422,39 @@ class Itinerary:
         self._legs = []
         self._fares = []
         self.verbose = verbose
-        self.db = db
+        # Either loaded FareRules or the path to a fares database
+        self.rules = FareRules.load(rules)
+
+    @classmethod
+    def from_legs(
+        cls, legs: list, region: str, rules, verbose: bool = False
+    ) -> "Itinerary":
+        """Make an itinerary from its transit legs, already cleaned and in order
+
+        Parameters
+        ----------
+        legs : list
+            The transit legs
+        region : str
+            The region the itinerary is in
+        rules : FareRules | str
+            The fare rules, or the path to a fares database
+        verbose : bool, optional
+            Whether to report fares running out, by default False
+
+        Returns
+        -------
+        Itinerary
+            The itinerary, ready for ``compute_fare``
+        """
+        it = cls.__new__(cls)
+        it._df = None
+        it.region = region
+        it._legs = list(legs)
+        it._fares = []
+        it.verbose = verbose
+        it.rules = FareRules.load(rules)
+        return it
 
     def clean(self):
         # Check that the first row is "walking"
@@ -256,22 +464,12 @@ class Itinerary:
             self._df = self._df.head(-1)
 
     def make_legs(self):
-        prev_leg = None
         for idx, row in self._df.iterrows():
             if row["transport_mode"] != WALK_MODE:
-                this_leg = TransitLeg.from_row(row, prev_leg, self.db)
-                self._legs.append(this_leg)
-                prev_leg = this_leg
+                self._legs.append(TransitLeg.from_row(row))
 
     def print_legs(self, with_feeds=False):
-        leg = self._legs[0]
-        if with_feeds:
-            print(leg.feed, leg)
-        else:
-            print(leg)
-        while leg.next_leg is not None:
-            # Update the leg and print it
-            leg = leg.next_leg
+        for leg in self._legs:
             if with_feeds:
                 print(leg.feed, leg)
             else:
@@ -291,41 +489,20 @@ class Itinerary:
         # We know there's no fare existing for the first one
         fare = self.get_new_fare(leg)
         self._fares.append(fare)
-        while leg.next_leg is not None:
+        for from_leg, to_leg in zip(self._legs, self._legs[1:]):
             # We have ourselves a transfer
-            from_leg = leg
-            to_leg = leg.next_leg
             current_time = to_leg.departure_time
 
             # Let's go ahead and update all fare clocks
             self.update_fare_times(current_time)
 
             # Let's find out if the next leg is already covered by the existing fares
-            df = from_leg.transfers[from_leg.transfers.to_mdb_slug == to_leg.feed]
-
-            # Now we need to filter out rules specifically
-            # First we check for an __ANY__ condition as that covers all routes
-            from_df = df[df.from_route_id == "__ANY__"]
-            if from_df.shape[0] == 0:
-                # Next, we check for a specific route ID
-                from_df = df[df.from_route_id == from_leg.route_id]
-
-                if from_df.shape[0] == 0:
-                    # Finally, we check for an __ELSE__ key
-                    from_df = df[df.from_route_id == "__ELSE__"]
-
-            # Now we check for the route we are transferring to
-            to_df = from_df[from_df.to_route_id == "__ANY__"]
-            if to_df.shape[0] == 0:
-                # Next, we check for a specific route ID
-                to_df = from_df[from_df.from_route_id == from_leg.route_id]
-                if to_df.shape[0] == 0:
-                    # Finally, we check for an __ELSE__ key
-                    to_df = from_df[from_df.from_route_id == "__ELSE__"]
-
-            if to_df.shape[0] > 0:
-                # We have some kind of rule, let's apply the first one we find (should just be one)
-                tfr = to_df.iloc[0]
+            # Find the transfer rule that applies, if any
+            tfr = self.rules.transfer_rule(
+                from_leg.feed, to_leg.feed, from_leg.route_id
+            )
+
+            if tfr is not None:
                 # For a transfer discount, we want to apply it
                 if tfr.transfer_type == "transfer-discount":
                     # Let's apply a discount to the next route's fare
@@ -365,7 +542,6 @@ class Itinerary:
                 if from_leg.feed != to_leg.feed:
                     fare = self.get_new_fare(to_leg)
                     self._fares.append(fare)
-            leg = to_leg
 
         total_fare = 0
         # Now we need to "close" off the fares
@@ -397,15 +573,10 @@ class Itinerary:
 
     def get_new_fare(self, leg):
         # Let's start by retrieving the fare
-        sql = f"""
-        SELECT fare_type.fare_type, fare_type.transfers_allowed, fare_type.fare_duration 
-        FROM fare_type
-        WHERE fare_type.mdb_slug = "{leg.feed}"
-        """
-        res = execute_sql(sql, self.db)[0]
+        res = self.rules.fare_type(leg.feed)
 
         if res[0] == "flat":
-            fare = FixedFare(leg.departure_time, res[1], res[2], leg.feed, self.db)
+            fare = FixedFare(leg.departure_time, res[1], res[2], leg.feed, self.rules)
             rf = self.get_route_fare_cost(leg)
             if rf is not None:
                 fare.cost = rf
@@ -421,7 +592,7 @@ class Itinerary:
                 max_transfers=res[1],
                 max_time=res[2],
                 feed=leg.feed,
-                db=self.db,
+                rules=self.rules,
                 route_id=leg.route_id,
                 from_zone=start_zone,
                 to_zone=end_zone,
@@ -431,26 +602,17 @@ class Itinerary:
         return fare
 
     def get_zones_from_leg(self, leg):
-        sql = f"""
-        SELECT zone_id
-        FROM "zone"
-        where "zone".mdb_slug = '{leg.feed}'
-        and "zone".stop_id = '{leg.start_stop_id}'
-        """
-        try:
-            start_zone = execute_sql(sql, self.db)[0][0]
-        except IndexError:
+        start_zone = self.rules.stop_zone(leg.feed, leg.start_stop_id)
+        if start_zone is None:
             raise IndexError(
                 f"{leg.feed} failed to find a zone for stop {leg.start_stop_id}"
             )
 
-        sql = f"""
-        SELECT zone_id
-        FROM "zone"
-        where "zone".mdb_slug = '{leg.feed}'
-        and "zone".stop_id = '{leg.end_stop_id}'
-        """
-        end_zone = execute_sql(sql, self.db)[0][0]
+        end_zone = self.rules.stop_zone(leg.feed, leg.end_stop_id)
+        if end_zone is None:
+            raise IndexError(
+                f"{leg.feed} failed to find a zone for stop {leg.end_stop_id}"
+            )
 
         return start_zone, end_zone
 
@@ -466,18 +628,7 @@ class Itinerary:
         -------
         int
             The fare cost"""
-
-        sql = f"""
-        SELECT rf.fare_cost 
-        FROM route_fare rf
-        where rf.mdb_slug = '{leg.feed}'
-        AND rf.route_id = '{leg.route_id}'
-        """
-        res = execute_sql(sql, self.db)
-        if len(res) > 0:
-            return int(res[0][0])
-        else:
-            return None
+        return self.rules.route_fare_cost(leg.feed, leg.route_id)
 
     def get_flat_fare_cost(self, leg) -> int:
         """Get the flat fare cost for the leg
@@ -492,14 +643,7 @@ class Itinerary:
         int
             The fare cost
         """
-
-        sql = f"""
-        SELECT ff.fare_cost
-        FROM flat_fare ff 
-        where ff.mdb_slug = "{leg.feed}"
-        """
-
-        return int(execute_sql(sql, self.db)[0][0])
+        return self.rules.flat_fare_cost(leg.feed)
 
 
 def execute_sql(sql, db) -> list:
@@ -517,7 +661,213 @@ def execute_sql_to_df(sql, db) -> pandas.DataFrame:
     return df
 
 
+class FareRules:
+    """The fare rules of every feed in a fares database
+
+    The ``fare_type``, ``flat_fare``, ``route_fare``, ``zone``, ``zone_fare`` and
+    ``transfer`` tables are read once into dictionaries keyed by feed
+    (``mdb_slug``), route, stop and zone, so computing fares does no I/O. Where
+    several rows match a lookup, the first one in table order is used, as the
+    SQL queries these replace did. Ids are compared as strings.
+
+    Parameters
+    ----------
+    tables : dict
+        The rows of each of the ``FARE_TABLES``, as lists of dicts
+    transfers : pandas.DataFrame
+        The ``transfer`` table
+    """
+
+    def __init__(self, tables: dict, transfers: pandas.DataFrame):
+        self._fare_types = {}
+        for row in tables["fare_type"]:
+            self._fare_types.setdefault(
+                str(row["mdb_slug"]),
+                (row["fare_type"], row["transfers_allowed"], row["fare_duration"]),
+            )
+        self._flat_fares = {}
+        for row in tables["flat_fare"]:
+            self._flat_fares.setdefault(str(row["mdb_slug"]), int(row["fare_cost"]))
+        self._route_fares = {}
+        for row in tables["route_fare"]:
+            key = (str(row["mdb_slug"]), str(row["route_id"]))
+            self._route_fares.setdefault(key, int(row["fare_cost"]))
+        self._zones = {}
+        for row in tables["zone"]:
+            key = (str(row["mdb_slug"]), str(row["stop_id"]))
+            self._zones.setdefault(key, row["zone_id"])
+        # Zone fares keep every (route, cost) of a zone pair in table order, as a
+        # specific route and __ANY__ both match
+        self._zone_fares = {}
+        for row in tables["zone_fare"]:
+            key = (str(row["mdb_slug"]), str(row["from_zone"]), str(row["to_zone"]))
+            self._zone_fares.setdefault(key, []).append(
+                (str(row["route_id"]), int(row["fare_cost"]))
+            )
+        # Transfer rules resolved ahead of time for every route a rule names,
+        # plus a default for the routes none of them name
+        self._transfer_rules = {}
+        self._default_transfer_rules = {}
+        for (from_feed, to_feed), df in transfers.groupby(
+            ["from_mdb_slug", "to_mdb_slug"], sort=False
+        ):
+            key = (str(from_feed), to_feed)
+            feed_rules = [
+                TransferRule(*row)
+                for row in df[list(TransferRule._fields)].itertuples(index=False)
+            ]
+            for route_id in df["from_route_id"].unique():
+                if not pandas.isna(route_id):
+                    self._transfer_rules[key + (route_id,)] = _resolve_transfer_rule(
+                        feed_rules, route_id
+                    )
+            self._default_transfer_rules[key] = _resolve_transfer_rule(feed_rules, None)
+
+    @classmethod
+    def from_db(cls, db: str) -> "FareRules":
+        """Read the fare rules from a fares database
+
+        Parameters
+        ----------
+        db : str
+            The path to the SQLite fares database
+
+        Returns
+        -------
+        FareRules
+            The fare rules
+        """
+        conn = sqlite3.connect(db)
+        try:
+            tables = {}
+            for table in FARE_TABLES:
+                cursor = conn.execute(f'SELECT * FROM "{table}"')
+                columns = [c[0] for c in cursor.description]
+                tables[table] = [dict(zip(columns, row)) for row in cursor.fetchall()]
+                cursor.close()
+            transfers = pandas.read_sql_query("SELECT * FROM transfer", conn)
+        finally:
+            conn.close()
+        return cls(tables, transfers)
+
+    @classmethod
+    def load(cls, rules) -> "FareRules":
+        """Get fare rules, reading a database only if it hasn't been read yet
+
+        Parameters
+        ----------
+        rules : FareRules | str
+            Fare rules, which are returned as they are, or the path to a fares
+            database
+
+        Returns
+        -------
+        FareRules
+            The fare rules
+        """
+        if isinstance(rules, FareRules):
+            return rules
+        stat = os.stat(rules)
+        key = (os.path.abspath(rules), stat.st_mtime_ns, stat.st_size)
+        if key not in _fare_rules:
+            _fare_rules[key] = cls.from_db(rules)
+        return _fare_rules[key]
+
+    def fare_type(self, feed: str) -> tuple:
+        """Get the fare type, transfers allowed and fare duration of a feed"""
+        try:
+            return self._fare_types[str(feed)]
+        except KeyError:
+            raise IndexError(f"{feed} has no fare type")
+
+    def flat_fare_cost(self, feed: str) -> int:
+        """Get the flat fare cost of a feed"""
+        try:
+            return self._flat_fares[str(feed)]
+        except KeyError:
+            raise IndexError(f"{feed} has no flat fare")
+
+    def route_fare_cost(self, feed: str, route_id: str) -> int:
+        """Get the route-specific fare cost of a route, or None if there is none"""
+        return self._route_fares.get((str(feed), str(route_id)))
+
+    def stop_zone(self, feed: str, stop_id: str):
+        """Get the fare zone of a stop, or None if it has none"""
+        return self._zones.get((str(feed), str(stop_id)))
+
+    def zone_fare_cost(self, feed: str, route_id: str, from_zone, to_zone) -> int:
+        """Get the fare between two zones on a route, or None if there is none
+
+        Fares for the specific route and for ``__ANY__`` route both apply.
+        """
+        route_id = str(route_id)
+        for rule_route_id, cost in self._zone_fares.get(
+            (str(feed), str(from_zone), str(to_zone)), []
+        ):
+            if rule_route_id == route_id or rule_route_id == "__ANY__":
+                return cost
+        return None
+
+    def transfer_rule(self, from_feed: str, to_feed: str, from_route_id: str):
+        """Get the rule for transferring between feeds, or None if there is none
+
+        Rules for ``__ANY__`` route come first, then rules for the route being
+        transferred from, then ``__ELSE__`` rules. Within those, rules to
+        ``__ANY__`` route come first, then the same fallback on the from-route.
+        The first matching rule in table order is used.
+        """
+        key = (str(from_feed), to_feed)
+        if not pandas.isna(from_route_id):
+            rule = self._transfer_rules.get(key + (from_route_id,), _NO_RULE)
+            if rule is not _NO_RULE:
+                return rule
+        return self._default_transfer_rules.get(key)
+
+
+#: A row of the transfer table, as used to compute fares
+TransferRule = collections.namedtuple(
+    "TransferRule",
+    ["from_route_id", "to_route_id", "transfer_type", "new_fare", "fare_value"],
+)
+# Marks routes without a resolved rule of their own
+_NO_RULE = object()
+
+
+def _resolve_transfer_rule(feed_rules: list, route_id) -> TransferRule:
+    # First we check for an __ANY__ condition as that covers all routes, then
+    # for the specific route ID, and finally for an __ELSE__ key
+    from_rules = [r for r in feed_rules if r.from_route_id == "__ANY__"]
+    if len(from_rules) == 0:
+        from_rules = [r for r in feed_rules if r.from_route_id == route_id]
+        if len(from_rules) == 0:
+            from_rules = [r for r in feed_rules if r.from_route_id == "__ELSE__"]
+
+    # Now we check for the route we are transferring to. Like the original
+    # cascade, the fallbacks look at the from-route.
+    to_rules = [r for r in from_rules if r.to_route_id == "__ANY__"]
+    if len(to_rules) == 0:
+        to_rules = [r for r in from_rules if r.from_route_id == route_id]
+        if len(to_rules) == 0:
+            to_rules = [r for r in from_rules if r.from_route_id == "__ELSE__"]
+
+    if len(to_rules) > 0:
+        return to_rules[0]
+    return None
+
+
 class TransitLeg:
+    # Legs are created by the million, so keep them small. Transfer rules are
+    # looked up per feed in FareRules rather than held by each leg.
+    __slots__ = (
+        "transport_mode",
+        "departure_time",
+        "feed",
+        "agency_id",
+        "route_id",
+        "start_stop_id",
+        "end_stop_id",
+    )
+
     def __init__(
         self,
         transport_mode,
@@ -527,9 +877,6 @@ class TransitLeg:
         route_id,
         start_stop_id,
         end_stop_id,
-        prev_leg,
-        next_leg,
-        db,
     ):
         self.transport_mode = transport_mode
         self.departure_time = departure_time
@@ -538,23 +885,13 @@ class TransitLeg:
         self.route_id = route_id
         self.start_stop_id = start_stop_id
         self.end_stop_id = end_stop_id
-        self.prev_leg = prev_leg
-        self.next_leg = next_leg
-        self.db = db
-
-        # Let's get the transfers
-        sql = f"""
-        SELECT * from transfer
-        where transfer.from_mdb_slug = '{self.feed}'
-        """
-        self.transfers = execute_sql_to_df(sql, self.db)
 
     def __repr__(self) -> str:
         return f"<TransitLeg {self.transport_mode} {self.departure_time} | {self.route_id}:{self.start_stop_id}->{self.end_stop_id}>"
 
     @classmethod
-    def from_row(cls, r, prev_leg, db):
-        leg = cls(
+    def from_row(cls, r):
+        return cls(
             r.transport_mode,
             r.departure_time.to_pydatetime(),
             r.feed,
@@ -562,26 +899,30 @@ class TransitLeg:
             r.route_id,
             r.start_stop_id,
             r.end_stop_id,
-            prev_leg,
-            None,
-            db,
         )
-        # Link the list
-        if prev_leg is not None:
-            leg.prev_leg.next_leg = leg
-
-        return leg
 
 
 class BaseFare:
-    def __init__(self, start_time, transfers, duration, feed, db):
+    __slots__ = (
+        "start_time",
+        "active",
+        "cost",
+        "premium",
+        "discount",
+        "feed",
+        "rules",
+        "max_time",
+        "transfers",
+    )
+
+    def __init__(self, start_time, transfers, duration, feed, rules):
         self.start_time = start_time
         self.active = True
         self.cost = None
         self.premium = None
         self.discount = 0
         self.feed = feed
-        self.db = db
+        self.rules = rules
 
         if duration > 0:
             self.max_time = duration
@@ -604,8 +945,10 @@ class BaseFare:
 
 
 class FixedFare(BaseFare):
-    def __init__(self, start_time, max_transfers, max_time, feed, db):
-        super().__init__(start_time, max_transfers, max_time, feed, db)
+    __slots__ = ()
+
+    def __init__(self, start_time, max_transfers, max_time, feed, rules):
+        super().__init__(start_time, max_transfers, max_time, feed, rules)
 
     def __repr__(self) -> str:
         active = ["X", "A"][int(self.active)]
@@ -613,18 +956,20 @@ class FixedFare(BaseFare):
 
 
 class ZoneFare(BaseFare):
+    __slots__ = ("route_id", "from_zone", "to_zone")
+
     def __init__(
         self,
         start_time,
         max_transfers,
         max_time,
         feed,
-        db,
+        rules,
         route_id,
         from_zone,
         to_zone,
     ):
-        super().__init__(start_time, max_transfers, max_time, feed, db)
+        super().__init__(start_time, max_transfers, max_time, feed, rules)
         self.route_id = route_id
         self.from_zone = from_zone
         self.to_zone = to_zone
@@ -635,26 +980,16 @@ class ZoneFare(BaseFare):
 
     def update_fare(self):
         """Update the fare based on start and end zones"""
-        sql = f"""
-        SELECT zf.fare_cost
-        FROM zone_fare zf 
-        WHERE mdb_slug = '{self.feed}' 
-        AND (route_id = '{self.route_id}' OR route_id = '__ANY__')
-        AND from_zone = '{self.from_zone}'
-        AND to_zone = '{self.to_zone}'"""
-        res = execute_sql(sql, self.db)
-        if len(res) == 0:
+        cost = self.rules.zone_fare_cost(
+            self.feed, self.route_id, self.from_zone, self.to_zone
+        )
+        if cost is None:
             # Try the reverse
-            sql = f"""
-                    SELECT zf.fare_cost
-                    FROM zone_fare zf 
-                    WHERE mdb_slug = '{self.feed}' 
-                    AND (route_id = '{self.route_id}' OR route_id = '__ANY__')
-                    AND from_zone = '{self.to_zone}'
-                    AND to_zone = '{self.from_zone}'"""
-            res = execute_sql(sql, self.db)
-        if len(res) > 0:
-            self.cost = int(res[0][0])
+            cost = self.rules.zone_fare_cost(
+                self.feed, self.route_id, self.to_zone, self.from_zone
+            )
+        if cost is not None:
+            self.cost = cost
         else:
             self.cost = 500
 
@@ -675,6 +1010,20 @@ class OTPQuery:
         to_lon: float,
         start_datetime: datetime.datetime,
     ) -> pandas.DataFrame:
+        q = self.plan_query(from_lat, from_lon, to_lat, to_lon, start_datetime)
+        r = requests.post(self.OTP_ENDPOINT, json={"query": q})
+        itineraries = json.loads(r.text)["data"]["plan"]["itineraries"]
+        return self.legs_from_itineraries(from_id, to_id, itineraries)
+
+    def plan_query(
+        self,
+        from_lat: float,
+        from_lon: float,
+        to_lat: float,
+        to_lon: float,
+        start_datetime: datetime.datetime,
+    ) -> str:
+        """Build the GraphQL plan query between two points"""
         q = f"""
             {{
                 plan(
@@ -721,8 +1070,12 @@ class OTPQuery:
                 }}
             }}
             """
-        r = requests.post(self.OTP_ENDPOINT, json={"query": q})
-        itineraries = json.loads(r.text)["data"]["plan"]["itineraries"]
+        return q
+
+    def legs_from_itineraries(
+        self, from_id: str, to_id: str, itineraries: list
+    ) -> pandas.DataFrame:
+        """Get the legs of the fastest of the itineraries OTP planned for a pair"""
         leg_data = {
             "from_id": [],
             "to_id": [],
@@ -748,7 +1101,7 @@ class OTPQuery:
                 leg_data["segment"].append(lidx)
                 leg_data["mode"].append(leg["mode"])
                 departure_time = datetime.datetime.fromtimestamp(
-                    leg["from"]["departureTime"] / 1000, timezone("America/New_York")
+                    leg["from"]["departureTime"] / 1000, timezone(OTP_TIMEZONE)
                 )
                 leg_data["departure_time"].append(departure_time)
                 if leg["from"]["stop"] != None:
@@ -798,6 +1151,373 @@ def _route_query(param_list):
     )
 
 
+class AsyncOTPQuery(OTPQuery):
+    """An OTP client that keeps many plan requests in flight at once
+
+    All requests share one pooled HTTP session, at most ``max_in_flight`` of
+    them are outstanding at a time, and requests that fail with a connection
+    error, a timeout or a retryable status are retried with exponential backoff.
+
+    Parameters
+    ----------
+    feeds : dict
+        The feed slug of each OTP feed id
+    endpoint : str, optional
+        The OTP GraphQL endpoint, by default ``OTP_ENDPOINT``
+    max_in_flight : int, optional
+        The maximum number of concurrent requests, by default 16
+    retries : int, optional
+        The number of times to retry a failed request, by default 3
+    backoff : float, optional
+        The wait before the first retry (seconds), doubled for each retry after
+        it, by default 1.0
+    timeout : float, optional
+        The time limit of a single request (seconds), by default 120
+    """
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        feeds,
+        endpoint: str = None,
+        max_in_flight: int = 16,
+        retries: int = 3,
+        backoff: float = 1.0,
+        timeout: float = 120,
+    ):
+        super().__init__(feeds)
+        self.endpoint = self.OTP_ENDPOINT if endpoint is None else endpoint
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+    async def query_route_async(
+        self,
+        session: aiohttp.ClientSession,
+        from_id: str,
+        to_id: str,
+        from_lat: float,
+        from_lon: float,
+        to_lat: float,
+        to_lon: float,
+        start_datetime: datetime.datetime,
+    ) -> pandas.DataFrame:
+        """Query the fastest itinerary of a pair, as ``OTPQuery.query_route``"""
+        q = self.plan_query(from_lat, from_lon, to_lat, to_lon, start_datetime)
+        for attempt in range(self.retries + 1):
+            try:
+                async with session.post(self.endpoint, json={"query": q}) as r:
+                    if r.status in self.RETRY_STATUSES:
+                        r.raise_for_status()
+                    text = await r.text()
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(self.backoff * 2**attempt)
+        itineraries = json.loads(text)["data"]["plan"]["itineraries"]
+        return self.legs_from_itineraries(from_id, to_id, itineraries)
+
+    async def query_routes(self, jobs, on_result) -> list:
+        """Query the itineraries of many pairs
+
+        Parameters
+        ----------
+        jobs : iterable
+            ``(from_id, to_id, from_lat, from_lon, to_lat, to_lon,
+            start_datetime)`` tuples, consumed lazily
+        on_result : callable
+            Called with each job and its legs as soon as they arrive
+
+        Returns
+        -------
+        list
+            The ``(from_id, to_id)`` of the pairs that could not be queried
+        """
+        jobs = iter(jobs)
+        failed = []
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(
+            connector=connector, timeout=timeout
+        ) as session:
+
+            async def worker():
+                # The workers share the job iterator, so each job is taken once
+                for job in jobs:
+                    try:
+                        legs = await self.query_route_async(session, *job)
+                    except (
+                        aiohttp.ClientError,
+                        asyncio.TimeoutError,
+                        KeyError,
+                        TypeError,
+                        ValueError,
+                    ) as e:
+                        logging.warning(f"Failed to query {job[0]}->{job[1]}: {e!r}")
+                        failed.append((job[0], job[1]))
+                        continue
+                    on_result(job, legs)
+
+            await asyncio.gather(*(worker() for _ in range(self.max_in_flight)))
+        return failed
+
+
+class ItineraryWriter:
+    """Appends itinerary legs to a resumable Parquet dataset
+
+    Legs are buffered and every ``batch_size`` pairs they are written as a new
+    part file in the ``path`` folder, which ``pandas.read_parquet`` reads as one
+    dataset. Every pair that is written, with or without legs, is recorded in a
+    ledger next to the parts. Opening an existing dataset reads its ledger, so a
+    killed run can skip the pairs in :attr:`completed` and only fetch the rest.
+
+    Parameters
+    ----------
+    path : str
+        The dataset folder, e.g. ``WAS_itineraries.parquet``
+    id_type : pyarrow.DataType, optional
+        The type of the origin and destination ids, by default ``int64``
+    batch_size : int, optional
+        The number of pairs per part file, by default 1000
+    """
+
+    def __init__(self, path: str, id_type=pyarrow.int64(), batch_size: int = 1000):
+        self.path = path
+        self.schema = itinerary_schema(id_type)
+        self.batch_size = batch_size
+        self.completed = set()
+        self._buffer = []
+        self._pairs = []
+        self._next_part = 0
+        os.makedirs(path, exist_ok=True)
+        for filename in os.listdir(path):
+            if filename.endswith(".partial"):
+                os.remove(os.path.join(path, filename))
+            elif filename.startswith("part-"):
+                self._next_part = max(self._next_part, _part_number(filename) + 1)
+        self._read_ledger()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, from_id, to_id, legs: pandas.DataFrame):
+        """Add the legs of a pair, which may have none"""
+        self._pairs.append([_json_id(from_id), _json_id(to_id)])
+        if not legs.empty:
+            self._buffer.append(legs[ITINERARY_COLUMNS])
+        if len(self._pairs) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered legs as a part file and record their pairs"""
+        if len(self._pairs) == 0:
+            return
+        part = None
+        if len(self._buffer) > 0:
+            part = ITINERARY_PART_TEMPLATE.format(self._next_part)
+            self._next_part += 1
+            df = pandas.concat(self._buffer, axis="index", ignore_index=True)
+            pyarrow.parquet.write_table(
+                pyarrow.Table.from_pandas(df, schema=self.schema, preserve_index=False),
+                os.path.join(self.path, f".{part}.partial"),
+            )
+        # The part only counts once it is in place, so a crash between these
+        # steps leaves its pairs to be fetched again
+        with open(os.path.join(self.path, ITINERARY_LEDGER_FILENAME), "a") as ledger:
+            ledger.write(json.dumps({"part": part, "pairs": self._pairs}) + "\n")
+            ledger.flush()
+            os.fsync(ledger.fileno())
+        if part is not None:
+            os.replace(
+                os.path.join(self.path, f".{part}.partial"),
+                os.path.join(self.path, part),
+            )
+        self.completed.update(tuple(p) for p in self._pairs)
+        self._buffer = []
+        self._pairs = []
+
+    def close(self):
+        """Write any remaining legs"""
+        self.flush()
+
+    def _read_ledger(self):
+        ledger_path = os.path.join(self.path, ITINERARY_LEDGER_FILENAME)
+        if not os.path.exists(ledger_path):
+            return
+        with open(ledger_path, "r+") as ledger:
+            text = ledger.read()
+            complete = text[: text.rfind("\n") + 1]
+            if len(complete) < len(text):
+                # The last line was cut off when a run was killed writing it
+                ledger.seek(len(complete))
+                ledger.truncate()
+        for line in complete.splitlines():
+            entry = json.loads(line)
+            part = entry["part"]
+            if part is not None:
+                self._next_part = max(self._next_part, _part_number(part) + 1)
+                if not os.path.exists(os.path.join(self.path, part)):
+                    continue
+            self.completed.update(tuple(p) for p in entry["pairs"])
+
+
+def _part_number(filename: str) -> int:
+    return int(filename.split("-")[1].split(".")[0])
+
+
+def _json_id(value):
+    # Ledger ids are plain ints or strings, not NumPy scalars
+    return value.item() if isinstance(value, numpy.generic) else value
+
+
+def itinerary_schema(id_type=pyarrow.int64()) -> pyarrow.Schema:
+    """Get the Parquet schema of itinerary legs
+
+    Parameters
+    ----------
+    id_type : pyarrow.DataType, optional
+        The type of the origin and destination ids, by default ``int64``
+
+    Returns
+    -------
+    pyarrow.Schema
+        The schema, with a column for each of ``ITINERARY_COLUMNS``
+    """
+    return pyarrow.schema(
+        [
+            ("from_id", id_type),
+            ("to_id", id_type),
+            ("segment", pyarrow.int64()),
+            ("mode", pyarrow.string()),
+            ("departure_time", pyarrow.timestamp("ms", tz=OTP_TIMEZONE)),
+            ("feed", pyarrow.string()),
+            ("agency_id", pyarrow.string()),
+            ("route_id", pyarrow.string()),
+            ("start_stop_id", pyarrow.string()),
+            ("end_stop_id", pyarrow.string()),
+        ]
+    )
+
+
+def run_otp_itineraries_async(
+    fares_yaml: str,
+    pairs_df: pandas.DataFrame,
+    clusters: pandas.DataFrame,
+    departure: datetime.datetime,
+    output_parquet: str,
+    max_in_flight: int = 16,
+    endpoint: str = None,
+) -> list:
+    """Fetch OTP itineraries for origin-destination pairs straight into Parquet
+
+    Pairs already in the output dataset's ledger are skipped, so a killed run
+    can be restarted with the same arguments.
+
+    Parameters
+    ----------
+    fares_yaml : str
+        The file path of the fares configuration YAML file
+    pairs_df : pandas.DataFrame
+        The dataframe with the pairs to check
+    clusters : pandas.DataFrame
+        The set of clusters to create itineraries for
+    departure : datetime.datetime
+        The departure time and date to use
+    output_parquet : str
+        The Parquet dataset folder to append the itinerary legs to
+    max_in_flight : int, optional
+        The maximum number of concurrent OTP requests, by default 16
+    endpoint : str, optional
+        The OTP GraphQL endpoint, by default ``OTPQuery.OTP_ENDPOINT``
+
+    Returns
+    -------
+    list
+        The ``(from_id, to_id)`` of the pairs that could not be queried
+    """
+    print("Running OTP Itineraries - Specified Pairs (async)")
+    with open(fares_yaml) as infile:
+        config = yaml.safe_load(infile)
+
+    feeds = {
+        (str(key) if isinstance(key, int) else key): config["feeds"][key]
+        for key in config["feeds"]
+    }
+
+    otp = AsyncOTPQuery(feeds, endpoint=endpoint, max_in_flight=max_in_flight)
+
+    start = time.time()
+    with ItineraryWriter(
+        output_parquet, id_type=_id_type(clusters["CLUSTER_ID"])
+    ) as writer:
+        jobs = _pair_jobs(pairs_df, clusters, departure, skip=writer.completed)
+        print("  Generating", len(jobs), "itineraries")
+        print(f"  Using {max_in_flight} requests in flight")
+        with tqdm(total=len(jobs)) as progress:
+
+            def on_result(job, legs):
+                writer.write(job[0], job[1], legs)
+                progress.update()
+
+            failed = asyncio.run(otp.query_routes(jobs, on_result))
+
+    end = time.time()
+    print("  Took", end - start, "seconds")
+    if len(failed) > 0:
+        print("  Failed to fetch", len(failed), "itineraries")
+    return failed
+
+
+def _pair_jobs(
+    pairs_df: pandas.DataFrame,
+    clusters: pandas.DataFrame,
+    departure: datetime.datetime,
+    skip: set = None,
+) -> list:
+    # Remove diagnonals
+    pairs_df = pairs_df[pairs_df.from_id != pairs_df.to_id]
+    pairs_df = pandas.merge(
+        pairs_df,
+        clusters,
+        left_on="from_id",
+        right_on="CLUSTER_ID",
+        how="left",
+    )
+    pairs_df = pandas.merge(
+        pairs_df,
+        clusters,
+        left_on="to_id",
+        right_on="CLUSTER_ID",
+        how="left",
+        suffixes=["_o", "_d"],
+    )
+    jobs = zip(
+        pairs_df.CLUSTER_ID_o,
+        pairs_df.CLUSTER_ID_d,
+        pairs_df.MEAN_Y_o,
+        pairs_df.MEAN_X_o,
+        pairs_df.MEAN_Y_d,
+        pairs_df.MEAN_X_d,
+        itertools.repeat(departure),
+    )
+    if skip:
+        # Pairs that are already fetched
+        return [job for job in jobs if (job[0], job[1]) not in skip]
+    return list(jobs)
+
+
+def _id_type(ids: pandas.Series) -> pyarrow.DataType:
+    if pandas.api.types.is_integer_dtype(ids):
+        return pyarrow.int64()
+    return pyarrow.string()
+
+
 def map_fare_matrix_to_bg(
     fare_matrix_filepath: str,
     cluster_to_bg: str,
@@ -836,31 +1556,201 @@ def map_fare_matrix_to_bg(
 
 
 def make_fare_matrix_from_itineraries(
-    itineraries_parquet, matrix_parquet, fares_db, region_key
+    itineraries_parquet, matrix_parquet, fares_db, region_key, processes=None
 ):
+    """Compute the fare matrix of a set of itineraries
+
+    Parameters
+    ----------
+    itineraries_parquet : str
+        The itinerary legs
+    matrix_parquet : str
+        The file to write the fare matrix to
+    fares_db : str
+        The path to the fares database
+    region_key : str
+        The region key string (e.g. WAS)
+    processes : int, optional
+        The number of worker processes, by default None (run serially). The
+        matrix is the same either way.
+    """
     df = pandas.read_parquet(itineraries_parquet).rename(
         columns={"mode": "transport_mode"}
     )
-    pairs = df.drop_duplicates(subset=["from_id", "to_id"])
-    fares = {"from_id": [], "to_id": [], "fare_cost": []}
-    for idx, pair in tqdm(pairs.iterrows(), total=pairs.shape[0]):
-        sub_df = df[
-            (df.from_id == pair["from_id"]) & (df.to_id == pair["to_id"])
-        ].copy()
-        if sub_df.shape[0] > 1:
-            it = Itinerary(
-                sub_df,
-                region_key,
-                fares_db,
+    rules = FareRules.load(fares_db)
+    if processes is not None and processes > 1:
+        fare_df = compute_pair_fares_in_parallel(
+            df, rules, region_key, processes, f"{matrix_parquet}.shards"
+        )
+    else:
+        fare_df = compute_pair_fares(df, rules, region_key)
+    fare_df.to_parquet(matrix_parquet)
+
+
+def compute_pair_fares(
+    df: pandas.DataFrame, rules, region_key: str, progress: bool = True
+) -> pandas.DataFrame:
+    """Compute the fare of every origin-destination pair's itinerary
+
+    The itineraries are sorted by pair once, so each pair's legs are a
+    contiguous slice rather than a filter over the whole frame.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The itinerary legs, with a ``transport_mode`` column
+    rules : FareRules | str
+        The fare rules, or the path to a fares database
+    region_key : str
+        The region the itineraries are in
+    progress : bool, optional
+        Whether to show a progress bar, by default True
+
+    Returns
+    -------
+    pandas.DataFrame
+        The ``from_id``, ``to_id`` and ``fare_cost`` of each pair with more than
+        one leg, in the order the pairs first appear in the itineraries
+    """
+    rules = FareRules.load(rules)
+    pairs, legs, bounds = _sort_by_pair(df)
+    positions = range(len(pairs))
+    if progress:
+        positions = tqdm(positions)
+    fares = _pair_fares(legs, pairs, bounds, positions, rules, region_key)
+    return _fare_frame(fares)
+
+
+def compute_pair_fares_in_parallel(
+    df: pandas.DataFrame,
+    rules,
+    region_key: str,
+    processes: int,
+    shard_folder: str,
+    shards_per_process: int = 4,
+) -> pandas.DataFrame:
+    """Compute the fare of every pair's itinerary on several processes
+
+    Pairs are partitioned by origin. Workers are forked after the itineraries
+    are sorted and the fare rules are loaded, so they share both without copying
+    or re-reading the fares database. Each partition is written as a Parquet
+    shard, and the shards are put back in pair order at the end, giving exactly
+    the same matrix as :func:`compute_pair_fares`.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The itinerary legs, with a ``transport_mode`` column
+    rules : FareRules | str
+        The fare rules, or the path to a fares database
+    region_key : str
+        The region the itineraries are in
+    processes : int
+        The number of worker processes
+    shard_folder : str
+        A folder for the shards, removed once they are merged
+    shards_per_process : int, optional
+        The number of partitions per process, by default 4
+
+    Returns
+    -------
+    pandas.DataFrame
+        The fare matrix, as returned by :func:`compute_pair_fares`
+    """
+    if "fork" not in multiprocessing.get_all_start_methods():
+        print("  Forking is not available, computing fares serially")
+        return compute_pair_fares(df, rules, region_key)
+
+    rules = FareRules.load(rules)
+    pairs, legs, bounds = _sort_by_pair(df)
+    # Split the origins (not the pairs) into contiguous ranges
+    origin_codes, origins = pandas.factorize(pairs.get_level_values(0), sort=True)
+    num_shards = max(1, min(processes * shards_per_process, len(origins)))
+    pair_shards = origin_codes * num_shards // max(1, len(origins))
+
+    os.makedirs(shard_folder, exist_ok=True)
+    tasks = [
+        (
+            numpy.flatnonzero(pair_shards == shard),
+            os.path.join(shard_folder, f"{shard:05d}.parquet"),
+        )
+        for shard in range(num_shards)
+    ]
+    _fare_worker_data.update(
+        legs=legs, pairs=pairs, bounds=bounds, rules=rules, region_key=region_key
+    )
+    # This process has usually started the JVM (importing r5py does), and unlike
+    # map_feeds, which spawns workers that each read their own feed, the workers
+    # are forked to share the legs and rules. Forking is safe as the workers only
+    # run Python and NumPy code and never call into Java, so they don't need the
+    # JVM threads that are not copied. Freezing the collector keeps the workers
+    # from collecting inherited objects (Java proxies included), and pool
+    # workers end with os._exit, so JPype never shuts the JVM down from them.
+    gc.freeze()
+    try:
+        with multiprocessing.get_context("fork").Pool(processes) as p:
+            shard_files = list(
+                tqdm(p.imap_unordered(_fare_shard, tasks), total=len(tasks))
             )
-            it.clean()
-            it.make_legs()
-            fares["from_id"].append(pair["from_id"])
-            fares["to_id"].append(pair["to_id"])
+    finally:
+        gc.unfreeze()
+        _fare_worker_data.clear()
+
+    # Leave out empty shards, which would change the dtypes of the columns
+    shard_dfs = [pandas.read_parquet(f) for f in sorted(shard_files)]
+    shard_dfs = [d for d in shard_dfs if not d.empty]
+    shutil.rmtree(shard_folder)
+    if len(shard_dfs) == 0:
+        # Built like compute_pair_fares builds a matrix without pairs
+        return _fare_frame(_new_fares())
+    fare_df = pandas.concat(shard_dfs, axis="index")
+    fare_df = fare_df.sort_values("pair").drop(columns=["pair"])
+    return fare_df.reset_index(drop=True)
+
+
+def _fare_shard(task) -> str:
+    positions, shard_file = task
+    d = _fare_worker_data
+    fares = _pair_fares(
+        d["legs"], d["pairs"], d["bounds"], positions, d["rules"], d["region_key"]
+    )
+    pandas.DataFrame(fares).to_parquet(shard_file)
+    return shard_file
+
+
+def _new_fares() -> dict:
+    return {"pair": [], "from_id": [], "to_id": [], "fare_cost": []}
+
+
+def _fare_frame(fares: dict) -> pandas.DataFrame:
+    return pandas.DataFrame(fares).drop(columns=["pair"])
+
+
+def _pair_fares(legs, pairs, bounds, positions, rules, region_key: str) -> dict:
+    fares = _new_fares()
+    for i in positions:
+        if bounds[i + 1] - bounds[i] > 1:
+            it = Itinerary.from_legs(legs.legs(i), region_key, rules)
+            fares["pair"].append(i)
+            fares["from_id"].append(pairs[i][0])
+            fares["to_id"].append(pairs[i][1])
             fares["fare_cost"].append(it.compute_fare())
+    return fares
+
 
-        fare_df = pandas.DataFrame(fares)
-        fare_df.to_parquet(matrix_parquet)
+def _sort_by_pair(df: pandas.DataFrame) -> tuple:
+    # Number the pairs in order of appearance, then sort by pair and segment so
+    # each pair's legs are contiguous and in travel order
+    codes, pairs = pandas.MultiIndex.from_arrays(
+        [df["from_id"], df["to_id"]]
+    ).factorize()
+    order = numpy.lexsort((df["segment"].to_numpy(), codes))
+    order = order[codes[order] >= 0]
+    codes = codes[order]
+    # The number of rows of each pair, including walking legs
+    bounds = numpy.searchsorted(codes, numpy.arange(len(pairs) + 1))
+    legs = LegTable.from_frame(df.take(order), codes, len(pairs))
+    return pairs, legs, bounds
 
 
 def _chunkify(l: list, n: int):
@@ -911,6 +1801,10 @@ def run_otp_itineraries_from_pairs_list(
 ):
     """Fetch a set of OTP itineraries based on a provided set of origin-destination pairs
 
+    The legs are appended to the ``{region_key}_itineraries.parquet`` dataset in
+    the output folder. Pairs already recorded in its ledger are skipped, so a
+    killed run resumes where it stopped.
+
     Parameters
     ----------
     fares_yaml : str
@@ -922,7 +1816,7 @@ def run_otp_itineraries_from_pairs_list(
     departure : datetime.datetime
         The departure time and date to use
     output_folder : str
-        The folder in which to put the chunks that are created
+        The folder in which to put the itinerary dataset
     region_key : str
         The region key string (e.g. WAS)
     chunk_size : int, optional
@@ -938,57 +1832,28 @@ def run_otp_itineraries_from_pairs_list(
     }
 
     otp = OTPQuery(feeds)
-    dfs = []
+    writer = ItineraryWriter(
+        os.path.join(output_folder, f"{region_key}_itineraries.parquet"),
+        id_type=_id_type(clusters["CLUSTER_ID"]),
+    )
     params_list = []
     print("  Building job list")
-
-    # Remove diagnonals
-    pairs_df = pairs_df[pairs_df.from_id != pairs_df.to_id]
-    pairs_df = pandas.merge(
-        pairs_df,
-        clusters,
-        left_on="from_id",
-        right_on="CLUSTER_ID",
-        how="left",
-    )
-    pairs_df = pandas.merge(
-        pairs_df,
-        clusters,
-        left_on="to_id",
-        right_on="CLUSTER_ID",
-        how="left",
-        suffixes=["_o", "_d"],
-    )
-    for idx, pair in pairs_df.iterrows():
-        params_list.append(
-            [
-                otp,
-                pair.CLUSTER_ID_o,
-                pair.CLUSTER_ID_d,
-                pair.MEAN_Y_o,
-                pair.MEAN_X_o,
-                pair.MEAN_Y_d,
-                pair.MEAN_X_d,
-                departure,
-            ]
-        )
+    for job in _pair_jobs(pairs_df, clusters, departure, skip=writer.completed):
+        params_list.append([otp, *job])
     print("  Generating", len(params_list), "itineraries")
+    if len(writer.completed) > 0:
+        print("  Skipping", len(writer.completed), "itineraries already fetched")
     chunk_list = list(_chunkify(params_list, chunk_size))
     print(f"  Using chunks of size {chunk_size}")
     cpus = multiprocessing.cpu_count() - 2
     print(f"  Using {cpus} CPUs")
 
     start = time.time()
-    with multiprocessing.Pool(cpus) as p:
+    with writer, multiprocessing.Pool(cpus) as p:
         for idx, chunk in tqdm(enumerate(chunk_list), total=len(chunk_list)):
             df_list = p.map(_route_query, chunk)
-            df_list = [d for d in df_list if not d.empty]
-            if len(df_list) > 0:
-                pandas.concat(df_list, axis="index").to_csv(
-                    f"{output_folder}/{region_key}_{idx}.csv", index=False
-                )
-            else:
-                print("    Chunk", idx, "has no data")
+            for params, legs in zip(chunk, df_list):
+                writer.write(params[1], params[2], legs)
 
     end = time.time()
     print("  Took", end - start, "seconds")
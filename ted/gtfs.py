@@ -3,23 +3,403 @@
 This module contains a set of utility functions specific to managing, analysing,
 and validating GTFS feeds."""
 
+import collections
+import csv
 import datetime
 import difflib
+import hashlib
+import io
 import json
+import multiprocessing
 import os
 import requests
 import urllib
 import shutil
+import struct
 import zipfile
 
 import geopandas
 import pandas
+import pyarrow.parquet
 from slugify import slugify
 import yaml
 
-from gtfslite.gtfs import GTFS
+from gtfslite.gtfs import GTFS, OPTIONAL_FILES, REQUIRED_FILES
+
+from .areas import StopAreaIndex
+from .cache import file_hash
+from .exception import FeedError
 
 MOBILITY_CATALOG_URL = "https://bit.ly/catalogs-csv"
+#: The memory parsed feeds may take up in-process before the least recently
+#: used ones are released (bytes)
+MAX_FEED_CACHE_BYTES = 4 * 1024**3
+#: The file marking a feed's Parquet tables as complete
+FEED_TABLES_MANIFEST = "manifest.json"
+#: The tables kept when simplifying a feed
+SIMPLIFIED_GTFS_FILES = REQUIRED_FILES + [
+    "calendar.txt",
+    "calendar_dates.txt",
+    "shapes.txt",
+]
+#: The size of the blocks copied between zip files (bytes)
+ZIP_COPY_BLOCK_SIZE = 1024 * 1024
+#: The HH:MM:SS columns stored as seconds since midnight, by table
+FEED_TIME_COLUMNS = {
+    "stop_times": ["arrival_time", "departure_time"],
+    "frequencies": ["start_time", "end_time"],
+}
+
+# Parsed feeds and their sizes keyed by (path, mtime, size, load options),
+# least recently used first
+_feeds = collections.OrderedDict()
+#: The number of stop area indexes to keep in-process
+MAX_WARM_STOP_AREA_INDEXES = 4
+# Stop area indexes keyed by their inputs, least recently used first
+_stop_area_indexes = collections.OrderedDict()
+
+
+def load_feed(gtfs_path: str, **load_kwargs) -> GTFS:
+    """Load a GTFS zip, reusing the parsed feed while the file is unchanged
+
+    Feeds are shared between callers, so they must not be modified in place.
+
+    Parameters
+    ----------
+    gtfs_path : str
+        The path to the GTFS zip file
+    **load_kwargs
+        Passed on to ``GTFS.load_zip``, feeds loaded with different options are
+        cached separately
+
+    Returns
+    -------
+    GTFS
+        The parsed feed
+    """
+    stat = os.stat(gtfs_path)
+    key = (
+        os.path.abspath(gtfs_path),
+        stat.st_mtime_ns,
+        stat.st_size,
+        tuple(sorted(load_kwargs.items())),
+    )
+    if key in _feeds:
+        _feeds.move_to_end(key)
+        return _feeds[key][0]
+
+    gtfs = GTFS.load_zip(gtfs_path, **load_kwargs)
+    _feeds[key] = (gtfs, _feed_size(gtfs))
+    # Keep at least the feed just loaded, however large it is
+    while len(_feeds) > 1 and _feed_cache_size() > MAX_FEED_CACHE_BYTES:
+        _feeds.popitem(last=False)
+    return gtfs
+
+
+def clear_feed_cache(gtfs_path: str = None):
+    """Release parsed feeds, either all of them or those of one file
+
+    Parameters
+    ----------
+    gtfs_path : str, optional
+        The path to the GTFS zip file to release, by default None (all feeds)
+    """
+    if gtfs_path is None:
+        _feeds.clear()
+        return
+    path = os.path.abspath(gtfs_path)
+    for key in [k for k in _feeds if k[0] == path]:
+        del _feeds[key]
+
+
+def _feed_size(gtfs: GTFS) -> int:
+    return sum(
+        int(table.memory_usage(index=True, deep=True).sum())
+        for table in vars(gtfs).values()
+        if isinstance(table, pandas.DataFrame)
+    )
+
+
+def _feed_cache_size() -> int:
+    return sum(size for _, size in _feeds.values())
+
+
+class FeedTables:
+    """The tables of a GTFS feed, cached on disk as Parquet
+
+    The first time a feed is opened each of its tables is converted to a
+    Parquet file in a folder named after the hash of the zip file. Columns of
+    ids are stored dictionary-encoded and the times in ``stop_times`` and
+    ``frequencies`` as integer seconds since midnight (nullable), so later
+    runs only read the tables and columns they need.
+
+    The methods used by the analysis functions (``summary``, ``date_trips``,
+    ``service_hours``) give the same results as those of ``GTFS``.
+
+    Parameters
+    ----------
+    gtfs_path : str
+        The path to the GTFS zip file
+    cache_folder : str
+        The folder holding the converted feeds
+    """
+
+    def __init__(self, gtfs_path: str, cache_folder: str):
+        self.gtfs_path = gtfs_path
+        self.folder = os.path.join(cache_folder, file_hash(gtfs_path))
+        manifest_path = os.path.join(self.folder, FEED_TABLES_MANIFEST)
+        if not os.path.exists(manifest_path):
+            _write_feed_tables(gtfs_path, self.folder)
+        with open(manifest_path) as infile:
+            #: The number of rows of each table in the feed
+            self.rows = json.load(infile)["tables"]
+
+    def table(self, name: str, columns: list = None) -> pandas.DataFrame:
+        """Read a table, or None if the feed doesn't have it
+
+        Parameters
+        ----------
+        name : str
+            The table name, e.g. "stop_times"
+        columns : list, optional
+            The columns to read, by default None (all). Columns the feed
+            doesn't have are left out.
+
+        Returns
+        -------
+        pandas.DataFrame
+            The table
+        """
+        if name not in self.rows:
+            return None
+        path = os.path.join(self.folder, f"{name}.parquet")
+        if columns is not None:
+            names = pyarrow.parquet.read_schema(path).names
+            columns = [c for c in columns if c in names]
+        return pandas.read_parquet(path, columns=columns)
+
+    def summary(self) -> pandas.Series:
+        """Summarize the feed like ``GTFS.summary``"""
+        summary = pandas.Series(dtype=str)
+        summary["agencies"] = self.table("agency", ["agency_name"]).agency_name.tolist()
+        summary["total_stops"] = self.rows["stops"]
+        summary["total_routes"] = self.rows["routes"]
+        summary["total_trips"] = self.rows["trips"]
+        summary["total_stops_made"] = self.rows["stop_times"]
+        first_dates = []
+        last_dates = []
+        calendar = self.table("calendar", ["start_date", "end_date"])
+        if calendar is not None:
+            first_dates.append(calendar.start_date.min())
+            last_dates.append(calendar.end_date.max())
+        calendar_dates = self.table("calendar_dates", ["date"])
+        if calendar_dates is not None:
+            first_dates.append(calendar_dates.date.min())
+            last_dates.append(calendar_dates.date.max())
+        summary["first_date"] = min(first_dates)
+        summary["last_date"] = max(last_dates)
+        if "shapes" in self.rows:
+            summary["total_shapes"] = self.rows["shapes"]
+        return summary
+
+    def date_trips(self, date: datetime.date) -> pandas.DataFrame:
+        """Get the trips that run on a date, like ``GTFS.date_trips``"""
+        calendar = self.table("calendar")
+        calendar_dates = self.table("calendar_dates")
+        service_ids = set()
+        if calendar is not None:
+            starts = pandas.to_datetime(calendar.start_date).dt.date
+            ends = pandas.to_datetime(calendar.end_date).dt.date
+            running = (
+                (calendar[date.strftime("%A").lower()] == 1)
+                & (starts <= date)
+                & (ends >= date)
+            )
+            service_ids.update(calendar.service_id[running])
+        if calendar_dates is not None:
+            on_date = pandas.to_datetime(calendar_dates.date).dt.date == date
+            service_ids.update(
+                calendar_dates.service_id[
+                    on_date & (calendar_dates.exception_type == 1)
+                ]
+            )
+            if calendar is not None:
+                service_ids.difference_update(
+                    calendar_dates.service_id[
+                        on_date & (calendar_dates.exception_type == 2)
+                    ]
+                )
+        trips = self.table("trips")
+        return trips[trips.service_id.isin(service_ids)]
+
+    def service_hours(
+        self, date: datetime.date, time_field: str = "arrival_time"
+    ) -> float:
+        """Get the service hours delivered on a date, like ``GTFS.service_hours``"""
+        trips = self.date_trips(date)
+        stop_times = self.table("stop_times", ["trip_id", time_field])
+        stop_times = stop_times[
+            stop_times.trip_id.isin(trips.trip_id) & stop_times[time_field].notna()
+        ]
+        grouped = stop_times.groupby("trip_id", observed=True)[time_field].agg(
+            ["max", "min"]
+        )
+        diff = (grouped["max"] - grouped["min"]).astype(float)
+        frequencies = self.table(
+            "frequencies", ["trip_id", "start_time", "end_time", "headway_secs"]
+        )
+        if frequencies is not None:
+            # Each frequency of a trip counts once per headway, at least once
+            runs = (
+                (frequencies.end_time - frequencies.start_time)
+                / frequencies.headway_secs
+            ).astype(int)
+            runs.index = frequencies.trip_id.astype(str)
+            multiplier = runs.clip(lower=1).groupby(level=0).sum()
+            diff = (
+                diff
+                * multiplier.reindex(diff.index.astype(str), fill_value=1).to_numpy()
+            )
+        return diff.sum() / 3600
+
+
+def _write_feed_tables(gtfs_path: str, folder: str):
+    # Parsed outside of load_feed, so the whole feed isn't kept in memory once
+    # its tables are written
+    gtfs = GTFS.load_zip(gtfs_path)
+    # Written next to the final folder and moved in place once complete, under
+    # a name of this process's own in case another converts the same feed
+    partial_folder = f"{folder}.{os.getpid()}.partial"
+    shutil.rmtree(partial_folder, ignore_errors=True)
+    os.makedirs(partial_folder)
+    rows = {}
+    for name, table in vars(gtfs).items():
+        if not isinstance(table, pandas.DataFrame):
+            continue
+        for column in table.columns:
+            if column in FEED_TIME_COLUMNS.get(name, []):
+                table[column] = _optional_time_to_seconds(table[column])
+            elif column.endswith("_id") and pandas.api.types.is_string_dtype(
+                table[column]
+            ):
+                table[column] = table[column].astype("category")
+        table.to_parquet(os.path.join(partial_folder, f"{name}.parquet"), index=False)
+        rows[name] = table.shape[0]
+    # The manifest marks the tables as complete
+    with open(os.path.join(partial_folder, FEED_TABLES_MANIFEST), "w") as outfile:
+        json.dump({"source": os.path.abspath(gtfs_path), "tables": rows}, outfile)
+    try:
+        os.replace(partial_folder, folder)
+    except OSError:
+        # Another process converted the same feed first
+        shutil.rmtree(partial_folder, ignore_errors=True)
+
+
+def _optional_time_to_seconds(times: pandas.Series) -> pandas.Series:
+    seconds = pandas.Series(pandas.NA, index=times.index, dtype="Int32")
+    present = times.notna()
+    if present.any():
+        seconds[present] = _time_to_seconds(times[present]).astype("int32")
+    return seconds
+
+
+#: The outcome of running a function on one feed, see map_feeds
+FeedResult = collections.namedtuple("FeedResult", ["path", "result", "error"])
+
+
+def map_feeds(
+    function, gtfs_paths: list[str], args: tuple = (), processes: int = 1
+) -> list[FeedResult]:
+    """Run a function on every feed, optionally each in its own worker process
+
+    Feeds are independent, so they are handed out largest first to keep the
+    whole map close to the time of the largest feed. An error in one feed is
+    reported and kept in its result rather than stopping the others.
+
+    Parameters
+    ----------
+    function : callable
+        A module-level function called as ``function(gtfs_path, *args)``
+    gtfs_paths : list[str]
+        The paths to the GTFS zip files
+    args : tuple, optional
+        Extra arguments passed to the function for every feed, by default ()
+    processes : int, optional
+        The number of worker processes, by default 1 (run the feeds in this
+        process, sharing its feed cache, see :func:`load_feed`)
+
+    Returns
+    -------
+    list[FeedResult]
+        The path, result, and error (or None) of each feed, in the order the
+        paths were given
+    """
+    tasks = [(function, path, args) for path in gtfs_paths]
+    processes = min(processes, len(tasks))
+    if processes <= 1:
+        results = [_feed_task(task) for task in tasks]
+    else:
+        order = sorted(
+            range(len(tasks)), key=lambda i: _file_size(gtfs_paths[i]), reverse=True
+        )
+        results = [None] * len(tasks)
+        # Spawn rather than fork, as this process may already have a JVM running
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(processes) as p:
+            for i, result in zip(
+                order, p.imap(_feed_task, [tasks[i] for i in order], chunksize=1)
+            ):
+                results[i] = result
+
+    for result in results:
+        if isinstance(result.error, zipfile.BadZipFile):
+            print(os.path.basename(result.path), "is not a zipfile, skipping...")
+        elif result.error is not None:
+            print(os.path.basename(result.path), "failed:", repr(result.error))
+    return results
+
+
+def raise_feed_errors(results: list[FeedResult]):
+    """Raise if any feed of a map failed, other than files that are not zips
+
+    Parameters
+    ----------
+    results : list[FeedResult]
+        The results of :func:`map_feeds`
+
+    Raises
+    ------
+    FeedError
+        If any feed raised an error, chained to the first one
+    """
+    failed = [
+        r
+        for r in results
+        if r.error is not None and not isinstance(r.error, zipfile.BadZipFile)
+    ]
+    if failed:
+        names = ", ".join(os.path.basename(r.path) for r in failed)
+        raise FeedError(f"{len(failed)} feeds failed: {names}") from failed[0].error
+
+
+def folder_feeds(gtfs_folder: str) -> list[str]:
+    """Get the paths of the entries of a GTFS folder, sorted by name"""
+    return [os.path.join(gtfs_folder, f) for f in sorted(os.listdir(gtfs_folder))]
+
+
+def _feed_task(task: tuple) -> FeedResult:
+    function, path, args = task
+    try:
+        return FeedResult(path, function(path, *args), None)
+    except Exception as e:
+        return FeedResult(path, None, e)
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
 
 
 def download_gtfs_using_yaml(
@@ -152,40 +532,26 @@ def check_routes_in_gtfs(gtfs_folder: str):
     print(f"\nMaster List:\n{masterlist_df}")
 
 
-def remove_routes_from_gtfs(gtfs_path: str, output_folder: str, route_ids: list[str]):
-    # Open/load the GTFS files
-    # Use the "remove_route" feature to remove the set of routes
-    # Make the output folder if it doesn't exist
-    # Write the GTFS file
-    zipfile_name = os.path.basename(gtfs_path)
-    gtfs = GTFS.load_zip(gtfs_path)
-    gtfs.delete_routes(route_ids)
-    if not os.path.exists(output_folder):
-        os.mkdir(output_folder)
-    gtfs.write_zip(os.path.join(output_folder, zipfile_name))
-
-
-def get_all_stops(gtfs_folder) -> geopandas.GeoDataFrame:
+def get_all_stops(
+    gtfs_folder, cache_folder: str = None, processes: int = 1
+) -> geopandas.GeoDataFrame:
     """Get all the stop locations in a given set of GTFS files
 
     Parameters
     ----------
     gtfs_folder : str
         The folder path for the GTFS folder
+    cache_folder : str, optional
+        The folder of cached feed tables (see :class:`FeedTables`), by default
+        None (parse the zip files)
+    processes : int, optional
+        The number of worker processes, see :func:`map_feeds`
     """
-    stop_dfs = []
     print("Fetching all stops")
-    for filename in os.listdir(gtfs_folder):
-        # Load the zipfile
-        print(" ", filename)
-        try:
-            gtfs = GTFS.load_zip(os.path.join(gtfs_folder, filename))
-            # Get the stops
-            stops = gtfs.stops[["stop_id", "stop_name", "stop_lat", "stop_lon"]].copy()
-            stops["agency"] = filename[:-4]
-            stop_dfs.append(stops)
-        except zipfile.BadZipFile:
-            print(filename, "is not a zipfile, skipping...")
+    results = map_feeds(
+        _feed_stops, folder_feeds(gtfs_folder), (cache_folder,), processes
+    )
+    stop_dfs = [r.result for r in results if r.error is None]
 
     df = pandas.concat(stop_dfs, axis="index")
     gdf = geopandas.GeoDataFrame(
@@ -194,21 +560,157 @@ def get_all_stops(gtfs_folder) -> geopandas.GeoDataFrame:
     return gdf
 
 
+def _feed_stops(gtfs_path: str, cache_folder: str) -> pandas.DataFrame:
+    print(" ", os.path.basename(gtfs_path))
+    columns = ["stop_id", "stop_name", "stop_lat", "stop_lon"]
+    if cache_folder is not None:
+        stops = FeedTables(gtfs_path, cache_folder).table("stops", columns)
+        stops["stop_id"] = stops.stop_id.astype(str)
+    else:
+        stops = load_feed(gtfs_path).stops[columns].copy()
+    stops["agency"] = os.path.basename(gtfs_path)[:-4]
+    return stops
+
+
+def get_stop_area_index(
+    areas_path: str,
+    areas_layer: str,
+    area_column: str,
+    gtfs_folder: str,
+    buffer: float,
+    feed_cache: str = None,
+    cache_folder: str = None,
+    processes: int = 1,
+) -> StopAreaIndex:
+    """Get the index of stops near areas, building it only if it isn't cached
+
+    Indexes are keyed by the contents of the area file, the file names and
+    contents of the feeds, the layer, and the buffer size. They are looked up in-process first, then in
+    the cache folder.
+
+    Parameters
+    ----------
+    areas_path : str
+        The path to the file (e.g. GeoPackage) holding the areas
+    areas_layer : str
+        The layer of the areas
+    area_column : str
+        The area id column
+    gtfs_folder : str
+        The folder of GTFS zip files to take the stops from
+    buffer : float
+        The distance around each area to include stops from, in the units of
+        the areas' CRS
+    feed_cache : str, optional
+        The folder of cached feed tables used to read the stops (see
+        :class:`FeedTables`), by default None
+    cache_folder : str, optional
+        The folder holding saved indexes, by default None (no disk cache)
+    processes : int, optional
+        The number of worker processes reading stops, see :func:`map_feeds`
+
+    Returns
+    -------
+    StopAreaIndex
+        The index of the stops of every feed in the folder
+    """
+    gtfs_paths = [p for p in folder_feeds(gtfs_folder) if os.path.isfile(p)]
+    key = hashlib.sha1(
+        json.dumps(
+            [
+                file_hash(areas_path),
+                areas_layer,
+                area_column,
+                buffer,
+                # Stops are labelled with their feed's file name, so names count
+                sorted((os.path.basename(p), file_hash(p)) for p in gtfs_paths),
+            ]
+        ).encode()
+    ).hexdigest()
+    if key in _stop_area_indexes:
+        _stop_area_indexes.move_to_end(key)
+        return _stop_area_indexes[key]
+
+    index = None
+    if cache_folder is not None:
+        index_folder = os.path.join(cache_folder, key)
+        if os.path.exists(index_folder):
+            print("   loading cached stop area index", key[:12])
+            index = StopAreaIndex.load(index_folder)
+    if index is None:
+        print("   building stop area index")
+        areas = geopandas.read_file(areas_path, layer=areas_layer)
+        stops = get_all_stops(gtfs_folder, feed_cache, processes)
+        index = StopAreaIndex.build(areas, area_column, stops, buffer)
+        if cache_folder is not None:
+            index.save(index_folder)
+
+    _stop_area_indexes[key] = index
+    while len(_stop_area_indexes) > MAX_WARM_STOP_AREA_INDEXES:
+        _stop_area_indexes.popitem(last=False)
+    return index
+
+
 def remove_routes_from_gtfs(gtfs_path: str, output_folder: str, route_ids: list[str]):
-    # Open/load the GTFS files
-    # Use the "remove_route" feature to remove the set of routes
-    # Make the output folder if it doesn't exist
-    # Write the GTFS file
-    zipfile_name = os.path.basename(gtfs_path)
-    gtfs = GTFS.load_zip(gtfs_path)
-    gtfs.delete_routes(route_ids)
+    """Copy a GTFS zip into a folder without some of its routes
+
+    Like ``GTFS.delete_routes``, the routes' trips are dropped along with their
+    stop times, frequencies, fare rules, transfers, and attributions. Only
+    those tables are rewritten, the rest are copied as they are.
+
+    Parameters
+    ----------
+    gtfs_path : str
+        The path to the GTFS zip file
+    output_folder : str
+        The folder to write the new zip file to, under the same name
+    route_ids : list[str]
+        The ids of the routes to remove
+    """
+    if isinstance(route_ids, str):
+        route_ids = [route_ids]
+    route_ids = {str(r) for r in route_ids}
+    # Find the trips of the routes first, stop_times can come before trips
+    with zipfile.ZipFile(gtfs_path) as zin:
+        header, rows = _read_member_rows(zin, _gtfs_members(zin)["trips.txt"])
+        route_index = header.index("route_id")
+        trip_index = header.index("trip_id")
+        trip_ids = {
+            row[trip_index].strip()
+            for row in rows
+            if row[route_index].strip() in route_ids
+        }
+    by_route = drop_rows({"route_id": route_ids})
+    by_trip = drop_rows({"trip_id": trip_ids})
     if not os.path.exists(output_folder):
         os.mkdir(output_folder)
-    gtfs.write_zip(os.path.join(output_folder, zipfile_name))
+    rewrite_gtfs_zip(
+        gtfs_path,
+        os.path.join(output_folder, os.path.basename(gtfs_path)),
+        rewrites={
+            "routes.txt": by_route,
+            "trips.txt": by_route,
+            "stop_times.txt": by_trip,
+            "frequencies.txt": by_trip,
+            "fare_rules.txt": by_route,
+            "transfers.txt": drop_rows(
+                {
+                    "from_route_id": route_ids,
+                    "to_route_id": route_ids,
+                    "from_trip_id": trip_ids,
+                    "to_trip_id": trip_ids,
+                }
+            ),
+            "attributions.txt": drop_rows({"route_id": route_ids, "trip_id": trip_ids}),
+        },
+    )
 
 
 def remove_premium_routes_from_gtfs(
-    gtfs_folder: str, output_folder: str, premium_routes_path: str
+    gtfs_folder: str,
+    output_folder: str,
+    premium_routes_path: str,
+    processes: int = 1,
 ):
     """Make a copy of a GTFS folder without premium routes
 
@@ -221,6 +723,8 @@ def remove_premium_routes_from_gtfs(
     premium_routes_path : str
         The path to the csv containing the list of premium route slugs and their ids.
         This must specify a csv file and the csv should be formatted into 'route_slug, route_id' columns
+    processes : int, optional
+        The number of worker processes, see :func:`map_feeds`
 
     """
     print("Removing Premium Routes from GTFS")
@@ -228,42 +732,41 @@ def remove_premium_routes_from_gtfs(
     if not os.path.exists(output_folder):
         os.mkdir(output_folder)
 
-    zip_entries = os.listdir(gtfs_folder)
-    # Iterate through .zip entries
-    for curr_zip_entry in zip_entries:
-        # Find entry zip folder
-        curr_zip_dir = os.path.join(gtfs_folder, curr_zip_entry)
-        curr_zip_slug = curr_zip_entry.removesuffix(".zip")
+    results = map_feeds(
+        _remove_premium_routes_from_feed,
+        folder_feeds(gtfs_folder),
+        (output_folder, premium_routes),
+        processes,
+    )
+    raise_feed_errors(results)
 
-        if not (curr_zip_entry.startswith("._")):
-            print("Currently parsing:", curr_zip_entry)
+    print(f"Done removing premium routes from {gtfs_folder}!")
 
-        premium_slug_rows = premium_routes.loc[
-            premium_routes["route_slug"] == curr_zip_slug
-        ]
-        slug_premium_ids = (premium_slug_rows.iloc[:, 1]).tolist()
 
-        # Skip slug labelled __ALL__
-        if "__ALL__" in slug_premium_ids:
-            print(curr_zip_slug + " is a premium feed, skipping...")
-        # delete specific routes within the given slug
-        else:
-            try:
-                if (
-                    curr_zip_slug in premium_routes["route_slug"].values
-                ):  # delete premium routes if it exists
-                    remove_routes_from_gtfs(
-                        curr_zip_dir, output_folder, slug_premium_ids
-                    )
-                else:  # not a feed containing premium routes: copy over current feed as is
-                    shutil.copy(
-                        curr_zip_dir,
-                        os.path.join(output_folder, curr_zip_entry),
-                    )
-            except zipfile.BadZipFile:
-                print(curr_zip_entry, "is not a zipfile, skipping...")
+def _remove_premium_routes_from_feed(
+    curr_zip_dir: str, output_folder: str, premium_routes: pandas.DataFrame
+):
+    curr_zip_entry = os.path.basename(curr_zip_dir)
+    curr_zip_slug = curr_zip_entry.removesuffix(".zip")
 
-    print(f"Done removing premium routes from {gtfs_folder}!")
+    if not (curr_zip_entry.startswith("._")):
+        print("Currently parsing:", curr_zip_entry)
+
+    premium_slug_rows = premium_routes.loc[
+        premium_routes["route_slug"] == curr_zip_slug
+    ]
+    slug_premium_ids = (premium_slug_rows.iloc[:, 1]).tolist()
+
+    # Skip slug labelled __ALL__
+    if "__ALL__" in slug_premium_ids:
+        print(curr_zip_slug + " is a premium feed, skipping...")
+    # delete specific routes within the given slug
+    elif (
+        curr_zip_slug in premium_routes["route_slug"].values
+    ):  # delete premium routes if it exists
+        remove_routes_from_gtfs(curr_zip_dir, output_folder, slug_premium_ids)
+    else:  # not a feed containing premium routes: copy over current feed as is
+        shutil.copy(curr_zip_dir, os.path.join(output_folder, curr_zip_entry))
 
 
 def remove_nonzip_files(gtfs_folder):
@@ -274,7 +777,7 @@ def remove_nonzip_files(gtfs_folder):
                 os.remove(os.path.join(gtfs_folder, folder, file))
 
 
-def check_valid_dates(gtfs_folder: str, week_of_deltas: list[int]):
+def check_valid_dates(gtfs_folder: str, week_of_deltas: list[int], processes: int = 1):
     """Check a gtfs feeds to see if dates are covered by the feed, assumes the mondays are
     the base starting point
 
@@ -285,42 +788,36 @@ def check_valid_dates(gtfs_folder: str, week_of_deltas: list[int]):
 
     deltas_week_of : list[ str ]
         List of day deltas from the date of the week in the gtfs_folder that is to be checked
+    processes : int, optional
+        The number of worker processes, see :func:`map_feeds`
     """
 
     dates_not_covered = dict()
     trips_not_covered = dict()
 
-    gtfs_path = os.listdir(gtfs_folder)
+    gtfs_path = sorted(os.listdir(gtfs_folder))
 
     for date in gtfs_path:
         dated_folder = os.path.join(gtfs_folder, date)
-        agency_feeds = os.listdir(dated_folder)
         dt_date = datetime.datetime.strptime(date, "%Y-%m-%d").date()
         print(f"\nNow parsing {date}:")
 
-        for agency_feed in agency_feeds:
-            print("-->", date, agency_feed, "<--")
-            agency_name = agency_feed.removesuffix(".zip")
-            feed_zip = os.path.join(dated_folder, agency_feed)
-            feed_df = GTFS.load_zip(feed_zip)
-            days_to_check = []
-            dates_not_covered[agency_name] = []
-            trips_not_covered[agency_name] = []
-
-            for delta_ent in week_of_deltas:
-                delt = dt_date + datetime.timedelta(days=delta_ent)
-                days_to_check.append(delt)
-
-            for day in days_to_check:
-                covered = feed_df.valid_date(day)
-                no_trips = feed_df.date_trips(day)
-                day_str = datetime.date.strftime(day, "%Y-%m-%d")
-
-                if not covered:
-                    dates_not_covered[agency_name].append(day)
+        days_to_check = []
+        for delta_ent in week_of_deltas:
+            delt = dt_date + datetime.timedelta(days=delta_ent)
+            days_to_check.append(delt)
 
-                elif no_trips.empty:
-                    trips_not_covered[agency_name].append(day)
+        results = map_feeds(
+            _feed_date_coverage, folder_feeds(dated_folder), (days_to_check,), processes
+        )
+        for result in results:
+            if result.error is not None:
+                continue
+            agency_feed = os.path.basename(result.path)
+            agency_name = agency_feed.removesuffix(".zip")
+            dates_not_covered[agency_name], trips_not_covered[agency_name] = (
+                result.result
+            )
 
             if len(dates_not_covered[agency_name]) > 0:
                 print(
@@ -334,16 +831,168 @@ def check_valid_dates(gtfs_folder: str, week_of_deltas: list[int]):
     print("Finished check_valid_dates")
 
 
-def remove_stop_timezone_and_fix_nan(gtfs_folder):
+def _feed_date_coverage(feed_zip: str, days_to_check: list) -> tuple[list, list]:
+    # The days the feed doesn't cover, and the covered days without trips
+    print("-->", os.path.basename(feed_zip), "<--")
+    feed_df = load_feed(feed_zip)
+    dates_not_covered = []
+    trips_not_covered = []
+    for day in days_to_check:
+        covered = feed_df.valid_date(day)
+        no_trips = feed_df.date_trips(day)
+
+        if not covered:
+            dates_not_covered.append(day)
+
+        elif no_trips.empty:
+            trips_not_covered.append(day)
+    return dates_not_covered, trips_not_covered
+
+
+def remove_stop_timezone_and_fix_nan(gtfs_folder, processes: int = 1):
     print("--> Cleaning Timezone and NAN values <--")
-    for f in os.listdir(gtfs_folder):
-        print(f)
-        for gtfs in os.listdir(os.path.join(gtfs_folder, f)):
-            print(" ", gtfs)
-            g = GTFS.load_zip(
-                os.path.join(gtfs_folder, f, gtfs), ignore_optional_files="all"
-            )
-            g.write_zip(os.path.join(gtfs_folder, f, gtfs))
+    gtfs_paths = []
+    for f in sorted(os.listdir(gtfs_folder)):
+        gtfs_paths.extend(folder_feeds(os.path.join(gtfs_folder, f)))
+    results = map_feeds(_rewrite_feed, gtfs_paths, processes=processes)
+    raise_feed_errors(results)
+
+
+def _rewrite_feed(gtfs_path: str):
+    print(" ", gtfs_path)
+    g = load_feed(gtfs_path, ignore_optional_files="all")
+    g.write_zip(gtfs_path)
+    # The file was rewritten, so what was parsed from it is stale
+    clear_feed_cache(gtfs_path)
+
+
+def rewrite_gtfs_zip(
+    gtfs_path: str, output_path: str, rewrites: dict = None, keep: list = None
+):
+    """Copy a GTFS zip, rewriting only some of its tables
+
+    Tables without a rewrite are copied as they are, without decompressing or
+    recompressing them, and rewritten tables are streamed row by row, so even
+    large feeds are never held in memory. Members are written at the top level
+    of the new zip, and files that aren't GTFS tables are left out.
+
+    Parameters
+    ----------
+    gtfs_path : str
+        The path to the GTFS zip file
+    output_path : str
+        The path to write the new zip file to
+    rewrites : dict, optional
+        Functions keyed by table file name (e.g. "calendar.txt"), each called
+        as ``function(header, rows)`` with the stripped column names and an
+        iterator of rows (lists of strings), returning the rows to write. By
+        default None (copy every table)
+    keep : list, optional
+        The table file names to keep, by default None (all GTFS tables)
+    """
+    rewrites = rewrites or {}
+    if keep is None:
+        keep = REQUIRED_FILES + OPTIONAL_FILES
+    # Written next to the output and moved in place once complete
+    partial_path = output_path + ".partial"
+    with zipfile.ZipFile(gtfs_path) as zin, zipfile.ZipFile(
+        partial_path, "w", zipfile.ZIP_DEFLATED
+    ) as zout:
+        for name, info in _gtfs_members(zin).items():
+            if name not in keep:
+                continue
+            if name not in rewrites:
+                _copy_zip_member(zin, zout, info, name)
+                continue
+            header, rows = _read_member_rows(zin, info)
+            with zout.open(
+                name, "w", force_zip64=info.file_size > zipfile.ZIP64_LIMIT
+            ) as outfile:
+                with io.TextIOWrapper(outfile, encoding="utf-8", newline="") as text:
+                    writer = csv.writer(text, lineterminator="\n")
+                    writer.writerow(header)
+                    writer.writerows(rewrites[name](header, rows))
+    os.replace(partial_path, output_path)
+
+
+def drop_rows(excluded: dict):
+    """Make a rewrite (see :func:`rewrite_gtfs_zip`) that drops matching rows
+
+    Parameters
+    ----------
+    excluded : dict
+        Sets of values keyed by column name, a row is dropped if any of these
+        columns has one of the values. Columns the table doesn't have are
+        ignored.
+    """
+
+    def rewrite(header: list, rows):
+        checks = [
+            (header.index(column), values)
+            for column, values in excluded.items()
+            if column in header
+        ]
+        for row in rows:
+            if not any(
+                i < len(row) and row[i].strip() in values for i, values in checks
+            ):
+                yield row
+
+    return rewrite
+
+
+def _gtfs_members(zin: zipfile.ZipFile) -> dict:
+    # GTFS tables keyed by file name, wherever they are nested in the zip
+    members = {}
+    for info in zin.infolist():
+        name = os.path.basename(info.filename)
+        if not info.is_dir() and name in REQUIRED_FILES + OPTIONAL_FILES:
+            members[name] = info
+    return members
+
+
+def _read_member_rows(zin: zipfile.ZipFile, info: zipfile.ZipInfo) -> tuple:
+    # The stripped header and a lazy iterator over the rows of a table
+    text = io.TextIOWrapper(zin.open(info), encoding="utf-8-sig", newline="")
+    reader = csv.reader(text)
+    header = [column.strip() for column in next(reader, [])]
+    return header, (row for row in reader if row)
+
+
+def _copy_zip_member(
+    zin: zipfile.ZipFile, zout: zipfile.ZipFile, info: zipfile.ZipInfo, name: str
+):
+    # Copy the compressed bytes of a member straight across: skip its local
+    # header, then write a new one for the (possibly flattened) name. zipfile
+    # has no public way to do this, so this writes through its fp, filelist,
+    # NameToInfo and start_dir internals, as checked on CPython 3.9 to 3.13.
+    # test_gtfs.py copies members and reads them back to catch changes.
+    zin.fp.seek(info.header_offset)
+    header = zin.fp.read(zipfile.sizeFileHeader)
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    zin.fp.seek(
+        info.header_offset + zipfile.sizeFileHeader + name_length + extra_length
+    )
+    copied = zipfile.ZipInfo(name, info.date_time)
+    copied.compress_type = info.compress_type
+    copied.CRC = info.CRC
+    copied.compress_size = info.compress_size
+    copied.file_size = info.file_size
+    copied.external_attr = info.external_attr
+    # Sizes are known up front, so no data descriptor follows the data
+    copied.flag_bits = info.flag_bits & ~0x08
+    copied.header_offset = zout.fp.tell()
+    zout.fp.write(copied.FileHeader())
+    remaining = info.compress_size
+    while remaining > 0:
+        block = zin.fp.read(min(remaining, ZIP_COPY_BLOCK_SIZE))
+        if not block:
+            raise zipfile.BadZipFile(f"{info.filename} is truncated")
+        zout.fp.write(block)
+        remaining -= len(block)
+    zout.filelist.append(copied)
+    zout.NameToInfo[name] = copied
+    zout.start_dir = zout.fp.tell()
 
 
 def keep_only_feeds_in(gtfs_folder, feed_ids, include_zero=True):
@@ -361,7 +1010,11 @@ def keep_only_feeds_in(gtfs_folder, feed_ids, include_zero=True):
 
 
 def extend_calendar_dates_and_simplify(
-    base_gtfs_folder, output_folder, monday, days_ahead_to_extend
+    base_gtfs_folder,
+    output_folder,
+    monday,
+    days_ahead_to_extend,
+    processes: int = 1,
 ):
     """Extend GTFS files as needed to cover analysis dates.
 
@@ -377,94 +1030,238 @@ def extend_calendar_dates_and_simplify(
         The datetime date of the monday of the run.
     days_ahead_to_extend : int
         The number of days ahead of the folder date to check
+    processes : int, optional
+        The number of worker processes, see :func:`map_feeds`
     """
     print("Extending Calendar Dates and Simplifying")
     min_date = monday
     max_date = min_date + datetime.timedelta(days=days_ahead_to_extend)
     if not os.path.exists(output_folder):
         os.mkdir(output_folder)
-    for feed in os.listdir(base_gtfs_folder):
-        print(" ", feed)
-        gtfs = GTFS.load_zip(
-            os.path.join(base_gtfs_folder, feed),
-            ignore_optional_files="keep_shapes",
-        )
-        summary = gtfs.summary()
-        min_feed_date = datetime.datetime.strptime(
-            summary["first_date"], "%Y%m%d"
-        ).date()
-        max_feed_date = datetime.datetime.strptime(
-            summary["last_date"], "%Y%m%d"
-        ).date()
-        print("    Min:", min_feed_date, "vs what we want which is", min_date)
-        print("    Max:", max_feed_date, "vs what we want which is", max_date)
-        if min_feed_date > min_date:
-            if gtfs.calendar is not None:
-                gtfs.calendar["start_date"] = min_date.strftime("%Y%m%d")
-                print("    Extended", feed, "start date")
-            else:
-                print("    Want to extend minimum, no calendar file")
-        if max_feed_date < max_date:
-            if gtfs.calendar is not None:
-                gtfs.calendar["end_date"] = max_date.strftime("%Y%m%d")
-                print("    Extended", feed, "end date")
-            else:
-                print("    Want to extend maximum, no calendar file")
-        gtfs.write_zip(os.path.join(output_folder, feed))
+    results = map_feeds(
+        _extend_feed_calendar,
+        folder_feeds(base_gtfs_folder),
+        (output_folder, min_date, max_date),
+        processes,
+    )
+    raise_feed_errors(results)
+
+
+def _extend_feed_calendar(
+    gtfs_path: str,
+    output_folder: str,
+    min_date: datetime.date,
+    max_date: datetime.date,
+):
+    feed = os.path.basename(gtfs_path)
+    print(" ", feed)
+    # Only the calendar tables are read, as for GTFS.summary the feed runs
+    # from the first to the last date in either of them
+    with zipfile.ZipFile(gtfs_path) as zin:
+        members = _gtfs_members(zin)
+        calendar = None
+        dates = []
+        if "calendar.txt" in members:
+            header, rows = _read_member_rows(zin, members["calendar.txt"])
+            calendar = [dict(zip(header, row)) for row in rows] or None
+        if calendar is not None:
+            dates.extend(row["start_date"].strip() for row in calendar)
+            dates.extend(row["end_date"].strip() for row in calendar)
+        if "calendar_dates.txt" in members:
+            header, rows = _read_member_rows(zin, members["calendar_dates.txt"])
+            date_index = header.index("date")
+            dates.extend(row[date_index].strip() for row in rows)
+    min_feed_date = datetime.datetime.strptime(min(dates), "%Y%m%d").date()
+    max_feed_date = datetime.datetime.strptime(max(dates), "%Y%m%d").date()
+    print("    Min:", min_feed_date, "vs what we want which is", min_date)
+    print("    Max:", max_feed_date, "vs what we want which is", max_date)
+    extended = {}
+    if min_feed_date > min_date:
+        if calendar is not None:
+            extended["start_date"] = min_date.strftime("%Y%m%d")
+            print("    Extended", feed, "start date")
+        else:
+            print("    Want to extend minimum, no calendar file")
+    if max_feed_date < max_date:
+        if calendar is not None:
+            extended["end_date"] = max_date.strftime("%Y%m%d")
+            print("    Extended", feed, "end date")
+        else:
+            print("    Want to extend maximum, no calendar file")
+
+    def extend_calendar(header: list, rows):
+        indexes = {header.index(column): value for column, value in extended.items()}
+        for row in rows:
+            yield [indexes.get(i, value) for i, value in enumerate(row)]
+
+    rewrite_gtfs_zip(
+        gtfs_path,
+        os.path.join(output_folder, feed),
+        rewrites={"calendar.txt": extend_calendar} if extended else None,
+        keep=SIMPLIFIED_GTFS_FILES,
+    )
 
 
 def stops_in_block_groups(
     gtfs_folder, block_groups: geopandas.GeoDataFrame, date: datetime.date, buffer=400
 ) -> pandas.DataFrame:
+    """Count the unique trips on a date at the stops near each block group
+
+    Parameters
+    ----------
+    gtfs_folder : str
+        The folder of GTFS zip files
+    block_groups : geopandas.GeoDataFrame
+        The block groups with a ``bg_id`` column, in a projected CRS. The frame
+        isn't modified.
+    date : datetime.date
+        The service date
+    buffer : int, optional
+        The distance around each block group to include stops from, by default
+        400
+
+    Returns
+    -------
+    pandas.DataFrame
+        Trip counts of the block groups with any nearby stops, indexed by
+        ``bg_id``, with one column per feed and a ``total_trips`` column
+    """
     # Buffer the block groups to get "nearby" stops
-    block_groups.geometry = block_groups.geometry.buffer(buffer)
-    just_bgs = block_groups[["bg_id"]]
+    index = StopAreaIndex.build(
+        block_groups, "bg_id", get_all_stops(gtfs_folder), buffer
+    )
     columns = []
     datasets = []
-    for filename in os.listdir(gtfs_folder):
-        print(filename)
-        try:
-            gtfs = GTFS.load_zip(os.path.join(gtfs_folder, filename))
-            column_name = os.path.splitext(filename)[0]
-            columns.append(column_name)
-            stops = geopandas.GeoDataFrame(
-                gtfs.stops[["stop_id", "stop_lat", "stop_lon"]],
-                geometry=geopandas.points_from_xy(
-                    gtfs.stops.stop_lon, gtfs.stops.stop_lat
-                ),
-                crs="EPSG:4326",
-            ).to_crs(block_groups.crs)
-            joined = block_groups.sjoin(stops)
-            data = {"bg_id": [], column_name: []}
-            for bg_id in joined.bg_id.unique():
-                # Get the stops in that zone
-                bg_stops = joined[joined.bg_id == bg_id]
-                trips = gtfs.unique_trips_at_stops(
-                    bg_stops.stop_id.tolist(), date
-                ).shape[0]
-                data["bg_id"].append(bg_id)
-                data[column_name].append(trips)
-
-            data = pandas.DataFrame(data)
-            data.set_index("bg_id", inplace=True)
-            datasets.append(data)
-
-        except zipfile.BadZipFile:
-            print(filename, "is not a valid zipfile, skipping...")
+    for agency in index.stops.agency.unique():
+        print(agency)
+        gtfs = load_feed(os.path.join(gtfs_folder, f"{agency}.zip"))
+        agency_index = index.agency(agency)
+        stop_times = gtfs.stop_times[["trip_id", "stop_id"]]
+        stop_times = stop_times[stop_times.trip_id.isin(gtfs.date_trips(date).trip_id)]
+        trips = agency_index.count_unique(stop_times.stop_id, stop_times.trip_id)
+        # Only the block groups the feed has stops near
+        trips = trips[agency_index.stop_counts().to_numpy() > 0]
+        columns.append(agency)
+        datasets.append(trips.rename(agency))
 
     result = pandas.concat(datasets, axis=1, join="outer").fillna(0)
     result["total_trips"] = result[columns].sum(axis=1)
-    all_bgs = just_bgs.join(result, how="left").fillna(0)
     return result
 
 
-def summarize_gtfs_data(gtfs_folder, date: datetime.date) -> pandas.DataFrame:
+def unique_trip_counts_by_area(
+    gtfs: GTFS | FeedTables,
+    stop_areas: pandas.DataFrame | StopAreaIndex,
+    windows: dict,
+    area_column: str,
+    time_field: str = "arrival_time",
+) -> pandas.DataFrame:
+    """Count the unique trips serving each area in each time window
+
+    This gives the same counts as calling ``GTFS.unique_trip_count_at_stops``
+    for every area and window, but ``stop_times`` is filtered once per window
+    and the counts come from a single groupby over all windows.
+
+    Parameters
+    ----------
+    gtfs : GTFS | FeedTables
+        The loaded feed, or its cached tables
+    stop_areas : pandas.DataFrame | StopAreaIndex
+        The stop to area assignment, with a ``stop_id`` column and the area column.
+        A stop can belong to several areas. With the index of the feed's stops
+        the counts are a sparse product and every area of the index is kept.
+    windows : dict
+        The time windows keyed by name (e.g. run key), each a tuple of start and
+        end ``datetime.datetime``. The service date is the date of the start.
+    area_column : str
+        The name of the area id column in ``stop_areas``
+    time_field : str, optional
+        The ``stop_times`` column to filter on, by default "arrival_time"
+
+    Returns
+    -------
+    pandas.DataFrame
+        Unique trip counts indexed by area, with one column per window
+    """
+    if isinstance(gtfs, FeedTables):
+        stop_times = gtfs.table("stop_times", ["trip_id", "stop_id", time_field])
+        frequencies = gtfs.table("frequencies", ["trip_id"])
+    else:
+        stop_times = gtfs.stop_times[["trip_id", "stop_id", time_field]]
+        frequencies = gtfs.frequencies
+    if isinstance(stop_areas, StopAreaIndex):
+        stop_ids = stop_areas.stops.stop_id
+    else:
+        stop_ids = stop_areas.stop_id
+    stop_times = stop_times[
+        stop_times.stop_id.isin(stop_ids) & ~stop_times[time_field].isna()
+    ]
+    # gtfslite inner-joins frequencies, so only those trips count if it exists
+    if frequencies is not None:
+        stop_times = stop_times[stop_times.trip_id.isin(frequencies.trip_id)]
+    if isinstance(gtfs, FeedTables):
+        seconds = stop_times[time_field].astype(int)
+        stop_times = stop_times.astype({"trip_id": str, "stop_id": str})
+    else:
+        seconds = _time_to_seconds(stop_times[time_field])
+
+    date_trips = {}
+    visits = []
+    for window, (start, end) in windows.items():
+        date = start.date()
+        if date not in date_trips:
+            date_trips[date] = gtfs.date_trips(date).trip_id
+        mask = seconds.between(
+            _clock_seconds(start), _clock_seconds(end)
+        ) & stop_times.trip_id.isin(date_trips[date])
+        visits.append(
+            stop_times.loc[mask, ["trip_id", "stop_id"]].assign(window=window)
+        )
+
+    if isinstance(stop_areas, StopAreaIndex):
+        counts = pandas.DataFrame(
+            {
+                window: stop_areas.count_unique(v.stop_id, v.trip_id)
+                for window, v in zip(windows, visits)
+            }
+        )
+        counts.index.name = area_column
+        return counts
+
+    visits = pandas.concat(visits, axis="index")
+    visits = pandas.merge(visits, stop_areas[["stop_id", area_column]], on="stop_id")
+    counts = (
+        visits.groupby([area_column, "window"])["trip_id"]
+        .nunique()
+        .unstack("window", fill_value=0)
+    )
+    return counts.reindex(columns=list(windows), fill_value=0)
+
+
+def _time_to_seconds(times: pandas.Series) -> pandas.Series:
+    # GTFS times are HH:MM:SS and can run past 24:00:00
+    parts = times.str.split(":", expand=True).astype(int)
+    return parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+
+def _clock_seconds(moment: datetime.datetime) -> int:
+    return moment.hour * 3600 + moment.minute * 60 + moment.second
+
+
+def summarize_gtfs_data(
+    gtfs_folder, date: datetime.date, cache_folder: str = None, processes: int = 1
+) -> pandas.DataFrame:
     """Summarize all GTFS data in a given folder
 
     Parameters
     ----------
     gtfs_folder : str or os.path
         The path to the folder to summarize
+    cache_folder : str, optional
+        The folder of cached feed tables (see :class:`FeedTables`), by default
+        None (parse the zip files)
+    processes : int, optional
+        The number of worker processes, see :func:`map_feeds`
 
     Returns
     -------
@@ -472,20 +1269,25 @@ def summarize_gtfs_data(gtfs_folder, date: datetime.date) -> pandas.DataFrame:
         A dataframe containing the results for each feed in the folder as
         generated by GTFS lite
     """
-    summaries = []
-    for filename in os.listdir(gtfs_folder):
-        print("Summarizing", filename)
-        try:
-            gtfs = GTFS.load_zip(os.path.join(gtfs_folder, filename))
-            summary = gtfs.summary()
-            summary["service_hours"] = gtfs.service_hours(date=date)
-            summary["file"] = os.path.splitext(filename)[0]
-            summaries.append(summary)
+    results = map_feeds(
+        _feed_summary, folder_feeds(gtfs_folder), (date, cache_folder), processes
+    )
+    return pandas.DataFrame([r.result for r in results if r.error is None])
 
-        except zipfile.BadZipFile:
-            print(filename, "is not a valid zipfile, skipping...")
 
-    return pandas.DataFrame(summaries)
+def _feed_summary(
+    gtfs_path: str, date: datetime.date, cache_folder: str
+) -> pandas.Series:
+    filename = os.path.basename(gtfs_path)
+    print("Summarizing", filename)
+    if cache_folder is not None:
+        gtfs = FeedTables(gtfs_path, cache_folder)
+    else:
+        gtfs = load_feed(gtfs_path)
+    summary = gtfs.summary()
+    summary["service_hours"] = gtfs.service_hours(date=date)
+    summary["file"] = os.path.splitext(filename)[0]
+    return summary
 
 
 def match_with_mobility_database(
@@ -610,7 +1412,7 @@ def compute_transit_service_intensity(
 ) -> pandas.DataFrame:
     for filename in os.listdir(gtfs_folder):
         try:
-            gtfs = GTFS.load_zip(os.path.join(gtfs_folder, filename))
+            gtfs = load_feed(os.path.join(gtfs_folder, filename))
             # Let's now load the block goups
             # Get a set of stops we need to "batch"
             # Get unique trips for each stop
@@ -0,0 +1,533 @@
+"""Travel time matrix computation and storage
+
+Large matrices can be computed in shards of origins. Each shard is written as a
+Parquet part file inside a ``<name>.parquet`` folder together with a manifest,
+so a crash only loses the shard in progress and a restart computes only the
+missing shards. Parquet readers (``pandas.read_parquet``, ``traccess``) treat the
+folder as a single dataset, so downstream code does not need to change.
+
+Matrices can also be loaded as a dense :class:`CostMatrix`, which maps zone ids
+to integer positions once so consumers can index arrays instead of merging long
+frames on string ids. Dense matrices are saved next to their Parquet files as a
+matrix store: the raw values in ``<name>.npy`` and the zone ids and run metadata
+in ``<name>.index.json``. Reading a store memory-maps the values, so nothing has
+to be decoded and pages are only read from disk as they are used."""
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy
+import pandas
+from r5py import TravelTimeMatrixComputer
+
+#: The name of the manifest inside a sharded matrix folder. The leading
+#: underscore keeps Parquet dataset readers from treating it as data.
+MANIFEST_FILENAME = "_manifest.json"
+#: The file name template for the part files of a sharded matrix
+PART_TEMPLATE = "part-{:05d}.parquet"
+#: The value stored for missing or unreachable pairs in integer cost matrices
+UNREACHABLE = numpy.iinfo(numpy.uint16).max
+#: The suffix of the values file of a matrix store
+STORE_SUFFIX = ".npy"
+#: The suffix of the index file of a matrix store
+STORE_INDEX_SUFFIX = ".index.json"
+
+
+def compute_sharded_matrix(
+    network,
+    centroids: pandas.DataFrame,
+    output_path: str,
+    shard_size: int,
+    network_key: str = None,
+    **computer_settings,
+):
+    """Compute a travel time matrix in shards of origins, resuming if possible
+
+    Shards are only reused if the origins, shard size, settings and network are
+    the same as when they were computed.
+
+    Parameters
+    ----------
+    network : r5py.TransportNetwork
+        The transport network to route on
+    centroids : geopandas.GeoDataFrame
+        The origins and destinations, with an ``id`` column
+    output_path : str
+        The matrix folder to write, e.g. ``.../WEDAM/full_matrix.parquet``
+    shard_size : int
+        The maximum number of origins per shard
+    network_key : str, optional
+        The key of the network's inputs (see :func:`ted.network.network_key`),
+        by default None. Without it, shards computed on a network built from
+        other OSM or GTFS files would be reused.
+    **computer_settings
+        Keyword arguments passed on to ``r5py.TravelTimeMatrixComputer``
+    """
+    centroids = centroids.sort_values("id").reset_index(drop=True)
+    shard_count = -(-centroids.shape[0] // shard_size)
+    signature = _matrix_signature(centroids, shard_size, network_key, computer_settings)
+
+    if os.path.isfile(output_path):
+        print("    Replacing the unsharded matrix with a sharded one")
+        os.remove(output_path)
+    os.makedirs(output_path, exist_ok=True)
+    manifest = read_manifest(output_path)
+    if manifest is None or manifest["signature"] != signature:
+        if manifest is not None:
+            print("    Matrix inputs changed, discarding existing shards")
+            for shard in manifest["complete"]:
+                _remove_if_exists(
+                    os.path.join(output_path, PART_TEMPLATE.format(shard))
+                )
+        manifest = {
+            "signature": signature,
+            "shard_size": shard_size,
+            "shards": shard_count,
+            "origins": centroids.shape[0],
+            "complete": [],
+        }
+        _write_manifest(output_path, manifest)
+
+    complete = set(manifest["complete"])
+    print(f"    {len(complete)} of {shard_count} shards already computed")
+    for shard in range(shard_count):
+        part_path = os.path.join(output_path, PART_TEMPLATE.format(shard))
+        if shard in complete and os.path.exists(part_path):
+            continue
+        print(f"    Computing shard {shard + 1} of {shard_count}")
+        origins = centroids.iloc[shard * shard_size : (shard + 1) * shard_size]
+        computer = TravelTimeMatrixComputer(
+            network,
+            origins=origins,
+            destinations=centroids,
+            **computer_settings,
+        )
+        mx = computer.compute_travel_times()
+        # Dot-prefixed while being written so readers skip partial parts
+        partial_path = os.path.join(output_path, "." + PART_TEMPLATE.format(shard))
+        mx.to_parquet(partial_path, index=False)
+        os.replace(partial_path, part_path)
+
+        complete.add(shard)
+        manifest["complete"] = sorted(complete)
+        _write_manifest(output_path, manifest)
+
+
+def read_manifest(matrix_path: str) -> dict:
+    """Read the manifest of a sharded matrix
+
+    Parameters
+    ----------
+    matrix_path : str
+        The matrix folder
+
+    Returns
+    -------
+    dict
+        The manifest, or None if the matrix is not sharded or not started
+    """
+    manifest_path = os.path.join(matrix_path, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as infile:
+        return json.load(infile)
+
+
+def write_matrix(mx: pandas.DataFrame, output_path: str):
+    """Write an unsharded matrix, replacing a sharded one at the same path
+
+    The matrix is written under a temporary name and moved in place, so readers
+    see either the old or the new matrix.
+
+    Parameters
+    ----------
+    mx : pandas.DataFrame
+        The matrix in the long layout
+    output_path : str
+        The matrix file to write, e.g. ``.../WEDAM/full_matrix.parquet``
+    """
+    partial_path = output_path + ".partial"
+    mx.to_parquet(partial_path)
+    if os.path.isdir(output_path):
+        print("    Replacing the sharded matrix with an unsharded one")
+        old_path = output_path + ".old"
+        shutil.rmtree(old_path, ignore_errors=True)
+        os.replace(output_path, old_path)
+        os.replace(partial_path, output_path)
+        shutil.rmtree(old_path)
+    else:
+        os.replace(partial_path, output_path)
+
+
+def is_matrix_complete(matrix_path: str) -> bool:
+    """Check whether a (sharded or single file) matrix has been fully written
+
+    Parameters
+    ----------
+    matrix_path : str
+        The path to the matrix parquet file or folder
+
+    Returns
+    -------
+    bool
+        True if every shard of the matrix exists
+    """
+    if os.path.isfile(matrix_path):
+        return True
+    manifest = read_manifest(matrix_path)
+    if manifest is None:
+        return False
+    return len(manifest["complete"]) == manifest["shards"]
+
+
+class CostMatrix:
+    """A dense origin by destination cost matrix
+
+    Zone ids (DAUID, BG20, ...) are mapped to the positions ``0..n-1`` once and
+    the costs are held in an ``n x n`` array, so row ``i`` / column ``j`` is the
+    cost from ``ids[i]`` to ``ids[j]``. Travel times in whole minutes are stored
+    as ``uint16`` with :data:`UNREACHABLE` for missing pairs, other costs (fares,
+    auto times) as floats with NaN for missing pairs.
+
+    Parameters
+    ----------
+    ids : list-like
+        The zone ids, in matrix order
+    values : numpy.ndarray
+        The ``len(ids) x len(ids)`` cost array
+    name : str, optional
+        The name of the cost column in the long layout, by default "travel_time"
+    metadata : dict, optional
+        Information about how the matrix was made, kept in its matrix store
+    """
+
+    def __init__(
+        self,
+        ids,
+        values: numpy.ndarray,
+        name: str = "travel_time",
+        metadata: dict = None,
+    ):
+        self.ids = pandas.Index(ids, name="id")
+        if values.shape != (len(self.ids), len(self.ids)):
+            raise ValueError(
+                f"A matrix of {len(self.ids)} ids needs {len(self.ids)}x"
+                f"{len(self.ids)} values, got {values.shape}"
+            )
+        self.values = values
+        self.name = name
+        self.metadata = {} if metadata is None else metadata
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __repr__(self) -> str:
+        return f"<CostMatrix {self.name} {len(self)}x{len(self)} {self.values.dtype}>"
+
+    @property
+    def missing(self):
+        """The value stored for missing pairs"""
+        return _missing_value(self.values.dtype)
+
+    @classmethod
+    def from_frame(
+        cls,
+        df: pandas.DataFrame,
+        cost_column: str = "travel_time",
+        from_id: str = "from_id",
+        to_id: str = "to_id",
+        ids=None,
+        dtype=numpy.float32,
+    ) -> "CostMatrix":
+        """Build a dense matrix from a long-format cost frame
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+            The long-format matrix, one row per origin-destination pair
+        cost_column : str, optional
+            The cost column, by default "travel_time"
+        from_id : str, optional
+            The origin column, by default "from_id"
+        to_id : str, optional
+            The destination column, by default "to_id"
+        ids : list-like, optional
+            The zone ids to index by, by default every origin and destination in
+            sorted order. Pairs with ids outside of these are dropped.
+        dtype : optional
+            The dtype of the values, by default ``numpy.float32``. Integer dtypes
+            round the costs to the nearest whole number.
+
+        Returns
+        -------
+        CostMatrix
+            The dense matrix, with missing pairs set to :attr:`missing`
+        """
+        if ids is None:
+            ids = pandas.Index(df[from_id].unique()).union(
+                pandas.Index(df[to_id].unique())
+            )
+        ids = pandas.Index(ids)
+        rows = ids.get_indexer(df[from_id])
+        columns = ids.get_indexer(df[to_id])
+        costs = df[cost_column].to_numpy(dtype=float)
+
+        dtype = numpy.dtype(dtype)
+        keep = (rows >= 0) & (columns >= 0) & ~numpy.isnan(costs)
+        costs = costs[keep]
+        if numpy.issubdtype(dtype, numpy.integer):
+            costs = numpy.rint(costs)
+            if costs.size > 0 and (costs.min() < 0 or costs.max() >= UNREACHABLE):
+                raise ValueError(
+                    f"{cost_column} does not fit in {dtype}, use a float dtype"
+                )
+        values = numpy.full((len(ids), len(ids)), _missing_value(dtype), dtype=dtype)
+        values[rows[keep], columns[keep]] = costs
+        return cls(ids, values, name=cost_column)
+
+    @classmethod
+    def from_parquet(
+        cls,
+        path: str,
+        cost_column: str = "travel_time",
+        from_id: str = "from_id",
+        to_id: str = "to_id",
+        ids=None,
+        dtype=numpy.float32,
+    ) -> "CostMatrix":
+        """Read a dense matrix from a long-format Parquet file or sharded folder
+
+        Only the id and cost columns are read. See :meth:`from_frame` for the
+        parameters.
+        """
+        df = pandas.read_parquet(path, columns=[from_id, to_id, cost_column])
+        return cls.from_frame(df, cost_column, from_id, to_id, ids=ids, dtype=dtype)
+
+    def to_frame(self, from_id: str = "from_id", to_id: str = "to_id", dropna=True):
+        """Convert to the long layout used by the Parquet matrices
+
+        Parameters
+        ----------
+        from_id : str, optional
+            The origin column, by default "from_id"
+        to_id : str, optional
+            The destination column, by default "to_id"
+        dropna : bool, optional
+            Whether to leave out missing pairs, by default True
+
+        Returns
+        -------
+        pandas.DataFrame
+            One row per origin-destination pair, ordered by origin then
+            destination, with the costs as floats
+        """
+        positions = numpy.arange(len(self))
+        rows = numpy.repeat(positions, len(self))
+        columns = numpy.tile(positions, len(self))
+        costs = self.as_float().ravel()
+        if dropna:
+            keep = ~numpy.isnan(costs)
+            rows, columns, costs = rows[keep], columns[keep], costs[keep]
+        ids = self.ids.to_numpy()
+        return pandas.DataFrame(
+            {from_id: ids[rows], to_id: ids[columns], self.name: costs}
+        )
+
+    def to_parquet(self, path: str, **kwargs):
+        """Write the matrix in the long Parquet layout
+
+        Missing pairs are left out. Keyword arguments are passed to
+        :meth:`to_frame`.
+        """
+        self.to_frame(**kwargs).to_parquet(path, index=False)
+
+    def as_float(self) -> numpy.ndarray:
+        """Get the costs as floats, with NaN for missing pairs
+
+        Float matrices are returned as-is (not copied).
+        """
+        if numpy.issubdtype(self.values.dtype, numpy.floating):
+            return self.values
+        values = self.values.astype(numpy.float32)
+        values[self.values == self.missing] = numpy.nan
+        return values
+
+    def positions(self, ids) -> numpy.ndarray:
+        """Get the matrix positions of zone ids
+
+        Raises
+        ------
+        KeyError
+            If any of the ids are not in the matrix
+        """
+        positions = self.ids.get_indexer(ids)
+        if (positions < 0).any():
+            missing = pandas.Index(ids)[positions < 0]
+            raise KeyError(f"{len(missing)} ids are not in the matrix: {missing[:5]}")
+        return positions
+
+    def reindex(self, ids) -> "CostMatrix":
+        """Get the matrix for another set of zone ids
+
+        Ids that are not in this matrix get missing costs, so two matrices can be
+        aligned on the same ids and compared element-wise.
+        """
+        ids = pandas.Index(ids)
+        if ids.equals(self.ids):
+            return self
+        positions = self.ids.get_indexer(ids)
+        found = positions >= 0
+        values = numpy.full((len(ids), len(ids)), self.missing, self.values.dtype)
+        values[numpy.ix_(found, found)] = self.values[
+            numpy.ix_(positions[found], positions[found])
+        ]
+        return CostMatrix(ids, values, name=self.name, metadata=self.metadata)
+
+
+def save_matrix_store(matrix: CostMatrix, path: str):
+    """Save a dense matrix as a matrix store
+
+    Parameters
+    ----------
+    matrix : CostMatrix
+        The matrix to save
+    path : str
+        The path of the store without a suffix, e.g. ``.../full_matrix``. A
+        trailing ``.parquet`` is dropped, so a store can be saved next to a
+        Parquet matrix by giving the matrix path.
+    """
+    path = _store_path(path)
+    # The index is written last, so a store without one is incomplete
+    _remove_if_exists(path + STORE_INDEX_SUFFIX)
+    with open(path + STORE_SUFFIX + ".partial", "wb") as outfile:
+        numpy.save(outfile, numpy.ascontiguousarray(matrix.values))
+    os.replace(path + STORE_SUFFIX + ".partial", path + STORE_SUFFIX)
+    index = {
+        "name": matrix.name,
+        "dtype": matrix.values.dtype.str,
+        # Ids keep their dtype, so they match the Parquet matrix and the areas
+        "ids": matrix.ids.tolist(),
+        "id_dtype": str(matrix.ids.dtype),
+        "metadata": matrix.metadata,
+    }
+    with open(path + STORE_INDEX_SUFFIX + ".partial", "w") as outfile:
+        json.dump(index, outfile, default=str)
+    os.replace(path + STORE_INDEX_SUFFIX + ".partial", path + STORE_INDEX_SUFFIX)
+
+
+def open_matrix_store(path: str, mmap_mode: str = "r") -> CostMatrix:
+    """Open a matrix store
+
+    Parameters
+    ----------
+    path : str
+        The path of the store without a suffix (or of its Parquet matrix)
+    mmap_mode : str, optional
+        How to memory-map the values, by default "r" (read-only). Use None to
+        read them into memory.
+
+    Returns
+    -------
+    CostMatrix
+        The matrix, backed by the memory-mapped values
+    """
+    path = _store_path(path)
+    with open(path + STORE_INDEX_SUFFIX) as infile:
+        index = json.load(infile)
+    values = numpy.load(path + STORE_SUFFIX, mmap_mode=mmap_mode)
+    ids = pandas.Index(index["ids"], dtype=index.get("id_dtype"))
+    return CostMatrix(ids, values, name=index["name"], metadata=index["metadata"])
+
+
+def has_matrix_store(path: str) -> bool:
+    """Check whether a complete matrix store exists
+
+    Parameters
+    ----------
+    path : str
+        The path of the store without a suffix (or of its Parquet matrix)
+    """
+    path = _store_path(path)
+    return os.path.exists(path + STORE_INDEX_SUFFIX) and os.path.exists(
+        path + STORE_SUFFIX
+    )
+
+
+def remove_matrix_store(path: str):
+    """Remove a matrix store, if there is one
+
+    Parameters
+    ----------
+    path : str
+        The path of the store without a suffix (or of its Parquet matrix)
+    """
+    path = _store_path(path)
+    _remove_if_exists(path + STORE_INDEX_SUFFIX)
+    _remove_if_exists(path + STORE_SUFFIX)
+
+
+def read_cost_matrix(
+    matrix_path: str, cost_column: str = "travel_time", dtype=numpy.float32
+) -> CostMatrix:
+    """Read a matrix, from its matrix store if it has one
+
+    Parameters
+    ----------
+    matrix_path : str
+        The path to the Parquet matrix (file or sharded folder)
+    cost_column : str, optional
+        The cost column when reading Parquet, by default "travel_time"
+    dtype : optional
+        The dtype when reading Parquet, by default ``numpy.float32``. Stores keep
+        the dtype they were saved with.
+
+    Returns
+    -------
+    CostMatrix
+        The matrix
+    """
+    if has_matrix_store(matrix_path):
+        return open_matrix_store(matrix_path)
+    return CostMatrix.from_parquet(matrix_path, cost_column=cost_column, dtype=dtype)
+
+
+def _store_path(path: str) -> str:
+    path = path.rstrip(os.sep)
+    if path.endswith(".parquet"):
+        path = path[: -len(".parquet")]
+    return path
+
+
+def _missing_value(dtype):
+    if numpy.issubdtype(dtype, numpy.integer):
+        return UNREACHABLE
+    return numpy.nan
+
+
+def _matrix_signature(
+    centroids: pandas.DataFrame,
+    shard_size: int,
+    network_key: str,
+    computer_settings: dict,
+) -> str:
+    sha = hashlib.sha1(str(network_key).encode())
+    for origin_id in centroids["id"].astype(str):
+        sha.update(origin_id.encode())
+        sha.update(b"\0")
+    sha.update(str(shard_size).encode())
+    sha.update(json.dumps(computer_settings, sort_keys=True, default=str).encode())
+    return sha.hexdigest()
+
+
+def _write_manifest(matrix_path: str, manifest: dict):
+    manifest_path = os.path.join(matrix_path, MANIFEST_FILENAME)
+    with open(manifest_path + ".partial", "w") as outfile:
+        json.dump(manifest, outfile, indent=2)
+    os.replace(manifest_path + ".partial", manifest_path)
+
+
+def _remove_if_exists(path: str):
+    if os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,81 @@
+"""Reuse of R5 transport networks
+
+Building an R5 transport network from a regional OSM extract and a folder of
+GTFS feeds takes minutes, and the same inputs get built again for every matrix,
+region, and weekly run. Networks here are keyed by a hash of the OSM file and
+the sorted hashes of the GTFS zips, and built networks stay warm in-process.
+
+Across runs, r5py (1.0 and later) already serializes every network it builds
+into its own cache folder, keyed by a digest of the inputs, and loads it from
+there the next time the same inputs are given, so networks are not persisted
+again here."""
+
+import collections
+import hashlib
+
+from r5py import TransportNetwork
+
+from .cache import file_hash
+
+#: The number of networks to keep warm in-process (full + limited)
+MAX_WARM_NETWORKS = 2
+
+# Warm networks keyed by network key, least recently used first
+_networks = collections.OrderedDict()
+
+
+def network_key(osm_pbf: str, gtfs_files: list[str]) -> str:
+    """Get the cache key for a network built from a set of inputs
+
+    The key does not depend on file names or the order of the GTFS files, only
+    on their contents.
+
+    Parameters
+    ----------
+    osm_pbf : str
+        The path to the OSM extract
+    gtfs_files : list[str]
+        The paths to the GTFS zip files
+
+    Returns
+    -------
+    str
+        The hex digest identifying the network
+    """
+    sha = hashlib.sha1(file_hash(osm_pbf).encode())
+    for gtfs_hash in sorted(file_hash(f) for f in gtfs_files):
+        sha.update(gtfs_hash.encode())
+    return sha.hexdigest()
+
+
+def get_transport_network(osm_pbf: str, gtfs_files: list[str]) -> TransportNetwork:
+    """Get a transport network, reusing one already built in this process
+
+    Networks that are not warm are created through r5py, which loads them from
+    its own disk cache when it has built the same inputs before.
+
+    Parameters
+    ----------
+    osm_pbf : str
+        The path to the OSM extract
+    gtfs_files : list[str]
+        The paths to the GTFS zip files
+
+    Returns
+    -------
+    r5py.TransportNetwork
+        The transport network for the inputs
+    """
+    gtfs_files = sorted(gtfs_files)
+    key = network_key(osm_pbf, gtfs_files)
+    if key in _networks:
+        print("   reusing transport network", key[:12])
+        _networks.move_to_end(key)
+        return _networks[key]
+
+    print("   building transport network")
+    network = TransportNetwork(osm_pbf=osm_pbf, gtfs=gtfs_files)
+    _networks[key] = network
+    while len(_networks) > MAX_WARM_NETWORKS:
+        _networks.popitem(last=False)
+    return network
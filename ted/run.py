@@ -1,21 +1,39 @@
 """Methods for setting up the data and folder structure for an analysis"""
 
+import collections
+import concurrent.futures
 import os
 import datetime
+import multiprocessing
 import shutil
 import sys
 
 import geopandas as gpd
+import numpy
 import pandas
 from pygris import block_groups
-from r5py import TravelTimeMatrixComputer, TransportNetwork
+from r5py import TravelTimeMatrixComputer
 import yaml
 
-from gtfslite import GTFS
 import traccess
 
+from .access import (
+    cost_to_closest,
+    cumulative_cutoffs,
+    fare_constrained_cutoffs,
+)
 from .exception import NotAMondayError
-from .gtfs import get_all_stops
+from .gtfs import FeedTables, get_stop_area_index, unique_trip_counts_by_area
+from .matrix import (
+    CostMatrix,
+    compute_sharded_matrix,
+    is_matrix_complete,
+    read_cost_matrix,
+    remove_matrix_store,
+    save_matrix_store,
+    write_matrix,
+)
+from .network import get_transport_network, network_key
 
 #: The number of days since Monday to count as a weekend (Saturday = 5, Sunday = 6)
 WEEKEND_DELTA = 5
@@ -27,6 +45,24 @@ BGNAME = "BG20"
 LIMITED_TAG = "limited"
 #: Size of the Transit Service Intensity buffer to use (meters)
 TSI_BUFFER_SIZE = 402.336
+#: The default folder (within the output folder) for cached GTFS feed tables
+FEED_CACHE_FOLDER = "_feeds"
+#: The folder (within the output folder) for cached stop area indexes
+STOP_AREA_CACHE_FOLDER = "_stop_areas"
+#: The supply columns measured within each cumulative cutoff (minutes)
+ACCESS_CUTOFFS = {
+    15: ["acres"],
+    30: ["C000", "acres"],
+    45: ["C000"],
+    60: ["C000"],
+    90: ["C000"],
+}
+#: Rough peak memory use of each kind of step (GB), used for the memory budget
+TASK_MEMORY_GB = {"matrix": 12.0, "tsi": 4.0, "access": 6.0, "equity": 1.0}
+
+#: A step of an analysis: a Run method to call with its arguments, and the keys
+#: of the tasks that must finish first
+Task = collections.namedtuple("Task", ["key", "method", "args", "depends_on"])
 
 
 class Run:
@@ -37,12 +73,26 @@ class Run:
         output_folder: str,
         week_of: datetime.date,
         regions: dict,
+        feed_cache: str = None,
+        matrix_shard_size: int = None,
+        workers: int = None,
+        memory_budget: float = None,
+        feed_processes: int = None,
     ):
         self.run_id = run_id
         self.description = description
         self.output_folder = output_folder
         self.week_of = week_of
         self.regions = regions
+        if feed_cache is None:
+            feed_cache = os.path.join(self.output_folder, FEED_CACHE_FOLDER)
+        self.feed_cache = feed_cache
+        self.stop_area_cache = os.path.join(self.output_folder, STOP_AREA_CACHE_FOLDER)
+        self.matrix_shard_size = matrix_shard_size
+        self.workers = workers
+        self.memory_budget = memory_budget
+        # Per-feed GTFS work runs in this process unless asked otherwise
+        self.feed_processes = 1 if feed_processes is None else feed_processes
 
         self.base_folder = os.path.join(self.output_folder, self.run_id)
         # Create the run folder if it doesn't exist
@@ -58,535 +108,426 @@ class Run:
             output_folder=c["output_folder"],
             week_of=c["week_of"].strftime("%Y-%m-%d"),
             regions=c["regions"],
+            feed_cache=c.get("feed_cache"),
+            matrix_shard_size=c.get("matrix_shard_size"),
+            workers=c.get("workers"),
+            memory_budget=c.get("memory_budget"),
+            feed_processes=c.get("feed_processes"),
         )
 
-    def run_regions(self):
-        """Run all regions and runs for the specified analysis."""
-        for region_key, region in self.regions.items():
-            with open(region["config"]) as infile:
-                region_config = yaml.safe_load(infile)
-
-            print(f"Running {region_config['name']} for {self.week_of}")
+    def run_regions(self, workers: int = None, memory_budget: float = None):
+        """Run all regions and runs for the specified analysis.
+
+        Each step (matrices, TSI, access, equity) is a node in a dependency graph
+        so independent regions and runs can be computed at the same time.
+
+        Parameters
+        ----------
+        workers : int, optional
+            The number of worker processes, by default the ``workers`` setting of
+            the run YAML, or 1 (run every step in this process, in order)
+        memory_budget : float, optional
+            The approximate memory available to concurrently running steps, in
+            GB, by default the ``memory_budget`` setting of the run YAML, or no
+            limit
+        """
+        if workers is None:
+            workers = self.workers
+        if memory_budget is None:
+            memory_budget = self.memory_budget
+        tasks = self.build_task_graph()
+        if workers is None or workers <= 1:
+            for task in tasks.values():
+                _run_task(self, task)
+        else:
+            run_task_graph(self, tasks, workers, memory_budget)
 
-            # Create a folder for the region if it doesn't exist
-            region_folder = os.path.join(self.base_folder, region_key)
-            create_folder_safely(region_folder)
+    def build_task_graph(self) -> dict:
+        """Build the graph of steps to run for every region
 
-            # First let's open up the region configuration
-            with open(region["config"]) as infile:
-                region_config = yaml.safe_load(infile)
+        Matrices feed access, and both access and TSI feed equity. Steps that
+        are not enabled for a region are left out, and their outputs are
+        expected to exist already.
 
-            if region["full_matrix"]:
-                # Read in the centroids for the region
-                centroids = gpd.read_file(
-                    region_config["gpkg"], layer=region_config["centroids_layer"]
-                )
-                centroids.rename(columns={BGNAME: "id"}, inplace=True)
-                print(f"  Running full network")
-                gtfs_folder = os.path.join(region_config["gtfs"], "full", self.week_of)
-                self.run_matrix(
-                    region_config,
-                    centroids,
-                    gtfs_folder,
-                    region_folder,
-                    region["runs"],
-                    "full_matrix",
-                )
-            if region["limited_matrix"]:
-                centroids = gpd.read_file(
-                    region_config["gpkg"], layer=region_config["centroids_layer"]
-                )
-                centroids.rename(columns={BGNAME: "id"}, inplace=True)
-                print(f"  Running limited network")
-                gtfs_folder = os.path.join(
-                    region_config["gtfs"], LIMITED_TAG, f"{self.week_of}-{LIMITED_TAG}"
-                )
-                self.run_matrix(
-                    region_config,
-                    centroids,
-                    gtfs_folder,
-                    region_folder,
-                    region["runs"],
-                    f"{LIMITED_TAG}_matrix",
-                )
+        Returns
+        -------
+        dict
+            The tasks keyed by task key, in an order that respects dependencies
+        """
+        tasks = {}
+        for region_key, region in self.regions.items():
+            # Created here, before any of the region's tasks run at once
+            self.region_folder(region_key)
+            matrix_keys = []
+            for kind in ["full", LIMITED_TAG]:
+                if region[f"{kind}_matrix"]:
+                    key = ("matrix", region_key, kind)
+                    tasks[key] = Task(key, "run_region_matrix", (region_key, kind), [])
+                    matrix_keys.append(key)
+            tsi_keys = []
             if region["tsi"]:
-                print("Computing Transit Service Intensity")
-                # Need to get the shapes
-                areas = gpd.read_file(
-                    region_config["gpkg"], layer=region_config["areas_layer"]
-                )
-                print(areas.crs)
-                areas.geometry = areas.geometry.buffer(TSI_BUFFER_SIZE)
-                runs = []
-                for run_key, run in region["runs"].items():
-                    areas[run_key] = 0
-                    runs.append(run_key)
-                # Now we get the stops in the region
-                gtfs_folder = os.path.join(region_config["gtfs"], "full", self.week_of)
-                all_stops = get_all_stops(gtfs_folder).to_crs(areas.crs)
-                all_stops.to_file(
-                    f"{region_config['code']}-allstops.gpkg", layer="all_stops"
-                )
-                print("Wrote file")
-                print("Starting TSI computation")
-                for agency in all_stops.agency.unique():
-                    print("  Computing for", agency)
-                    # Load the zipfile
-                    agency_stops = all_stops[all_stops.agency == agency].copy()
-                    gtfs = GTFS.load_zip(os.path.join(gtfs_folder, f"{agency}.zip"))
-                    # Compute the spatial intersection
-                    joined = gpd.sjoin(
-                        left_df=agency_stops[["stop_id", "geometry"]],
-                        right_df=areas[[BGNAME, "geometry"]],
+                key = ("tsi", region_key)
+                tasks[key] = Task(key, "run_tsi", (region_key,), [])
+                tsi_keys.append(key)
+            for run_key in region["runs"]:
+                access_keys = []
+                if region["access"]:
+                    key = ("access", region_key, run_key)
+                    tasks[key] = Task(
+                        key, "run_access", (region_key, run_key), matrix_keys
                     )
-                    stops_per_bg = (
-                        joined[["BG20", "stop_id"]]
-                        .groupby("BG20", as_index=False)
-                        .count()
+                    access_keys.append(key)
+                if region["equity"]:
+                    key = ("equity", region_key, run_key)
+                    tasks[key] = Task(
+                        key,
+                        "run_equity",
+                        (region_key, run_key),
+                        access_keys + tsi_keys,
                     )
-                    stops_per_bg.to_csv(f"{region_config['code']}-{agency}.csv")
-                    print("Wrote stops per bg for", agency)
-                    # Let's get the TSI
-                    for bg in joined.BG20.unique():
-                        # print("  Checking", bg)
-                        stops = joined[joined.BG20 == bg]["stop_id"].tolist()
-                        # print(f"  {bg}: Found", len(stops), "stops.")
-                        for run_key, run in region["runs"].items():
-                            # print("    Checking on", run_key)
-                            start_time = run
-                            end_time = start_time + datetime.timedelta(hours=2)
-                            tsi = gtfs.unique_trip_count_at_stops(
-                                stops,
-                                date=start_time.date(),
-                                start_time=start_time.strftime("%H:%M:%S"),
-                                end_time=end_time.strftime("%H:%M:%S"),
-                            )
-                            areas.loc[areas.BG20 == bg, run_key] += tsi
-                # Finish off by joining in items
-                runs.append(BGNAME)
-                out = areas[runs].set_index(BGNAME)
-                out.to_csv(os.path.join(region_folder, "tsi.csv"))
-                #     df.to_csv(os.path.join(run_folder, "tsi.csv"), index=False)
-            if region["access"]:
-                print("Computing access metrics")
-                # Compute access metrics
-                supply = traccess.Supply.from_csv(
-                    region_config["supply"], dtype={"BG20": str}, id_column="BG20"
+        return tasks
+
+    def region_config(self, region_key: str) -> dict:
+        """Load the configuration YAML for a region"""
+        with open(self.regions[region_key]["config"]) as infile:
+            return yaml.safe_load(infile)
+
+    def region_folder(self, region_key: str) -> str:
+        """Get the output folder for a region, creating it if needed"""
+        region_folder = os.path.join(self.base_folder, region_key)
+        create_folder_safely(region_folder)
+        return region_folder
+
+    def run_region_matrix(self, region_key: str, kind: str):
+        """Compute the full or limited travel time matrices for a region
+
+        Parameters
+        ----------
+        region_key : str
+            The region key
+        kind : str
+            Either ``"full"`` or the limited tag
+        """
+        region = self.regions[region_key]
+        region_config = self.region_config(region_key)
+        region_folder = self.region_folder(region_key)
+        print(f"Running {region_config['name']} for {self.week_of}")
+
+        # Read in the centroids for the region
+        centroids = gpd.read_file(
+            region_config["gpkg"], layer=region_config["centroids_layer"]
+        )
+        centroids.rename(columns={BGNAME: "id"}, inplace=True)
+        if kind == LIMITED_TAG:
+            print(f"  Running limited network")
+            gtfs_folder = os.path.join(
+                region_config["gtfs"], LIMITED_TAG, f"{self.week_of}-{LIMITED_TAG}"
+            )
+        else:
+            print(f"  Running full network")
+            gtfs_folder = os.path.join(region_config["gtfs"], "full", self.week_of)
+        self.run_matrix(
+            region_config,
+            centroids,
+            gtfs_folder,
+            region_folder,
+            region["runs"],
+            f"{kind}_matrix",
+        )
+
+    def run_tsi(self, region_key: str):
+        """Compute the Transit Service Intensity of every area for all runs"""
+        region = self.regions[region_key]
+        region_config = self.region_config(region_key)
+        region_folder = self.region_folder(region_key)
+
+        print("Computing Transit Service Intensity")
+        # Only the area ids are needed here, the index has the shapes
+        areas = gpd.read_file(
+            region_config["gpkg"],
+            layer=region_config["areas_layer"],
+            ignore_geometry=True,
+        )
+        runs = []
+        windows = {}
+        for run_key, run in region["runs"].items():
+            areas[run_key] = 0
+            runs.append(run_key)
+            windows[run_key] = (run, run + datetime.timedelta(hours=2))
+        # Now we get the stops near every area in the region
+        gtfs_folder = os.path.join(region_config["gtfs"], "full", self.week_of)
+        index = get_stop_area_index(
+            region_config["gpkg"],
+            region_config["areas_layer"],
+            BGNAME,
+            gtfs_folder,
+            TSI_BUFFER_SIZE,
+            feed_cache=self.feed_cache,
+            cache_folder=self.stop_area_cache,
+            processes=self.feed_processes,
+        )
+        index.stops.to_file(f"{region_config['code']}-allstops.gpkg", layer="all_stops")
+        print("Wrote file")
+        print("Starting TSI computation")
+        for agency in index.stops.agency.unique():
+            print("  Computing for", agency)
+            agency_index = index.agency(agency)
+            # Only the needed columns of the feed's cached tables are read
+            gtfs = FeedTables(
+                os.path.join(gtfs_folder, f"{agency}.zip"), self.feed_cache
+            )
+            stops_per_bg = agency_index.stop_counts()
+            stops_per_bg = (
+                stops_per_bg[stops_per_bg > 0].rename("stop_id").reset_index()
+            )
+            stops_per_bg.to_csv(f"{region_config['code']}-{agency}.csv")
+            print("Wrote stops per bg for", agency)
+            # Let's get the TSI for every block group and run in one pass
+            counts = unique_trip_counts_by_area(gtfs, agency_index, windows, BGNAME)
+            counts = counts.reindex(areas[BGNAME]).fillna(0).astype(int)
+            for run_key in windows:
+                areas[run_key] += counts[run_key].to_numpy()
+        # Finish off by joining in items
+        runs.append(BGNAME)
+        out = areas[runs].set_index(BGNAME)
+        out.to_csv(os.path.join(region_folder, "tsi.csv"))
+
+    def run_access(self, region_key: str, run_key: str):
+        """Compute the transit and auto access metrics for one run"""
+        region_config = self.region_config(region_key)
+        region_folder = self.region_folder(region_key)
+
+        print("Computing access metrics")
+        # Compute access metrics
+        supply = traccess.Supply.from_csv(
+            region_config["supply"], dtype={"BG20": str}, id_column="BG20"
+        )
+        run_folder = os.path.join(region_folder, run_key)
+        print(f"    {run_key}: Output folder is", run_folder)
+        # A sharded matrix can be left part way by a crashed or running matrix step
+        for kind in ["full", LIMITED_TAG]:
+            matrix_path = os.path.join(run_folder, f"{kind}_matrix.parquet")
+            if not is_matrix_complete(matrix_path):
+                raise RuntimeError(
+                    f"{matrix_path} is missing or incomplete, run the {kind} matrix first"
                 )
-                for run_key, run in region["runs"].items():
-                    run_folder = os.path.join(region_folder, run_key)
-                    print(f"    {run_key}: Output folder is", run_folder)
-                    # Let's do full matrix first
-                    full_cost = traccess.Cost.from_parquet(
-                        os.path.join(run_folder, "full_matrix.parquet"),
-                        from_id="from_id",
-                        to_id="to_id",
-                    )
-                    # Now let's compute some STUFF
-                    ac = traccess.AccessComputer(supply, full_cost)
-                    print(f"    {run_key}: Computing c15 measures")
-                    c15 = ac.cumulative_cutoff(
-                        cost_columns=["travel_time"],
-                        cutoffs=[15],
-                        supply_columns=["acres"],
-                    ).data
-                    c15.columns = ["acres_c15"]
-
-                    print(f"    {run_key}: Computing c30 measures")
-                    c30 = ac.cumulative_cutoff(
-                        cost_columns=["travel_time"],
-                        cutoffs=[30],
-                        supply_columns=["C000", "acres"],
-                    ).data
-                    c30.columns = ["C000_c30", "acres_c30"]
-
-                    print(f"    {run_key}: Computing c45 measures")
-                    c45 = ac.cumulative_cutoff(
-                        cost_columns=["travel_time"],
-                        cutoffs=[45],
-                        supply_columns=["C000"],
-                    ).data
-                    c45.columns = ["C000_c45"]
-
-                    print(f"    {run_key}: Computing c60 measures")
-                    c60 = ac.cumulative_cutoff(
-                        cost_columns=["travel_time"],
-                        cutoffs=[60],
-                        supply_columns=["C000"],
-                    ).data
-                    c60.columns = ["C000_c60"]
-
-                    print(f"    {run_key}: Computing c90 measures")
-                    c90 = ac.cumulative_cutoff(
-                        cost_columns=["travel_time"],
-                        cutoffs=[90],
-                        supply_columns=["C000"],
-                    ).data
-                    c90.columns = ["C000_c90"]
-
-                    print(f"    {run_key}: Computing t1 measures")
-                    t1 = ac.cost_to_closest(
-                        "travel_time",
-                        supply_columns=[
-                            "education",
-                            "grocery",
-                            "hospitals",
-                            "pharmacies",
-                            "urgent_care_facilities",
-                            "early_voting",
-                        ],
-                        n=1,
-                    ).data
-                    t1.columns = [f"{c}_t1" for c in t1.columns]
-
-                    print(f"    {run_key}: Computing t3 measures")
-                    t3 = ac.cost_to_closest(
-                        "travel_time",
-                        [
-                            "education",
-                            "grocery",
-                            "hospitals",
-                            "pharmacies",
-                            "urgent_care_facilities",
-                        ],
-                        n=3,
-                    ).data
-                    t3.columns = [f"{c}_t3" for c in t3.columns]
-
-                    # Now we need fare constrained
-                    # Fare constrained analysis
-                    # Need to load in some fare matrices
-                    fare_threshold = region_config["fare_threshold"]
-                    fare_config = region_config["fare"]
-                    print(f"    {run_key}: Computing fare measures")
-                    years_dfs = []
-                    for year in fare_config:
-                        year_config = fare_config[year]
-                        # Read in the matrices
-                        full_fmx = pandas.read_parquet(year_config["full"])
-                        lim_fmx = pandas.read_parquet(year_config["limited"])
-                        full_fmx.columns = ["from_id", "to_id", "fare_cost"]
-                        lim_fmx.columns = ["from_id", "to_id", "fare_cost"]
-
-                        full_mx = pandas.read_parquet(
-                            os.path.join(run_folder, "full_matrix.parquet")
-                        )
-                        lim_mx = pandas.read_parquet(
-                            os.path.join(run_folder, "limited_matrix.parquet")
-                        )
-
-                        # Merge the fare matrix and the travel time matrices
-                        full_mx = pandas.merge(
-                            full_mx, full_fmx, on=["from_id", "to_id"]
-                        )
-                        lim_mx = pandas.merge(lim_mx, lim_fmx, on=["from_id", "to_id"])
-
-                        full_fare_cost = traccess.Cost(full_mx)
-                        lim_fare_cost = traccess.Cost(lim_mx)
-
-                        full_ac = traccess.AccessComputer(supply, full_fare_cost)
-                        lim_ac = traccess.AccessComputer(supply, lim_fare_cost)
-
-                        print(f"      {run_key} ({year}): Computing c15f measures")
-                        c15f_full = full_ac.cumulative_cutoff(
-                            ["travel_time", "fare_cost"],
-                            [15, fare_threshold],
-                            supply_columns=["acres"],
-                        ).data
-                        c15f_lim = lim_ac.cumulative_cutoff(
-                            ["travel_time", "fare_cost"],
-                            [15, fare_threshold],
-                            supply_columns=["acres"],
-                        ).data
-
-                        c15f = c15f_full.join(c15f_lim, lsuffix="_full", rsuffix="_lim")
-                        c15f[f"acres_c15f_{year}"] = c15f[
-                            ["acres_full", "acres_lim"]
-                        ].max(axis=1)
-                        c15f = c15f[[f"acres_c15f_{year}"]]
-
-                        years_dfs.append(c15f)
-
-                        print(f"      {run_key} ({year}): Computing c30f measures")
-                        c30f_full = full_ac.cumulative_cutoff(
-                            ["travel_time", "fare_cost"],
-                            [30, fare_threshold],
-                            supply_columns=["C000", "acres"],
-                        ).data
-                        c30f_lim = lim_ac.cumulative_cutoff(
-                            ["travel_time", "fare_cost"],
-                            [30, fare_threshold],
-                            supply_columns=["C000", "acres"],
-                        ).data
-
-                        c30f = c30f_full.join(c30f_lim, lsuffix="_full", rsuffix="_lim")
-                        c30f[f"C000_c30f_{year}"] = c30f[["C000_full", "C000_lim"]].max(
-                            axis=1
-                        )
-                        c30f[f"acres_c30f_{year}"] = c30f[
-                            ["acres_full", "acres_lim"]
-                        ].max(axis=1)
-                        c30f = c30f[[f"C000_c30f_{year}", f"acres_c30f_{year}"]]
-
-                        years_dfs.append(c30f)
-
-                        print(f"      {run_key} ({year}): Computing c45f measures")
-                        c45f_full = full_ac.cumulative_cutoff(
-                            ["travel_time", "fare_cost"],
-                            [45, fare_threshold],
-                            supply_columns=["C000"],
-                        ).data
-                        c45f_lim = lim_ac.cumulative_cutoff(
-                            ["travel_time", "fare_cost"],
-                            [45, fare_threshold],
-                            supply_columns=["C000"],
-                        ).data
-
-                        c45f = c45f_full.join(c45f_lim, lsuffix="_full", rsuffix="_lim")
-                        c45f[f"C000_c45f_{year}"] = c45f[["C000_full", "C000_lim"]].max(
-                            axis=1
-                        )
-                        c45f = c45f[[f"C000_c45f_{year}"]]
-
-                        years_dfs.append(c45f)
-
-                        print(f"      {run_key} ({year}): Computing c60f measures")
-                        c60f_full = full_ac.cumulative_cutoff(
-                            ["travel_time", "fare_cost"],
-                            [60, fare_threshold],
-                            supply_columns=["C000"],
-                        ).data
-                        c60f_lim = lim_ac.cumulative_cutoff(
-                            ["travel_time", "fare_cost"],
-                            [60, fare_threshold],
-                            supply_columns=["C000"],
-                        ).data
-
-                        c60f = c60f_full.join(c60f_lim, lsuffix="_full", rsuffix="_lim")
-                        c60f[f"C000_c60f_{year}"] = c60f[["C000_full", "C000_lim"]].max(
-                            axis=1
-                        )
-                        c60f = c60f[[f"C000_c60f_{year}"]]
-
-                        years_dfs.append(c60f)
-
-                        print(f"      {run_key} ({year}): Computing c90f measures")
-                        c90f_full = full_ac.cumulative_cutoff(
-                            ["travel_time", "fare_cost"],
-                            [90, fare_threshold],
-                            supply_columns=["C000"],
-                        ).data
-                        c90f_lim = lim_ac.cumulative_cutoff(
-                            ["travel_time", "fare_cost"],
-                            [90, fare_threshold],
-                            supply_columns=["C000"],
-                        ).data
-
-                        c90f = c90f_full.join(c90f_lim, lsuffix="_full", rsuffix="_lim")
-                        c90f[f"C000_c90f_{year}"] = c90f[["C000_full", "C000_lim"]].max(
-                            axis=1
-                        )
-                        c90f = c90f[[f"C000_c90f_{year}"]]
-
-                        years_dfs.append(c90f)
-
-                        del full_mx
-                        del lim_mx
-                        del full_fare_cost
-                        del lim_fare_cost
-
-                    df = c15.join(c30)
-                    df = df.join(c45)
-                    df = df.join(c60)
-                    df = df.join(c90)
-                    df = df.join(t1)
-                    df = df.join(t3)
-
-                    for frame in years_dfs:
-                        df = df.join(frame)
-
-                    df = df.reset_index().rename(columns={"from_id": "BG20"})
-                    print("    Saving transit access output to", run_folder)
-                    df.to_csv(
-                        os.path.join(run_folder, "access_transit.csv"), index=False
-                    )
+        # Let's do full matrix first. R5 travel times are whole minutes, so the
+        # dense matrix stores them as uint16.
+        full_mx = read_cost_matrix(
+            os.path.join(run_folder, "full_matrix.parquet"), dtype=numpy.uint16
+        )
+        print(f"    {run_key}: Computing cumulative measures")
+        cumulative = cumulative_cutoffs(full_mx, supply.data, ACCESS_CUTOFFS)
+
+        print(f"    {run_key}: Computing t1 measures")
+        t1 = cost_to_closest(
+            full_mx,
+            supply.data,
+            [
+                "education",
+                "grocery",
+                "hospitals",
+                "pharmacies",
+                "urgent_care_facilities",
+                "early_voting",
+            ],
+            n=1,
+        )
+        t1.columns = [f"{c}_t1" for c in t1.columns]
+
+        print(f"    {run_key}: Computing t3 measures")
+        t3 = cost_to_closest(
+            full_mx,
+            supply.data,
+            [
+                "education",
+                "grocery",
+                "hospitals",
+                "pharmacies",
+                "urgent_care_facilities",
+            ],
+            n=3,
+        )
+        t3.columns = [f"{c}_t3" for c in t3.columns]
+
+        # Now we need fare constrained
+        # The travel times are loaded once and the fares of every year are
+        # aligned to them by zone id
+        travel_times = {
+            "full": full_mx,
+            LIMITED_TAG: read_cost_matrix(
+                os.path.join(run_folder, f"{LIMITED_TAG}_matrix.parquet"),
+                dtype=numpy.uint16,
+            ),
+        }
+        fare_threshold = region_config["fare_threshold"]
+        fare_config = region_config["fare"]
+        print(f"    {run_key}: Computing fare measures")
+        years_dfs = []
+        for year in fare_config:
+            year_config = fare_config[year]
+            print(f"      {run_key} ({year}): Computing fare constrained measures")
+            networks = []
+            for kind, travel_time in travel_times.items():
+                # Read in the matrices
+                fmx = pandas.read_parquet(year_config[kind])
+                fmx.columns = ["from_id", "to_id", "fare_cost"]
+                fare = CostMatrix.from_frame(
+                    fmx, "fare_cost", ids=travel_time.ids, dtype=numpy.float64
+                )
+                networks.append((travel_time, fare))
+                del fmx
+
+            years_dfs.append(
+                fare_constrained_cutoffs(
+                    networks,
+                    supply.data,
+                    ACCESS_CUTOFFS,
+                    fare_threshold,
+                    suffix=f"f_{year}",
+                )
+            )
+            del networks
 
-                    del c30
-                    del c45
-                    del c60
-                    del c90
-                    del t1
-                    del t3
-                    del years_dfs
+        del full_mx
+        del travel_times
 
-                    # Now auto matrices
+        df = cumulative.join(t1)
+        df = df.join(t3)
 
-                    auto_cost = traccess.Cost.from_parquet(
-                        os.path.join(region_config["auto"], f"{run_key}.parquet")
-                    )
-                    auto_ac = traccess.AccessComputer(supply, auto_cost)
-
-                    print(f"    {run_key}: Computing AUTO c15 measures")
-                    auto_c15 = auto_ac.cumulative_cutoff(
-                        cost_columns=["travel_time"],
-                        cutoffs=[15],
-                        supply_columns=["acres"],
-                    ).data
-                    auto_c15.columns = ["acres_c15_auto"]
-
-                    print(f"    {run_key}: Computing AUTO c30 measures")
-                    auto_c30 = auto_ac.cumulative_cutoff(
-                        cost_columns=["travel_time"],
-                        cutoffs=[30],
-                        supply_columns=["C000", "acres"],
-                    ).data
-                    auto_c30.columns = ["C000_c30_auto", "acres_c30_auto"]
-
-                    print(f"    {run_key}: Computing AUTO c45 measures")
-                    auto_c45 = auto_ac.cumulative_cutoff(
-                        cost_columns=["travel_time"],
-                        cutoffs=[45],
-                        supply_columns=["C000"],
-                    ).data
-                    auto_c45.columns = ["C000_c45_auto"]
-
-                    print(f"    {run_key}: Computing AUTO c60 measures")
-                    auto_c60 = auto_ac.cumulative_cutoff(
-                        cost_columns=["travel_time"],
-                        cutoffs=[60],
-                        supply_columns=["C000"],
-                    ).data
-                    auto_c60.columns = ["C000_c60_auto"]
-
-                    print(f"    {run_key}: Computing AUTO c90 measures")
-                    auto_c90 = auto_ac.cumulative_cutoff(
-                        cost_columns=["travel_time"],
-                        cutoffs=[90],
-                        supply_columns=["C000"],
-                    ).data
-                    auto_c90.columns = ["C000_c90_auto"]
-
-                    df = auto_c15.join(auto_c30)
-                    df = df.join(auto_c45)
-                    df = df.join(auto_c60)
-                    df = df.join(auto_c90)
-
-                    del auto_c15
-                    del auto_c30
-                    del auto_c45
-                    del auto_c60
-                    del auto_c90
-
-                    print(f"    {run_key}: Computing AUTO t1 measures")
-                    auto_t1 = auto_ac.cost_to_closest(
-                        "travel_time",
-                        [
-                            "education",
-                            "grocery",
-                            "hospitals",
-                            "pharmacies",
-                            "urgent_care_facilities",
-                            "early_voting",
-                        ],
-                        n=1,
-                    ).data
-                    auto_t1.columns = [f"{c}_t1_auto" for c in auto_t1.columns]
-
-                    print(f"    {run_key}: Computing AUTO t3 measures")
-                    auto_t3 = auto_ac.cost_to_closest(
-                        "travel_time",
-                        [
-                            "education",
-                            "grocery",
-                            "hospitals",
-                            "pharmacies",
-                            "urgent_care_facilities",
-                        ],
-                        n=3,
-                    ).data
-                    auto_t3.columns = [f"{c}_t3_auto" for c in auto_t3.columns]
-
-                    df = df.join(auto_t1)
-                    df = df.join(auto_t3)
-
-                    df = df.reset_index().rename(columns={"from_id": "BG20"})
-                    print("    Saving auto access output to", run_folder)
-                    df.to_csv(os.path.join(run_folder, "access_auto.csv"), index=False)
-                    del df
-
-                    # Load and combine
-                    transit = pandas.read_csv(
-                        os.path.join(run_folder, "access_transit.csv"),
-                        dtype={"BG20": str},
-                    )
-                    auto = pandas.read_csv(
-                        os.path.join(run_folder, "access_auto.csv"), dtype={"BG20": str}
-                    )
-                    transit = pandas.merge(transit, auto, on="BG20")
-                    transit.to_csv(os.path.join(run_folder, "access.csv"), index=False)
-                    del transit
-                    del auto
-
-            if region["equity"]:
-                print("Computing equity summary metrics")
-                # Grab TSI
-                tsi = pandas.read_csv(
-                    os.path.join(region_folder, "tsi.csv"), dtype={"BG20": str}
-                )
-                for run_key, run in region["runs"].items():
-                    run_folder = os.path.join(region_folder, run_key)
-                    print(f"    {run_key}: Output folder is", run_folder)
-                    acs_df = pandas.read_csv(
-                        os.path.join(run_folder, "access.csv"), dtype={"BG20": str}
-                    )
-                    this_tsi = (
-                        tsi[["BG20", run_key]].copy().rename(columns={run_key: "tsi"})
-                    )
+        for frame in years_dfs:
+            df = df.join(frame)
 
-                    acs_df = pandas.merge(acs_df, this_tsi, on="BG20")
-                    demo_df = pandas.read_csv(
-                        region_config["demographics"],
-                        dtype={"BG20": str},
-                    )
+        df = df.reset_index().rename(columns={"from_id": "BG20"})
+        print("    Saving transit access output to", run_folder)
+        df.to_csv(os.path.join(run_folder, "access_transit.csv"), index=False)
 
-                    # First let's do it for the whole region
-                    access = traccess.Access(acs_df, id_column="BG20")
-                    demographics = traccess.Demographic(demo_df, id_column="BG20")
-                    ec = traccess.EquityComputer(
-                        access=access, demographic=demographics
-                    )
-                    all = []
-                    for c in access.columns:
-                        all.append(ec.weighted_average(c).to_frame())
-                    all = pandas.concat(all, axis="columns")
-                    all = all.rename_axis("demographic")
-                    all["area"] = "urban"
-
-                    # Next let's do the urban area
-                    city_bgs = pandas.read_csv(
-                        region_config["city"],
-                        dtype={"BG20": str},
-                    )
-                    access = traccess.Access(
-                        acs_df[acs_df["BG20"].isin(city_bgs["BG20"])], id_column="BG20"
-                    )
-                    demographics = traccess.Demographic(
-                        demo_df[demo_df["BG20"].isin(city_bgs["BG20"])],
-                        id_column="BG20",
-                    )
-                    ec = traccess.EquityComputer(
-                        access=access, demographic=demographics
-                    )
-                    city = []
-                    for c in access.columns:
-                        city.append(ec.weighted_average(c).to_frame())
-                    city = pandas.concat(city, axis="columns")
-                    city = city.rename_axis("demographic")
-                    city["area"] = "city"
+        del cumulative
+        del t1
+        del t3
+        del years_dfs
+
+        # Now auto matrices
+
+        # Auto travel times can be fractional minutes, so keep full precision
+        auto_mx = read_cost_matrix(
+            os.path.join(region_config["auto"], f"{run_key}.parquet"),
+            dtype=numpy.float64,
+        )
+
+        print(f"    {run_key}: Computing AUTO cumulative measures")
+        df = cumulative_cutoffs(auto_mx, supply.data, ACCESS_CUTOFFS, suffix="_auto")
+
+        print(f"    {run_key}: Computing AUTO t1 measures")
+        auto_t1 = cost_to_closest(
+            auto_mx,
+            supply.data,
+            [
+                "education",
+                "grocery",
+                "hospitals",
+                "pharmacies",
+                "urgent_care_facilities",
+                "early_voting",
+            ],
+            n=1,
+        )
+        auto_t1.columns = [f"{c}_t1_auto" for c in auto_t1.columns]
+
+        print(f"    {run_key}: Computing AUTO t3 measures")
+        auto_t3 = cost_to_closest(
+            auto_mx,
+            supply.data,
+            [
+                "education",
+                "grocery",
+                "hospitals",
+                "pharmacies",
+                "urgent_care_facilities",
+            ],
+            n=3,
+        )
+        auto_t3.columns = [f"{c}_t3_auto" for c in auto_t3.columns]
+        del auto_mx
+
+        df = df.join(auto_t1)
+        df = df.join(auto_t3)
+
+        df = df.reset_index().rename(columns={"from_id": "BG20"})
+        print("    Saving auto access output to", run_folder)
+        df.to_csv(os.path.join(run_folder, "access_auto.csv"), index=False)
+        del df
+
+        # Load and combine
+        transit = pandas.read_csv(
+            os.path.join(run_folder, "access_transit.csv"),
+            dtype={"BG20": str},
+        )
+        auto = pandas.read_csv(
+            os.path.join(run_folder, "access_auto.csv"), dtype={"BG20": str}
+        )
+        transit = pandas.merge(transit, auto, on="BG20")
+        transit.to_csv(os.path.join(run_folder, "access.csv"), index=False)
+        del transit
+        del auto
+
+    def run_equity(self, region_key: str, run_key: str):
+        """Compute the equity summary metrics for one run"""
+        region_config = self.region_config(region_key)
+        region_folder = self.region_folder(region_key)
+
+        print("Computing equity summary metrics")
+        # Grab TSI
+        tsi = pandas.read_csv(
+            os.path.join(region_folder, "tsi.csv"), dtype={"BG20": str}
+        )
+        run_folder = os.path.join(region_folder, run_key)
+        print(f"    {run_key}: Output folder is", run_folder)
+        acs_df = pandas.read_csv(
+            os.path.join(run_folder, "access.csv"), dtype={"BG20": str}
+        )
+        this_tsi = tsi[["BG20", run_key]].copy().rename(columns={run_key: "tsi"})
+
+        acs_df = pandas.merge(acs_df, this_tsi, on="BG20")
+        demo_df = pandas.read_csv(
+            region_config["demographics"],
+            dtype={"BG20": str},
+        )
+
+        # First let's do it for the whole region
+        access = traccess.Access(acs_df, id_column="BG20")
+        demographics = traccess.Demographic(demo_df, id_column="BG20")
+        ec = traccess.EquityComputer(access=access, demographic=demographics)
+        all = []
+        for c in access.columns:
+            all.append(ec.weighted_average(c).to_frame())
+        all = pandas.concat(all, axis="columns")
+        all = all.rename_axis("demographic")
+        all["area"] = "urban"
+
+        # Next let's do the urban area
+        city_bgs = pandas.read_csv(
+            region_config["city"],
+            dtype={"BG20": str},
+        )
+        access = traccess.Access(
+            acs_df[acs_df["BG20"].isin(city_bgs["BG20"])], id_column="BG20"
+        )
+        demographics = traccess.Demographic(
+            demo_df[demo_df["BG20"].isin(city_bgs["BG20"])],
+            id_column="BG20",
+        )
+        ec = traccess.EquityComputer(access=access, demographic=demographics)
+        city = []
+        for c in access.columns:
+            city.append(ec.weighted_average(c).to_frame())
+        city = pandas.concat(city, axis="columns")
+        city = city.rename_axis("demographic")
+        city["area"] = "city"
 
-                    both = pandas.concat([all, city], axis="index")
+        both = pandas.concat([all, city], axis="index")
 
-                    both.to_csv(os.path.join(run_folder, "summary.csv"))
+        both.to_csv(os.path.join(run_folder, "summary.csv"))
 
     def run_matrix(
         self, region, centroids, gtfs_folder, region_folder, runs, output_name
@@ -596,9 +537,10 @@ class Run:
             if (not filename.startswith(".")) and (filename.endswith(".zip")):
                 gtfs_files.append(os.path.join(gtfs_folder, filename))
 
-        # Build the full network
-        print("   building transport network")
-        network = TransportNetwork(osm_pbf=region["osm"], gtfs=gtfs_files)
+        # Build the full network, or reuse one already built from the same inputs
+        network = get_transport_network(region["osm"], gtfs_files)
+        # Sharded matrices are only resumed on a network built from the same inputs
+        inputs_key = network_key(region["osm"], gtfs_files)
 
         # Run the matrices for the specified runs
         for run_key, run in runs.items():
@@ -608,20 +550,112 @@ class Run:
 
             print(f"    Running {run_key}")
 
-            computer = TravelTimeMatrixComputer(
-                network,
-                origins=centroids,
-                destinations=centroids,
+            settings = dict(
                 departure=run,
                 departure_time_window=datetime.timedelta(minutes=120),
                 max_time=datetime.timedelta(minutes=180),
                 transport_modes=["WALK", "TRANSIT"],
             )
+            output_path = os.path.join(run_folder, f"{output_name}.parquet")
+            # Make sure a store from an earlier run never outlives its matrix
+            remove_matrix_store(output_path)
+
+            if self.matrix_shard_size is not None:
+                # Write one part file per chunk of origins so we can resume
+                compute_sharded_matrix(
+                    network,
+                    centroids,
+                    output_path,
+                    self.matrix_shard_size,
+                    inputs_key,
+                    **settings,
+                )
+                mx = pandas.read_parquet(output_path)
+            else:
+                computer = TravelTimeMatrixComputer(
+                    network,
+                    origins=centroids,
+                    destinations=centroids,
+                    **settings,
+                )
+
+                # Actually compute the travel times
+                mx = computer.compute_travel_times()
+                # Dump it into a file, replacing shards from an earlier run
+                write_matrix(mx, output_path)
+
+            # Also keep a dense copy that the access step can memory-map
+            dense = CostMatrix.from_frame(mx, dtype=numpy.uint16)
+            dense.metadata = {
+                "region": region["name"],
+                "week_of": self.week_of,
+                "run": run_key,
+                "departure": str(run),
+                "network": output_name,
+            }
+            save_matrix_store(dense, output_path)
+            del mx, dense
+
+
+def run_task_graph(run: Run, tasks: dict, workers: int, memory_budget=None):
+    """Run a task graph on a pool of worker processes
+
+    A task is started once all of its dependencies have finished, as long as a
+    worker is free and its estimated memory fits in the budget. A task that is
+    larger than the whole budget still runs, but only on its own.
+
+    Parameters
+    ----------
+    run : Run
+        The run the tasks belong to
+    tasks : dict
+        The tasks keyed by task key, as built by ``Run.build_task_graph``
+    workers : int
+        The maximum number of tasks to run at once
+    memory_budget : float, optional
+        The memory available to running tasks (GB), by default None (no limit)
+    """
+    pending = dict(tasks)
+    done = set()
+    running = {}
+    memory_in_use = 0.0
+    # Spawn rather than fork, as the parent may already have a JVM running
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(workers, mp_context=context) as pool:
+        while pending or running:
+            for key, task in list(pending.items()):
+                if len(running) >= workers:
+                    break
+                if not all(dep in done for dep in task.depends_on):
+                    continue
+                memory = TASK_MEMORY_GB[task.key[0]]
+                if (
+                    memory_budget is not None
+                    and running
+                    and memory_in_use + memory > memory_budget
+                ):
+                    continue
+                print("Starting", "/".join(task.key))
+                running[pool.submit(_run_task, run, task)] = task
+                memory_in_use += memory
+                del pending[key]
+
+            if not running:
+                raise RuntimeError(f"Unable to schedule tasks: {list(pending)}")
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in finished:
+                task = running.pop(future)
+                memory_in_use -= TASK_MEMORY_GB[task.key[0]]
+                # Raise any error from the worker here
+                future.result()
+                print("Finished", "/".join(task.key))
+                done.add(task.key)
+
 
-            # Actually compute the travel times
-            mx = computer.compute_travel_times()
-            # Dump it into a folder
-            mx.to_parquet(os.path.join(run_folder, f"{output_name}.parquet"))
+def _run_task(run: Run, task: Task):
+    getattr(run, task.method)(*task.args)
 
 
 def create_folder_safely(folder_path: os.path):
@@ -632,9 +666,8 @@ def create_folder_safely(folder_path: os.path):
     folder_path : os.path
         The path to the folder to create or check for existence
     """
-    if not os.path.exists(folder_path):
-        print("Creating folder", folder_path)
-        os.mkdir(folder_path)
+    # Tolerates other tasks creating the same folder at the same time
+    os.makedirs(folder_path, exist_ok=True)
 
 
 def create_regions(root_directory):
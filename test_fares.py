@@ -0,0 +1,247 @@
+"""Reference tests for fare matrices
+
+``FareRules.transfer_rule`` resolves the ``__ANY__``/``__ELSE__`` transfer
+cascade once, when the rules are loaded. This checks it against the cascade as
+it was previously run on the transfer table for every leg pair, both rule by
+rule and on the fares of a reference set of itineraries. It also checks that
+fare matrices computed on several processes are written byte for byte as the
+serial ones.
+
+Run:  python test_fares.py (or pytest)
+"""
+
+import datetime
+import os
+import random
+import sqlite3
+import tempfile
+
+import pandas
+
+from ted.fare import (
+    FareRules,
+    Itinerary,
+    TransferRule,
+    TransitLeg,
+    compute_pair_fares,
+    compute_pair_fares_in_parallel,
+)
+
+FEEDS = ["a", "b", "c"]
+ROUTES = {"a": ["r1", "r2"], "b": ["r3", "r4"], "c": ["r5", "r6"]}
+
+FARE_TYPES = [("a", "flat", 1, 5400), ("b", "flat", -1, 0), ("c", "zone", 0, 3600)]
+FLAT_FARES = [("a", 275), ("b", 300)]
+ROUTE_FARES = [("a", "r1", 500), ("b", "r3", 450)]
+ZONES = [("c", f"s{i}", f"z{i % 3}") for i in range(10)]
+ZONE_FARES = [
+    ("c", "__ANY__", "z0", "z1", 400),
+    ("c", "r5", "z1", "z2", 650),
+    ("c", "__ANY__", "z0", "z0", 300),
+    ("c", "__ANY__", "z1", "z1", 325),
+    ("c", "__ANY__", "z2", "z2", 350),
+    ("c", "__ANY__", "z1", "z0", 400),
+    ("c", "__ANY__", "z2", "z0", 500),
+    ("c", "__ANY__", "z2", "z1", 450),
+    ("c", "__ANY__", "z1", "z2", 450),
+    ("c", "__ANY__", "z0", "z2", 700),
+]
+# Covers __ANY__, specific and __ELSE__ rules on both sides, several rules
+# for one feed pair, and feed pairs without rules
+TRANSFERS = [
+    ("a", "a", "__ANY__", "__ANY__", "transfer-discount", 0, 0),
+    ("a", "b", "r1", "__ANY__", "transfer-discount", 1, 100),
+    ("a", "b", "__ELSE__", "__ANY__", "transfer-discount", 0, 50),
+    ("b", "a", "__ANY__", "r2", "free", 0, 25),
+    ("b", "a", "r3", "__ANY__", "free", 1, 30),
+    ("b", "c", "r3", "x", "transfer-discount", 1, 75),
+    ("b", "c", "__ELSE__", "y", "other", 1, 120),
+    ("c", "a", "__ELSE__", "__ELSE__", "other", 0, 10),
+    ("c", "c", "r5", "r6", "transfer-discount", 0, 40),
+]
+
+
+def make_fares_db(path: str):
+    """Write the reference fares database"""
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE fare_type(mdb_slug TEXT, fare_type TEXT, transfers_allowed INT, fare_duration INT)"
+    )
+    conn.executemany("INSERT INTO fare_type VALUES (?, ?, ?, ?)", FARE_TYPES)
+    conn.execute("CREATE TABLE flat_fare(mdb_slug TEXT, fare_cost INT)")
+    conn.executemany("INSERT INTO flat_fare VALUES (?, ?)", FLAT_FARES)
+    conn.execute("CREATE TABLE route_fare(mdb_slug TEXT, route_id TEXT, fare_cost INT)")
+    conn.executemany("INSERT INTO route_fare VALUES (?, ?, ?)", ROUTE_FARES)
+    conn.execute("CREATE TABLE zone(mdb_slug TEXT, stop_id TEXT, zone_id TEXT)")
+    conn.executemany("INSERT INTO zone VALUES (?, ?, ?)", ZONES)
+    conn.execute(
+        "CREATE TABLE zone_fare(mdb_slug TEXT, route_id TEXT, from_zone TEXT, to_zone TEXT, fare_cost INT)"
+    )
+    conn.executemany("INSERT INTO zone_fare VALUES (?, ?, ?, ?, ?)", ZONE_FARES)
+    conn.execute(
+        "CREATE TABLE transfer(from_mdb_slug TEXT, to_mdb_slug TEXT, from_route_id TEXT, "
+        "to_route_id TEXT, transfer_type TEXT, new_fare INT, fare_value INT)"
+    )
+    conn.executemany("INSERT INTO transfer VALUES (?, ?, ?, ?, ?, ?, ?)", TRANSFERS)
+    conn.commit()
+    conn.close()
+
+
+def cascade_transfer_rule(
+    transfers: pandas.DataFrame, from_feed: str, to_feed: str, from_route_id: str
+):
+    """Find a transfer rule the way compute_fare did before the rules were compiled"""
+    transfers = transfers[transfers.from_mdb_slug == from_feed]
+    df = transfers[transfers.to_mdb_slug == to_feed]
+
+    from_df = df[df.from_route_id == "__ANY__"]
+    if from_df.shape[0] == 0:
+        from_df = df[df.from_route_id == from_route_id]
+        if from_df.shape[0] == 0:
+            from_df = df[df.from_route_id == "__ELSE__"]
+
+    to_df = from_df[from_df.to_route_id == "__ANY__"]
+    if to_df.shape[0] == 0:
+        to_df = from_df[from_df.from_route_id == from_route_id]
+        if to_df.shape[0] == 0:
+            to_df = from_df[from_df.from_route_id == "__ELSE__"]
+
+    if to_df.shape[0] > 0:
+        return TransferRule(*to_df.iloc[0][list(TransferRule._fields)])
+    return None
+
+
+class CascadeFareRules(FareRules):
+    """Fare rules that search the transfer table for every leg pair"""
+
+    def __init__(self, tables: dict, transfers: pandas.DataFrame):
+        super().__init__(tables, transfers)
+        self.transfers = transfers
+
+    def transfer_rule(self, from_feed: str, to_feed: str, from_route_id: str):
+        return cascade_transfer_rule(self.transfers, from_feed, to_feed, from_route_id)
+
+
+def make_itineraries(count: int, seed: int = 0) -> list:
+    """Make itineraries of one to four random transit legs"""
+    rng = random.Random(seed)
+    start = datetime.datetime(2024, 1, 10, 7, 0)
+    itineraries = []
+    for _ in range(count):
+        departure_time = start + datetime.timedelta(minutes=rng.randint(0, 60))
+        legs = []
+        for _ in range(rng.randint(1, 4)):
+            feed = rng.choice(FEEDS)
+            departure_time += datetime.timedelta(minutes=rng.randint(5, 70))
+            legs.append(
+                TransitLeg(
+                    "BUS",
+                    departure_time,
+                    feed,
+                    "agency",
+                    rng.choice(ROUTES[feed] + ["unlisted"]),
+                    f"s{rng.randint(0, 9)}",
+                    f"s{rng.randint(0, 9)}",
+                )
+            )
+        itineraries.append(legs)
+    return itineraries
+
+
+def compute_fares(rules: FareRules, itineraries: list) -> list:
+    return [
+        Itinerary.from_legs(legs, "reference", rules).compute_fare()
+        for legs in itineraries
+    ]
+
+
+def make_leg_frame(itineraries: list) -> pandas.DataFrame:
+    """Make itinerary legs as read from OTP, starting each with a walk"""
+    rows = []
+    for i, legs in enumerate(itineraries):
+        # A few origins, so pairs are spread over several shards
+        from_id, to_id = i % 7, i
+        rows.append(
+            (from_id, to_id, 0, "WALK", legs[0].departure_time)
+            + (None, None, None, None, legs[0].start_stop_id)
+        )
+        for segment, leg in enumerate(legs, start=1):
+            rows.append(
+                (from_id, to_id, segment, leg.transport_mode, leg.departure_time)
+                + (leg.feed, leg.agency_id, leg.route_id)
+                + (leg.start_stop_id, leg.end_stop_id)
+            )
+    return pandas.DataFrame(
+        rows,
+        columns=[
+            "from_id",
+            "to_id",
+            "segment",
+            "transport_mode",
+            "departure_time",
+            "feed",
+            "agency_id",
+            "route_id",
+            "start_stop_id",
+            "end_stop_id",
+        ],
+    )
+
+
+def parquet_bytes(df: pandas.DataFrame, path: str) -> bytes:
+    df.to_parquet(path)
+    with open(path, "rb") as infile:
+        return infile.read()
+
+
+def test_transfer_rules_match_cascade():
+    with tempfile.TemporaryDirectory() as folder:
+        db = os.path.join(folder, "fares.db")
+        make_fares_db(db)
+        rules = FareRules.from_db(db)
+        cascade = CascadeFareRules.from_db(db)
+
+    for from_feed in FEEDS:
+        for to_feed in FEEDS + ["none"]:
+            for route_id in ROUTES[from_feed] + ["unlisted", None]:
+                assert rules.transfer_rule(
+                    from_feed, to_feed, route_id
+                ) == cascade.transfer_rule(from_feed, to_feed, route_id), (
+                    from_feed,
+                    to_feed,
+                    route_id,
+                )
+
+    itineraries = make_itineraries(500)
+    assert compute_fares(rules, itineraries) == compute_fares(cascade, itineraries)
+
+
+def test_parallel_fares_match_serial():
+    legs = make_leg_frame(make_itineraries(300))
+    cases = {
+        "mixed": legs,
+        # Every pair has a single leg, so no pair gets a fare
+        "single": legs[legs.segment == 1],
+    }
+    with tempfile.TemporaryDirectory() as folder:
+        db = os.path.join(folder, "fares.db")
+        make_fares_db(db)
+        rules = FareRules.from_db(db)
+        for name, df in cases.items():
+            serial = compute_pair_fares(df, rules, "reference", progress=False)
+            parallel = compute_pair_fares_in_parallel(
+                df, rules, "reference", 2, os.path.join(folder, f"{name}.shards")
+            )
+            assert serial.empty == (name == "single"), name
+            assert parquet_bytes(
+                serial, os.path.join(folder, f"{name}.serial.parquet")
+            ) == parquet_bytes(
+                parallel, os.path.join(folder, f"{name}.parallel.parquet")
+            ), name
+
+
+if __name__ == "__main__":
+    test_transfer_rules_match_cascade()
+    print("OK - compiled transfer rules match the transfer cascade")
+    test_parallel_fares_match_serial()
+    print("OK - parallel fare matrices match the serial ones")
@@ -0,0 +1,76 @@
+"""Reference test for copying GTFS zip members
+
+``_copy_zip_member`` copies the compressed bytes of a member into another zip
+through private ``zipfile`` internals. This copies members written in several
+ways, next to one written through ``zipfile`` itself, and reads them back, so a
+change in ``zipfile`` fails here rather than producing corrupt GTFS zips.
+
+Run:  python test_gtfs.py (or pytest)
+"""
+
+import io
+import os
+import tempfile
+import zipfile
+
+from ted.gtfs import _copy_zip_member
+
+MEMBERS = {
+    "agency.txt": (b"agency_id,agency_name\n1,Transit\n", zipfile.ZIP_DEFLATED),
+    "stops.txt": (b"stop_id,stop_lat,stop_lon\n" * 2000, zipfile.ZIP_STORED),
+    # Flattened to routes.txt when copied
+    "feed/routes.txt": (b"route_id,route_type\n" * 2000, zipfile.ZIP_DEFLATED),
+}
+
+
+class Unseekable(io.RawIOBase):
+    """A write-only stream, which makes zipfile add data descriptors"""
+
+    def __init__(self, outfile):
+        self.outfile = outfile
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.outfile.write(data)
+
+
+def make_zip(path: str, seekable: bool):
+    with open(path, "wb") as outfile:
+        with zipfile.ZipFile(outfile if seekable else Unseekable(outfile), "w") as z:
+            for name, (data, compress_type) in MEMBERS.items():
+                z.writestr(name, data, compress_type=compress_type)
+
+
+def test_copy_zip_member():
+    with tempfile.TemporaryDirectory() as folder:
+        for seekable in [True, False]:
+            source = os.path.join(folder, f"source-{seekable}.zip")
+            copy = os.path.join(folder, f"copy-{seekable}.zip")
+            make_zip(source, seekable)
+            with zipfile.ZipFile(source) as zin, zipfile.ZipFile(copy, "w") as zout:
+                for info in zin.infolist():
+                    _copy_zip_member(zin, zout, info, os.path.basename(info.filename))
+                # Members written by zipfile itself follow the copied ones
+                with zout.open("trips.txt", "w") as outfile:
+                    outfile.write(b"route_id,trip_id\n")
+
+            with zipfile.ZipFile(copy) as z:
+                assert z.testzip() is None
+                assert z.namelist() == [
+                    "agency.txt",
+                    "stops.txt",
+                    "routes.txt",
+                    "trips.txt",
+                ]
+                for name, (data, compress_type) in MEMBERS.items():
+                    info = z.getinfo(os.path.basename(name))
+                    assert info.compress_type == compress_type
+                    assert z.read(info) == data
+                assert z.read("trips.txt") == b"route_id,trip_id\n"
+
+
+if __name__ == "__main__":
+    test_copy_zip_member()
+    print("OK - copied zip members read back unchanged")